@@ -1,56 +1,151 @@
 import json
-from flask import Flask, jsonify, request
-from google.cloud import storage
+from flask import Flask, Response, g, jsonify, request
 import create_image
 import veo_utils
-from google.oauth2 import service_account
 import os
 import translate
 import create_story
+import generate_bgm
 import gcs_utils
-
-
-key_json_str = os.environ.get("GCS_KEY_JSON")
-if not key_json_str:
-    raise RuntimeError("環境変数 GCS_KEY_JSON が設定されていません")
-key_dict = json.loads(key_json_str)
-credentials = service_account.Credentials.from_service_account_info(key_dict)
-client = storage.Client(credentials=credentials)
+import jobs
+import metrics
+import retry
+import tracing
 
 
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# リクエスト全体の期限 (秒)。中のモデル呼び出しの再試行はこれを超えて待たない (gunicorn の --timeout 3000 より短くする)
+CHAT_FIN_DEADLINE_SECONDS = float(os.getenv("CHAT_FIN_DEADLINE_SECONDS", "900"))
+EDIT_DEADLINE_SECONDS = float(os.getenv("EDIT_DEADLINE_SECONDS", "600"))
+VIDEO_REQUEST_DEADLINE_SECONDS = float(os.getenv("VIDEO_REQUEST_DEADLINE_SECONDS", "2700"))
+REQUEST_DEADLINES = {
+    "/chat-fin": CHAT_FIN_DEADLINE_SECONDS,
+    "/edit": EDIT_DEADLINE_SECONDS,
+    "/video": VIDEO_REQUEST_DEADLINE_SECONDS,
+}
 
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "a3f5c2b9e7d44c7a8e5b6f3f28c9a412")
 
 
-@app.post("/form")
-def form():
-    print("フォーム入力を受け付けました")
+# ===== リクエスト単位のトレース =====
+@app.before_request
+def start_request_span():
+    body = request.get_json(silent=True) if request.is_json else None
+    project_folder = body.get("project_folder") if isinstance(body, dict) else None
+    # ルートに一致しないパスはラベルの種類が増えないようにまとめる
+    rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+    metrics.HTTP_REQUESTS_IN_FLIGHT.inc()
+    g.trace_span = tracing.start_span(
+        f"{request.method} {rule}",
+        kind="http",
+        path=request.path,
+        project_folder=project_folder or None,
+        request_bytes=request.content_length,
+    )
+    if rule in REQUEST_DEADLINES:
+        g.deadline_token = retry.start_budget(REQUEST_DEADLINES[rule])
+
+
+@app.after_request
+def record_response(response):
+    span = g.get("trace_span")
+    if span is not None:
+        span.set("status_code", response.status_code)
+        if not response.is_streamed:
+            span.set("response_bytes", response.calculate_content_length())
+    return response
+
+
+@app.teardown_request
+def finish_request_span(error=None):
+    deadline_token = g.pop("deadline_token", None)
+    if deadline_token is not None:
+        retry.end_budget(deadline_token)
+    span = g.pop("trace_span", None)
+    if span is not None:
+        span.finish(error=error)
+        metrics.HTTP_REQUESTS_IN_FLIGHT.dec()
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus 形式のメトリクス"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+def sse(event, data):
+    """Server-Sent Events の 1 イベント分の文字列を作る"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_response(events):
+    return Response(
+        events,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def save_user_input(data):
+    """プロジェクトフォルダを作成してユーザー入力を保存し、(project_folder, gcs_path, user_input_en_path) を返す"""
     project_folder = gcs_utils.create_next_project_folder()
     
     json_folder = project_folder + "json/"
-    data = request.get_json(silent=True) or {}
     filename = f"user_input_akakura_ja.json"
     gcs_path = json_folder + filename
     user_input_en_path = json_folder + "user_input_akakura_en.json"
     # GCS にアップロード
-    client = storage.Client()
-    bucket = client.bucket(BUCKET_NAME)
-    blob = bucket.blob(gcs_path)
-    blob.upload_from_string(json.dumps(data, ensure_ascii=False, indent=2), content_type="application/json")
+    gcs_utils.write_json(BUCKET_NAME, data, gcs_path)
+    return project_folder, gcs_path, user_input_en_path
+
+
+@app.post("/form")
+def form():
+    print("フォーム入力を受け付けました")
+    data = request.get_json(silent=True) or {}
+    project_folder, gcs_path, user_input_en_path = save_user_input(data)
     translate.translate_json(BUCKET_NAME, gcs_path, user_input_en_path)
     reply = create_story.first(data)
     
     return {"reply": reply, "project_folder": project_folder}
 
 
-@app.post("/chat")
-def chat():
+@app.post("/form/stream")
+def form_stream():
+    """/form のストリーミング版。project_folder → token... → done の順にイベントを送る"""
+    print("フォーム入力を受け付けました (stream)")
     data = request.get_json(silent=True) or {}
-
+    project_folder, gcs_path, user_input_en_path = save_user_input(data)
+
+    def events():
+        with tracing.span("stream /form/stream", kind="sse", project_folder=project_folder):
+            yield from form_events()
+
+    def form_events():
+        yield sse("project_folder", {"project_folder": project_folder})
+        reply = ""
+        try:
+            for text in create_story.first_stream(data):
+                reply += text
+                yield sse("token", {"text": text})
+            # 翻訳は返信の表示に不要なので、ストリームの後に行う
+            translate.translate_json(BUCKET_NAME, gcs_path, user_input_en_path)
+        except Exception as e:
+            print("form stream error:", e)
+            yield sse("error", {"error": str(e)})
+            return
+        print("システム：" + reply)
+        yield sse("done", {"reply": reply or "（生成結果なし）", "project_folder": project_folder})
+
+    return sse_response(events())
+
+
+def build_chat_suffix(data):
+    """リクエストの会話履歴と最新の発話からモデルに渡すプロンプトを作る"""
     # 送信形式の違いを吸収
     message = data.get("message") or data.get("input")
     if not message and isinstance(data.get("messages"), list):
@@ -94,19 +189,56 @@ def chat():
         # 履歴が無い初回
         suffix = "【会話履歴】(なし)\n\n【指示】初回の質問から開始してください。"
 
+    return suffix
+
+
+@app.post("/chat")
+def chat():
+    data = request.get_json(silent=True) or {}
+    suffix = build_chat_suffix(data)
+
     reply_text = create_story.generate_lyrics(suffix)
     return jsonify({"reply": reply_text})
 
 
-@app.post("/chat-fin")
-def image():
-    
+@app.post("/chat/stream")
+def chat_stream():
+    """/chat のストリーミング版。token... → done の順にイベントを送る"""
     data = request.get_json(silent=True) or {}
-    
-    project_folder = data.get("project_folder", "")
-    messages = data.get("messages", [])
-    print("messages:", messages)
-
+    suffix = build_chat_suffix(data)
+
+    def events():
+        with tracing.span("stream /chat/stream", kind="sse"):
+            yield from chat_events()
+
+    def chat_events():
+        reply = ""
+        try:
+            for text in create_story.generate_lyrics_stream(suffix):
+                reply += text
+                yield sse("token", {"text": text})
+        except Exception as e:
+            print("chat stream error:", e)
+            yield sse("error", {"error": str(e)})
+            return
+        print(reply)
+        yield sse("done", {"reply": reply})
+
+    return sse_response(events())
+
+
+def attach_image_urls(scenes, image_paths):
+    """各シーンに原寸画像 (url) と縮小版 (preview_url) の署名付き URL を付ける"""
+    previews = gcs_utils.find_previews(BUCKET_NAME, image_paths)
+    urls = gcs_utils.generate_signed_urls(image_paths + list(previews.values()), 60)
+    for scene, image_path in zip(scenes, image_paths):
+        scene["url"] = urls[image_path]
+        if image_path in previews:
+            scene["preview_url"] = urls[previews[image_path]]
+
+
+def build_storyboard(job, project_folder, messages):
+    """ストーリー → キャラクター → 翻訳 → 絵コンテ生成までを行い、署名付きURL入りのシーンJSONを返す"""
     json_folder = project_folder + "json/"
     filename1 = f"story_script_akakura_ja.json"
     filename2 = f"character_akakura_ja.json"
@@ -118,33 +250,87 @@ def image():
     
     data = gcs_utils.read_json(BUCKET_NAME, user_input_ja_path)
     progression = data.get("progression")
-    if "登場人物型" == progression:
-        story_json = create_story.make_story(messages,story_ja_path)
-        create_story.meke_character(story_json,character_ja_path)
-        translate.translate_json(BUCKET_NAME, story_ja_path, story_en_path)
-        translate.translate_json(BUCKET_NAME, character_ja_path, character_en_path)
-        
-    elif "ナレーション型" == progression:
-        story_json = create_story.make_story_no_character(messages,story_ja_path)
-        translate.translate_json(BUCKET_NAME, story_ja_path, story_en_path)
-    
+    if "ナレーション型" == progression:
+        with job.stage("story"):
+            story_json = create_story.make_story_no_character(messages,story_ja_path)
+        job.skip("character")
+        with job.stage("translate"):
+            translate.translate_json(BUCKET_NAME, story_ja_path, story_en_path)
+
     else:
-        story_json = create_story.make_story(messages,story_ja_path)
-        create_story.meke_character(story_json,character_ja_path)
-        translate.translate_json(BUCKET_NAME, story_ja_path, story_en_path)
-        translate.translate_json(BUCKET_NAME, character_ja_path, character_en_path)
+        # "登場人物型" および未指定の場合
+        with job.stage("story"):
+            story_json = create_story.make_story(messages,story_ja_path)
+        with job.stage("character"):
+            create_story.meke_character(story_json,character_ja_path)
+        with job.stage("translate"):
+            translate.translate_json(BUCKET_NAME, story_ja_path, story_en_path)
+            translate.translate_json(BUCKET_NAME, character_ja_path, character_en_path)
+
+    # BGM は英語ストーリーだけで決まるので、絵コンテ生成と並行して先に作っておく
+    try:
+        generate_bgm.schedule_bgm(project_folder)
+    except Exception as e:
+        print("BGM の先行生成を開始できませんでした:", e)
 
     print("create_image start")
-    create_image.main(project_folder)
+    with job.stage("storyboard"):
+        create_image.main(project_folder)
     print("create_image end")
 
-    data = gcs_utils.read_json(BUCKET_NAME, project_folder + "json/scene_akakura_ja.json")
-    for scene in data["scenes"]:
-        scene_id = scene["scene_id"]
-        scene["url"] = gcs_utils.generate_signed_url(project_folder + "images/akakuraPR_" + str(scene_id) + ".png", 60)
+    with job.stage("signed_url"):
+        data = gcs_utils.read_json(BUCKET_NAME, project_folder + "json/scene_akakura_ja.json")
+        image_paths = [project_folder + "images/akakuraPR_" + str(scene["scene_id"]) + ".png" for scene in data["scenes"]]
+        attach_image_urls(data["scenes"], image_paths)
+    return data
+
+
+STORYBOARD_STAGES = ["story", "character", "translate", "storyboard", "signed_url"]
+
+
+@app.post("/chat-fin")
+def image():
+    
+    data = request.get_json(silent=True) or {}
+    
+    project_folder = data.get("project_folder", "")
+    messages = data.get("messages", [])
+    print("messages:", messages)
+
+    data = build_storyboard(jobs.NullJobContext(), project_folder, messages)
     return json.dumps(data, ensure_ascii=False, indent=2)
 
 
+@app.post("/chat-fin/jobs")
+def image_job():
+    """/chat-fin の非同期版。job_id をすぐに返し、進捗は /jobs/<job_id> で確認する"""
+    data = request.get_json(silent=True) or {}
+
+    project_folder = data.get("project_folder", "")
+    messages = data.get("messages", [])
+    print("messages:", messages)
+
+    try:
+        job_id = jobs.submit(
+            "chat-fin", STORYBOARD_STAGES, build_storyboard, project_folder, messages,
+            project_folder=project_folder, deadline=CHAT_FIN_DEADLINE_SECONDS,
+        )
+    except jobs.JobQueueFull as e:
+        return {"error": str(e)}, 503
+
+    return {"job_id": job_id, "status_url": f"/jobs/{job_id}"}, 202
+
+
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "ジョブが見つかりません"}, 404
+    return app.response_class(
+        json.dumps(job, ensure_ascii=False, indent=2), mimetype="application/json"
+    )
+
+
 @app.post("/edit")
 def edit():
     data = request.get_json(silent=True) or {}
@@ -176,9 +362,8 @@ def edit():
     image_files = gcs_utils.list_images_in_folder(BUCKET_NAME, project_folder +  "images/")
     data = gcs_utils.read_json(BUCKET_NAME, project_folder + f"json/scene_akakura_ja_v{revision_count}.json")
 
-    for scene in data["scenes"]:
-        scene_id = scene["scene_id"]
-        scene["url"] = gcs_utils.generate_signed_url(project_folder + "images/" + image_files[scene_id-1], 60)
+    image_paths = [project_folder + "images/" + image_files[scene["scene_id"]-1] for scene in data["scenes"]]
+    attach_image_urls(data["scenes"], image_paths)
     print(data)
     return json.dumps(data, ensure_ascii=False, indent=2)
 
@@ -0,0 +1 @@
+# オフラインのベンチマーク / 負荷試験用ツール (本番のアプリからは import しない)
@@ -0,0 +1,497 @@
+"""
+ベンチマーク用のフェイク実装。
+GCS / Gemini / Imagen / Veo / Lyria を clients のレジストリ経由で差し替え、ネットワーク無しでパイプラインを動かす。
+遅延はプロファイル (profiles/*.json) の分布から決め、応答は fixtures/ の記録を返す。
+"""
+import array
+import ast
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from io import BytesIO
+from urllib.parse import quote
+from types import SimpleNamespace
+import imageio_ffmpeg
+from PIL import Image
+import clients
+import operation_poller
+import storage_backends
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+PROFILES_DIR = os.path.join(BENCH_DIR, "profiles")
+
+# 生成物のサイズを本番に近づける (Imagen の 9:16 は 768x1408 前後)
+IMAGE_SIZES = {"9:16": (768, 1344), "16:9": (1344, 768), "1:1": (1024, 1024)}
+VIDEO_SIZES = {"9:16": (720, 1280), "16:9": (1280, 720)}
+BGM_SECONDS = 30
+BGM_SAMPLE_RATE = 48000
+
+
+class FakeServiceError(RuntimeError):
+    """フェイクが注入する失敗。メトリクスでクォータ超過として数えられるよう 429 を含める"""
+
+
+# ===== プロファイル =====
+def load_profile(name):
+    """profiles/ の名前かファイルパスからプロファイルを読む ("extends" で別のプロファイルを上書きできる)"""
+    path = name
+    if not os.path.exists(path):
+        path = os.path.join(PROFILES_DIR, name if name.endswith(".json") else name + ".json")
+    with open(path, encoding="utf-8") as f:
+        profile = json.load(f)
+
+    base = profile.pop("extends", None)
+    if not base:
+        return profile
+    merged = load_profile(os.path.join(os.path.dirname(path), base))
+    for key, value in profile.items():
+        if isinstance(value, dict):
+            merged.setdefault(key, {}).update(value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class Latency:
+    """サービスごとの遅延 (median と p95 から決める対数正規分布) と失敗率"""
+
+    def __init__(self, profile):
+        self.scale = profile.get("time_scale", 1.0)
+        self.latency = profile.get("latency", {})
+        self.failure_rate = profile.get("failure_rate", {})
+        self._random = random.Random(profile.get("seed"))
+        self._lock = threading.Lock()
+
+    def sample(self, service):
+        spec = self.latency.get(service)
+        if not spec:
+            return 0.0
+        median = spec["median"]
+        p95 = spec.get("p95", median)
+        sigma = math.log(p95 / median) / 1.645 if p95 > median else 0.0
+        with self._lock:
+            z = self._random.gauss(0, 1)
+        return median * math.exp(sigma * z) * self.scale
+
+    def fails(self, service):
+        rate = self.failure_rate.get(service, 0.0)
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def call(self, service):
+        """service の遅延だけ待ち、失敗率に当たれば例外を出す"""
+        time.sleep(self.sample(service))
+        if self.fails(service):
+            raise FakeServiceError(f"429 RESOURCE_EXHAUSTED (fake {service})")
+
+
+# ===== 記録済みの応答 =====
+class Fixtures:
+    """fixtures/ の JSON と、実行時に 1 度だけ作る画像・動画・音声"""
+
+    def __init__(self, directory=FIXTURES_DIR):
+        def load(name):
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                return json.load(f)
+
+        self.user_input = load("user_input.json")
+        self.story = load("story.json")
+        self.character = load("character.json")
+        self.scenes = load("scenes.json")
+        self.text = load("text.json")
+
+        self._lock = threading.Lock()
+        self._images = {}
+        self._clips = {}
+        self._bgm = None
+        self._media_dir = tempfile.mkdtemp(prefix="locaiver-bench-")
+
+    def image(self, aspect_ratio):
+        """ノイズ画像の PNG (圧縮が効かないので実際の生成画像に近いサイズになる)"""
+        size = IMAGE_SIZES.get(aspect_ratio or "1:1", IMAGE_SIZES["1:1"])
+        with self._lock:
+            if size not in self._images:
+                bands = [Image.effect_noise(size, 48) for _ in range(3)]
+                buffer = BytesIO()
+                Image.merge("RGB", bands).save(buffer, format="PNG")
+                self._images[size] = buffer.getvalue()
+            return self._images[size]
+
+    def clip(self, aspect_ratio, duration_seconds):
+        """ffmpeg のテストパターンから作った mp4 (結合や BGM 追加は本物の ffmpeg で行うため)"""
+        size = VIDEO_SIZES.get(aspect_ratio, VIDEO_SIZES["9:16"])
+        key = (size, duration_seconds or 4)
+        with self._lock:
+            if key not in self._clips:
+                path = os.path.join(self._media_dir, f"clip_{size[0]}x{size[1]}_{key[1]}.mp4")
+                self._encode_clip(path, size, key[1])
+                with open(path, "rb") as f:
+                    self._clips[key] = f.read()
+            return self._clips[key]
+
+    def _encode_clip(self, path, size, seconds):
+        base = [
+            imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc=size={size[0]}x{size[1]}:rate=24",
+            "-t", str(seconds), "-pix_fmt", "yuv420p",
+        ]
+        try:
+            subprocess.run(base + ["-c:v", "libx264", "-preset", "ultrafast", path], check=True)
+        except subprocess.CalledProcessError:
+            # libx264 の無いビルド向け
+            subprocess.run(base + ["-c:v", "mpeg4", path], check=True)
+
+    def bgm(self):
+        """Lyria の出力と同じ 48kHz ステレオ 16bit の WAV"""
+        with self._lock:
+            if self._bgm is None:
+                second = array.array("h", (
+                    int(8000 * math.sin(2 * math.pi * 440 * n / BGM_SAMPLE_RATE))
+                    for n in range(BGM_SAMPLE_RATE) for _ in range(2)
+                )).tobytes()
+                buffer = BytesIO()
+                with wave.open(buffer, "wb") as w:
+                    w.setnchannels(2)
+                    w.setsampwidth(2)
+                    w.setframerate(BGM_SAMPLE_RATE)
+                    w.writeframes(second * BGM_SECONDS)
+                self._bgm = buffer.getvalue()
+            return self._bgm
+
+
+# ===== Cloud Storage =====
+class FakeGCSBackend(storage_backends.MemoryBackend):
+    """
+    storage_backends.GCSBackend の代わり。保存は MemoryBackend のまま、操作ごとに GCS の遅延と失敗を入れる。
+    upload_file / download_file / list_prefixes は write / read / list を経由するので、そちらで数える。
+    """
+
+    name = "gcs"
+
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+
+    def stat(self, bucket_name, path):
+        self.latency.call("gcs_metadata")
+        return super().stat(bucket_name, path)
+
+    def read(self, bucket_name, path, generation=None):
+        self.latency.call("gcs_read")
+        return super().read(bucket_name, path, generation)
+
+    def write(self, bucket_name, path, data, content_type=None, if_generation_match=None):
+        self.latency.call("gcs_write")
+        return super().write(bucket_name, path, data, content_type, if_generation_match)
+
+    def copy(self, bucket_name, source_path, target_path):
+        # サーバー側のコピーなので書き込みの遅延は入れない
+        self.latency.call("gcs_copy")
+        return super().write(bucket_name, target_path, self._get(bucket_name, source_path)[1])
+
+    def delete(self, bucket_name, path):
+        self.latency.call("gcs_delete")
+        super().delete(bucket_name, path)
+
+    def list(self, bucket_name, prefix):
+        self.latency.call("gcs_list")
+        return super().list(bucket_name, prefix)
+
+    def signed_url(self, bucket_name, path, lifetime):
+        # 本物もローカル署名なのでネットワークの遅延は入れない
+        return f"https://storage.fake/{bucket_name}/{quote(path)}?X-Goog-Signature={uuid.uuid4().hex}"
+
+
+# ===== Gemini (テキスト) =====
+def _call_kind(role, prompt, generation_config):
+    """
+    呼び出しの種類 (chat, story, translate 等) を呼び出し自体から判定する。
+    用途専用のモデル (role) → 構造化出力のスキーマ → プロンプトの内容 の順に見る (翻訳だけはプロンプトを先に見る)。
+    """
+    if role is not None:
+        return role
+    # 翻訳のスキーマは入力 JSON から作られるので、スキーマではなくプロンプトで見分ける
+    if "json本体:" in prompt:
+        return "translate"
+    schema = generation_config.get("response_schema")
+    if schema is not None:
+        import create_story
+        import scene
+
+        if schema is create_story.STORY_SCHEMA:
+            return "story"
+        if schema is create_story.CHARACTER_SCHEMA:
+            return "character"
+        if schema is scene.SCENES_SCHEMA:
+            return "scene"
+        return "json"
+    if "music generation" in prompt:
+        return "bgm_prompt"
+    return "chat"
+
+
+def _prompt_text(contents):
+    if isinstance(contents, str):
+        return contents
+    return "\n".join(c for c in contents if isinstance(c, str))
+
+
+def _data_block(prompt, marker):
+    """プロンプト中の marker の後の --- で囲まれた部分 (Python の repr で埋め込まれている) を読む"""
+    start = prompt.find(marker)
+    if start < 0:
+        return None
+    match = re.search(r"---\s*\n(.*?)\n\s*---", prompt[start:], re.DOTALL)
+    if match is None:
+        return None
+    try:
+        return ast.literal_eval(match.group(1).strip())
+    except (ValueError, SyntaxError):
+        return None
+
+
+def _translated(value):
+    if isinstance(value, str):
+        return f"[en] {value}"
+    if isinstance(value, list):
+        return [_translated(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _translated(v) for k, v in value.items()}
+    return value
+
+
+def _example_from_schema(schema, index=0):
+    """スキーマに合う値を作る (フィクスチャの無い呼び出し用)"""
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: _example_from_schema(prop) for key, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_example_from_schema(schema["items"], i) for i in range(4)]
+    if kind == "integer":
+        return index + 1
+    if kind == "number":
+        return float(index)
+    if kind == "boolean":
+        return False
+    return "sample"
+
+
+class FakeGenerativeModel:
+    """
+    google.generativeai / vertexai の GenerativeModel の代わり。
+    role は登録キーだけで用途が決まるモデル (修復用・安全化用・インタビュアー) の呼び出し種別。
+    """
+
+    def __init__(self, services, model_name, role=None):
+        self.services = services
+        self.model_name = model_name
+        self.role = role
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        prompt = _prompt_text(contents)
+        kind = _call_kind(self.role, prompt, generation_config or {})
+        text = self.services.respond(kind, prompt, generation_config or {})
+        if stream:
+            return self._stream(kind, text)
+        self.services.latency.call(kind)
+        return SimpleNamespace(text=text)
+
+    def _stream(self, kind, text):
+        latency = self.services.latency
+        total = latency.sample(kind)
+        pieces = [text[i:i + 20] for i in range(0, len(text), 20)] or [""]
+        # 最初のトークンまでに全体の 3 割かかる想定
+        time.sleep(total * 0.3)
+        if latency.fails(kind):
+            raise FakeServiceError(f"429 RESOURCE_EXHAUSTED (fake {kind})")
+        for piece in pieces:
+            time.sleep(total * 0.7 / len(pieces))
+            yield SimpleNamespace(text=piece)
+
+
+# ===== google.genai (Gemini 画像 / Veo) =====
+class FakeOperation:
+    def __init__(self, ready_at, output_gcs_uri, aspect_ratio, duration_seconds, failed):
+        self.name = f"operations/{uuid.uuid4().hex}"
+        self.ready_at = ready_at
+        self.output_gcs_uri = output_gcs_uri
+        self.aspect_ratio = aspect_ratio
+        self.duration_seconds = duration_seconds
+        self.failed = failed
+        self.done = False
+        self.error = None
+        self.result = None
+        self.response = None
+
+
+class _FakeModels:
+    def __init__(self, services):
+        self.services = services
+
+    def generate_content(self, model, contents, **kwargs):
+        self.services.latency.call("gemini_image")
+        part = SimpleNamespace(
+            text=None,
+            inline_data=SimpleNamespace(mime_type="image/png", data=self.services.fixtures.image("1:1")),
+        )
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    def generate_videos(self, model, prompt, config=None, image=None, **kwargs):
+        latency = self.services.latency
+        latency.call("veo")
+        return FakeOperation(
+            ready_at=time.monotonic() + latency.sample("veo_render"),
+            output_gcs_uri=config.output_gcs_uri,
+            aspect_ratio=config.aspect_ratio,
+            duration_seconds=config.duration_seconds,
+            failed=latency.fails("veo_render"),
+        )
+
+
+class _FakeOperations:
+    def __init__(self, services):
+        self.services = services
+
+    def get(self, operation):
+        self.services.latency.call("veo_poll")
+        if operation.done or time.monotonic() < operation.ready_at:
+            return operation
+
+        operation.done = True
+        if operation.failed:
+            operation.error = {"code": 3, "message": "fake: the prompt was rejected by the safety filter"}
+            return operation
+
+        # Veo と同じく output_gcs_uri の下にランダムな名前で書き出す
+        bucket_name, prefix = operation.output_gcs_uri[5:].split("/", 1)
+        path = f"{prefix.rstrip('/')}/{uuid.uuid4().hex[:12]}/sample_0.mp4"
+        data = self.services.fixtures.clip(operation.aspect_ratio, operation.duration_seconds)
+        # STORAGE_BACKEND=local / memory でも動くように、アプリと同じ保存先に書く
+        clients.storage_backend().write(bucket_name, path, data, content_type="video/mp4")
+        video = SimpleNamespace(video=SimpleNamespace(uri=f"gs://{bucket_name}/{path}"))
+        operation.result = SimpleNamespace(generated_videos=[video])
+        return operation
+
+
+class FakeGenaiClient:
+    """google.genai.Client の代わり"""
+
+    def __init__(self, services):
+        self.models = _FakeModels(services)
+        self.operations = _FakeOperations(services)
+
+
+# ===== Imagen =====
+class FakeImagenModel:
+    def __init__(self, services):
+        self.services = services
+
+    def generate_images(self, prompt, negative_prompt=None, number_of_images=1, aspect_ratio=None, **kwargs):
+        self.services.latency.call("imagen")
+        image_bytes = self.services.fixtures.image(aspect_ratio)
+        return [SimpleNamespace(_image_bytes=image_bytes) for _ in range(number_of_images)]
+
+
+# ===== Lyria =====
+class FakeLyriaClient:
+    """generate_bgm.LyriaClient の代わり"""
+
+    def __init__(self, services):
+        self.services = services
+
+    def access_token(self):
+        return "fake-token"
+
+    def generate(self, prompt, negative_prompt, output_path):
+        latency = self.services.latency
+        time.sleep(latency.sample("lyria"))
+        if latency.fails("lyria"):
+            print("エラー: fake lyria failure")
+            return False
+        with open(output_path, "wb") as f:
+            f.write(self.services.fixtures.bgm())
+        return True
+
+
+# ===== まとめて差し替える =====
+class FakeServices:
+    """フェイク一式。install() で clients のレジストリに登録する"""
+
+    def __init__(self, profile="default", fixtures_dir=FIXTURES_DIR):
+        self.profile = load_profile(profile) if isinstance(profile, str) else profile
+        self.latency = Latency(self.profile)
+        self.fixtures = Fixtures(fixtures_dir)
+        self.storage = FakeGCSBackend(self.latency)
+
+    def respond(self, kind, prompt, generation_config):
+        """呼び出し種別ごとに記録済みの応答を返す"""
+        fixtures = self.fixtures
+        if kind == "story":
+            return json.dumps(fixtures.story, ensure_ascii=False)
+        if kind == "character":
+            return json.dumps(fixtures.character, ensure_ascii=False)
+        if kind == "scene":
+            current = _data_block(prompt, "入力JSON:")
+            if isinstance(current, dict):
+                # 修正依頼: 対象シーンの描写に修正内容を書き足して全体を返す
+                for scene_id, revision in re.findall(r"- scene_id (\d+): (.*)", prompt):
+                    for scene in current.get("scenes", []):
+                        if scene.get("scene_id") == int(scene_id):
+                            scene["depiction"] = f"{scene['depiction']} ({revision.strip()})"
+                return json.dumps(current, ensure_ascii=False)
+            return json.dumps(fixtures.scenes, ensure_ascii=False)
+        if kind == "translate":
+            data = _data_block(prompt, "json本体:")
+            if data is not None:
+                return json.dumps(_translated(data), ensure_ascii=False)
+        if kind in fixtures.text and isinstance(fixtures.text[kind], str):
+            return fixtures.text[kind]
+
+        schema = generation_config.get("response_schema")
+        if schema is not None:
+            return json.dumps(_example_from_schema(schema), ensure_ascii=False)
+        return fixtures.text["chat"]
+
+    def install(self):
+        import generate_character
+        import llm_json
+
+        clients.reset()
+        # STORAGE_BACKEND=gcs の時だけフェイクの GCS を使う (local / memory はそのまま)
+        clients.register("storage.backend", storage_backends.create(remote=self.storage))
+        clients.register("genai.model:gemini-2.5-pro", FakeGenerativeModel(self, "gemini-2.5-pro"))
+        clients.register(
+            f"genai.model:{llm_json.REPAIR_MODEL}", FakeGenerativeModel(self, llm_json.REPAIR_MODEL, role="repair")
+        )
+        # キーは clients.vertex_model / imagen_model / vertex_genai_client と同じ形式
+        # (key 無しは veo_utils のプロンプト安全化、interviewer は create_story の対話で使う)
+        for key, role in (("", "sanitize"), ("interviewer", "chat")):
+            clients.register(
+                f"vertex.model:us-central1:gemini-2.5-pro:{key}", FakeGenerativeModel(self, "gemini-2.5-pro", role=role)
+            )
+        clients.register(
+            f"vertex.imagen:{clients.GOOGLE_CLOUD_REGION}:{generate_character.IMAGEN_MODEL}", FakeImagenModel(self)
+        )
+        clients.register("genai.client", FakeGenaiClient(self))
+        clients.register("genai.vertex_client:us-central1", FakeGenaiClient(self))
+        clients.register("lyria", FakeLyriaClient(self))
+
+        # Veo のポーリング間隔も遅延と同じ倍率で縮める
+        scale = self.latency.scale
+        render = self.profile.get("latency", {}).get("veo_render", {}).get("median", 60)
+        operation_poller.EXPECTED_RENDER_SECONDS = {d: render * scale for d in (4, 6, 8)}
+        operation_poller.MIN_POLL_INTERVAL = max(0.01, 2 * scale)
+        operation_poller.MAX_POLL_INTERVAL = max(0.05, 15 * scale)
+        return self
@@ -0,0 +1,295 @@
+"""
+同時ユーザー数を段階的に増やす負荷試験 (1 インスタンスで何人まで捌けるかの見積もり用)。
+各仮想ユーザーは /form → /chat を数回 → /chat-fin → /edit → /video num=0〜4 を繰り返す。
+バックエンドは bench/fakes.py のフェイクで、遅延はプロファイルの time_scale 倍になる。
+
+    cd locaiver-back
+    # アプリを同じプロセス内で起動する (app.py の __main__ と同じ threaded な開発サーバー)
+    python -m bench.loadtest --users 1,2,4,8 --step-seconds 60
+
+    # 別に起動したサーバー (bench/serve.py) に対して実行する。--pid でそのプロセスのスレッド数と RSS を測る
+    python -m bench.loadtest --url http://localhost:8080 --pid 12345 --users 4,8,16
+
+段階ごとにスループット、エンドポイント別の p50/p95/p99、エラー率、スレッド数と RSS のピークを表示する。
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+
+
+class _Response:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self._text = text
+
+    def get_data(self, as_text=False):
+        return self._text if as_text else self._text.encode("utf-8")
+
+
+class HttpClient:
+    """run_session から使う HTTP クライアント (Flask のテストクライアントと同じ post() を持つ)"""
+
+    def __init__(self, base_url, think_time=0.0, timeout=3600):
+        import requests
+
+        self.base_url = base_url.rstrip("/")
+        self.think_time = think_time
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def post(self, endpoint, json=None):
+        if self.think_time:
+            time.sleep(self.think_time)
+        try:
+            response = self.session.post(self.base_url + endpoint, json=json, timeout=self.timeout)
+        except Exception as e:
+            # 接続できない・タイムアウトもエラーとして数える
+            return _Response(599, f"{type(e).__name__}: {e}")
+        return _Response(response.status_code, response.text)
+
+
+# ===== スレッド数とメモリの計測 =====
+def _proc_status(pid):
+    """/proc/<pid>/status から (スレッド数, RSS バイト) を読む (Linux 以外では None)"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None, None
+    threads = int(fields["Threads"].strip()) if "Threads" in fields else None
+    rss = int(fields["VmRSS"].split()[0]) * 1024 if "VmRSS" in fields else None
+    return threads, rss
+
+
+class ResourceSampler:
+    """
+    一定間隔でサーバーのスレッド数と RSS を記録する。
+    pid が None ならこのプロセスを測り、負荷をかける側のスレッド (vu-*, loadtest-*) は数えない。
+    """
+
+    def __init__(self, pid=None, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self._samples = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="loadtest-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _sample(self):
+        if self.pid is not None:
+            return _proc_status(self.pid)
+        threads = sum(1 for t in threading.enumerate() if not t.name.startswith(("vu-", "loadtest-sampler")))
+        _, rss = _proc_status(os.getpid())
+        return threads, rss
+
+    def _loop(self):
+        while not self._stop.is_set():
+            threads, rss = self._sample()
+            with self._lock:
+                self._samples.append((time.monotonic(), threads, rss))
+            self._stop.wait(self.interval)
+
+    def peak(self, since):
+        with self._lock:
+            samples = [s for s in self._samples if s[0] >= since]
+        threads = [s[1] for s in samples if s[1] is not None]
+        rss = [s[2] for s in samples if s[2] is not None]
+        return {
+            "max_threads": max(threads, default=None),
+            "max_rss_mib": max(rss) / 1024 / 1024 if rss else None,
+            "last_rss_mib": rss[-1] / 1024 / 1024 if rss else None,
+        }
+
+
+# ===== 段階ごとの集計 =====
+class StepStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.errors = {}
+        self.sessions = 0
+        self.failed_sessions = 0
+        self.session_errors = []
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.durations.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def session_done(self, error=None):
+        with self._lock:
+            self.sessions += 1
+            if error is not None:
+                self.failed_sessions += 1
+                if len(self.session_errors) < 5:
+                    self.session_errors.append(str(error))
+
+
+def start_local_server(profile, env):
+    """フェイクを組み込んだアプリをこのプロセスのスレッドで起動し、(URL, services) を返す"""
+    from bench.pipeline import prepare_environment
+
+    prepare_environment(env)
+    from bench import fakes
+
+    services = fakes.FakeServices(profile).install()
+    import app
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="loadtest-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", services
+
+
+def virtual_user(base_url, fixtures, stats, stop_at, args):
+    from bench.pipeline import run_session
+
+    client = HttpClient(base_url, think_time=args.think_time)
+    while time.monotonic() < stop_at:
+        try:
+            run_session(client, fixtures, "each", chat_turns=args.chat_turns, record=stats.record)
+        except Exception as e:
+            stats.session_done(e)
+        else:
+            stats.session_done()
+
+
+def run_step(users, base_url, fixtures, sampler, args):
+    stats = StepStats()
+    started = time.monotonic()
+    stop_at = started + args.step_seconds
+    threads = []
+    for i in range(users):
+        thread = threading.Thread(
+            target=virtual_user, name=f"vu-{users}-{i}", args=(base_url, fixtures, stats, stop_at, args), daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+        time.sleep(args.spawn_interval)
+    # 時間切れの後は新しいセッションを始めず、実行中のセッションの終了を待つ
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    from bench import report
+
+    requests = sum(len(d) for d in stats.durations.values())
+    errors = sum(stats.errors.values())
+    endpoints = {}
+    for endpoint, durations in sorted(stats.durations.items()):
+        endpoints[endpoint] = report.summarize(durations)
+        endpoints[endpoint]["errors"] = stats.errors.get(endpoint, 0)
+    return {
+        "users": users,
+        "seconds": elapsed,
+        "sessions": stats.sessions,
+        "failed_sessions": stats.failed_sessions,
+        "session_errors": stats.session_errors,
+        "requests": requests,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "sessions_per_minute": (stats.sessions - stats.failed_sessions) * 60 / elapsed if elapsed else 0.0,
+        "error_rate": errors / requests if requests else 0.0,
+        "endpoints": endpoints,
+        **sampler.peak(started),
+    }
+
+
+def format_step(result):
+    from bench import report
+
+    lines = [
+        f"### users={result['users']}  {result['seconds']:.1f}s  "
+        f"sessions={result['sessions']} (failed {result['failed_sessions']})  "
+        f"throughput={result['throughput_rps']:.2f} req/s, {result['sessions_per_minute']:.2f} sessions/min  "
+        f"error_rate={result['error_rate'] * 100:.1f}%",
+        f"    threads(max)={result['max_threads']}  rss(max)={_mib(result['max_rss_mib'])}  rss(end)={_mib(result['last_rss_mib'])}",
+    ]
+    for error in result["session_errors"]:
+        lines.append(f"    error: {error}")
+    lines.append(report.format_table("latency", result["endpoints"]))
+    return "\n".join(lines)
+
+
+def _mib(value):
+    return f"{value:.1f}MiB" if value is not None else "n/a"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="同時ユーザー数を増やしながらの負荷試験")
+    parser.add_argument("--users", default="1,2,4,8", help="段階ごとの同時ユーザー数 (カンマ区切り)")
+    parser.add_argument("--step-seconds", type=float, default=60, help="各段階で新しいセッションを始める時間")
+    parser.add_argument("--spawn-interval", type=float, default=0.5, help="仮想ユーザーを起動する間隔 (秒)")
+    parser.add_argument("--chat-turns", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=0.0, help="リクエスト間の待ち時間 (秒)")
+    parser.add_argument("--url", help="対象サーバー。省略するとこのプロセス内でフェイク付きのアプリを起動する")
+    parser.add_argument("--pid", type=int, help="--url のサーバーのプロセス ID (スレッド数と RSS の計測用)")
+    parser.add_argument("--profile", default="default", help="bench/profiles の名前か JSON ファイルのパス")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="アプリの設定を上書きする")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    parser.add_argument("--verbose", action="store_true", help="アプリのログを表示する")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    if not args.verbose:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    with contextlib.ExitStack() as quiet:
+        if not args.verbose:
+            quiet.enter_context(contextlib.redirect_stdout(quiet.enter_context(open(os.devnull, "w"))))
+        if args.url:
+            from bench import fakes
+
+            base_url = args.url
+            fixtures = fakes.Fixtures()
+            # --pid が無ければサーバー側の計測はしない
+            sampler = ResourceSampler(pid=args.pid)
+            if args.pid:
+                sampler.start()
+        else:
+            base_url, services = start_local_server(args.profile, args.env)
+            fixtures = services.fixtures
+            sampler = ResourceSampler().start()
+
+        results = []
+        for users in (int(u) for u in args.users.split(",") if u.strip()):
+            result = run_step(users, base_url, fixtures, sampler, args)
+            results.append(result)
+            print(format_step(result) + "\n", file=out, flush=True)
+
+        sampler.stop()
+
+    print("== summary ==", file=out)
+    print(f"{'users':>6}{'req/s':>10}{'sess/min':>10}{'err%':>8}{'p95 max':>10}{'threads':>9}{'rss MiB':>10}", file=out)
+    for result in results:
+        p95 = max((s.get("p95") or 0 for s in result["endpoints"].values()), default=0)
+        rss = result["max_rss_mib"]
+        print(
+            f"{result['users']:>6}{result['throughput_rps']:>10.2f}{result['sessions_per_minute']:>10.2f}"
+            f"{result['error_rate'] * 100:>8.1f}{p95:>9.2f}s{str(result['max_threads']):>9}"
+            f"{(f'{rss:.1f}' if rss is not None else 'n/a'):>10}",
+            file=out,
+        )
+
+    if args.json:
+        from bench import report
+
+        report.write_json(args.json, {"args": vars(args), "steps": results})
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
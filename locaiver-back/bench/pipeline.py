@@ -0,0 +1,169 @@
+"""
+オフラインのパイプラインベンチマーク。
+リモートサービスをすべて bench/fakes.py のフェイクに置き換え、/form → /chat-fin → /edit → /video を
+Flask のテストクライアントで実行して、エンドポイント・ステージ・モデル呼び出し・GCS・ffmpeg ごとの所要時間を表示する。
+
+    cd locaiver-back
+    python -m bench.pipeline --profile default --iterations 3
+    python -m bench.pipeline --env IMAGE_CACHE_ENABLED=0 --env SCENE_IMAGE_CONCURRENCY=1 --json before.json
+    python -m bench.pipeline --env STORAGE_BACKEND=local --env STORAGE_LOCAL_DIR=/tmp/bench-storage
+
+遅延はプロファイルの time_scale 倍になる (1.0 で本番相当)。リトライのバックオフの sleep は縮めない。
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+
+# モジュールの import 時に読まれる環境変数。フェイクでは意味を持たないか、ベンチマークを歪めるもの
+DEFAULT_ENV = {
+    "BUCKET_NAME": "bench-bucket",
+    "URL": "https://lyria.fake/predict",
+    "TRACE_EXPORTER": "none",
+    "JOB_STORE": "memory",
+}
+
+
+def prepare_environment(overrides=()):
+    """アプリのモジュールを import する前に呼ぶ"""
+    for key, value in DEFAULT_ENV.items():
+        os.environ.setdefault(key, value)
+    for item in overrides:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+    # 完成処理を別プロセスで行うとフェイクが引き継がれないので、常に同じプロセスで行う
+    os.environ["FINALIZE_PROCESSES"] = "0"
+
+
+class SessionError(RuntimeError):
+    def __init__(self, endpoint, status, body):
+        super().__init__(f"{endpoint} -> {status}: {body[:200]}")
+        self.endpoint = endpoint
+
+
+def _post(client, endpoint, payload, record):
+    started = time.perf_counter()
+    response = client.post(endpoint, json=payload)
+    elapsed = time.perf_counter() - started
+    ok = response.status_code < 400
+    if record is not None:
+        # /video は num ごとに処理が全く違うので分けて集計する
+        label = f"{endpoint} num={payload['num']}" if endpoint == "/video" else endpoint
+        record(label, elapsed, ok)
+    if not ok:
+        raise SessionError(endpoint, response.status_code, response.get_data(as_text=True))
+    return response
+
+
+def run_session(client, fixtures, video_mode="all", chat_turns=0, record=None):
+    """
+    1 ユーザー分の操作を順に行う。record(endpoint, seconds, ok) があれば各リクエストごとに呼ぶ。
+    video_mode: "all" なら /video num=5、"each" なら num=0〜3 のあと num=4
+    """
+    response = _post(client, "/form", fixtures.user_input, record)
+    project_folder = json.loads(response.get_data(as_text=True))["project_folder"]
+
+    messages = list(fixtures.text["messages"])
+    for turn in range(chat_turns):
+        history = messages[: 2 * turn + 1]
+        _post(client, "/chat", {"messages": history, "message": history[-1]["text"]}, record)
+
+    response = _post(client, "/chat-fin", {"project_folder": project_folder, "messages": messages}, record)
+    # /chat-fin は JSON 文字列を text/html で返すので、本文をそのままパースする
+    scenes = json.loads(response.get_data(as_text=True))["scenes"]
+
+    edits = fixtures.text["edit"]
+    _post(client, "/edit", {
+        "project_folder": project_folder,
+        "counter": "1",
+        "scenes": [
+            {"scene_id": scene["scene_id"], "fix": "Y" if edits[i] else "N", "input_fix": edits[i]}
+            for i, scene in enumerate(scenes)
+        ],
+    }, record)
+
+    if video_mode == "all":
+        _post(client, "/video", {"project_folder": project_folder, "num": 5}, record)
+    else:
+        for num in range(4):
+            _post(client, "/video", {"project_folder": project_folder, "num": num}, record)
+        _post(client, "/video", {"project_folder": project_folder, "num": 4}, record)
+    return project_folder
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="オフラインのパイプラインベンチマーク")
+    parser.add_argument("--profile", default="default", help="bench/profiles の名前か JSON ファイルのパス")
+    parser.add_argument("--iterations", type=int, default=1)
+    parser.add_argument("--video", choices=["all", "each"], default="all")
+    parser.add_argument("--fresh-storage", action="store_true", help="反復ごとにフェイクの GCS を空にする (キャッシュ無しの計測)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="アプリの設定を上書きする")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    parser.add_argument("--verbose", action="store_true", help="アプリのログを表示する")
+    args = parser.parse_args(argv)
+
+    prepare_environment(args.env)
+
+    import tracing
+    from bench import fakes, report
+
+    services = fakes.FakeServices(args.profile).install()
+    import app
+
+    collector = report.SpanCollector()
+    tracing.add_exporter(collector)
+    client = app.app.test_client()
+
+    iterations = []
+    with contextlib.ExitStack() as stack:
+        output = sys.stdout if args.verbose else stack.enter_context(open(os.devnull, "w"))
+        for n in range(args.iterations):
+            if args.fresh_storage and n > 0:
+                services = fakes.FakeServices(args.profile).install()
+            requests = {}
+            started = time.perf_counter()
+            error = None
+            with contextlib.redirect_stdout(output):
+                try:
+                    run_session(client, services.fixtures, args.video,
+                                record=lambda endpoint, seconds, ok: requests.setdefault(endpoint, []).append(seconds))
+                except Exception as e:
+                    error = str(e)
+            elapsed = time.perf_counter() - started
+            iterations.append({"seconds": elapsed, "requests": requests, "error": error})
+            status = f"error: {error}" if error else "ok"
+            print(f"iteration {n + 1}: {elapsed:.3f}s ({status})", flush=True)
+
+    summary = collector.summary()
+    end_to_end = report.summarize([it["seconds"] for it in iterations if not it["error"]])
+    print()
+    print(report.format_table("end to end", {"session": end_to_end}))
+    for group in ("endpoint", "stage", "model", "gcs", "ffmpeg"):
+        if group in summary:
+            print()
+            print(report.format_table(group, summary[group]))
+    print()
+    import clients
+
+    backend = clients.storage_backend()
+    if backend.name.startswith("gcs"):
+        print(f"fake storage: {services.storage.total_bytes() / 1024 / 1024:.1f} MiB")
+    elif hasattr(backend, "total_bytes"):
+        print(f"{backend.name} storage: {backend.total_bytes() / 1024 / 1024:.1f} MiB")
+
+    if args.json:
+        report.write_json(args.json, {
+            "profile": services.profile,
+            "env": args.env,
+            "iterations": iterations,
+            "end_to_end": end_to_end,
+            "spans": summary,
+        })
+    return 1 if any(it["error"] for it in iterations) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""ベンチマーク結果の集計と表示"""
+import json
+import math
+import threading
+
+
+def percentile(values, q):
+    """線形補間のパーセンタイル (q は 0〜100)"""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def span_group(span):
+    """スパンを (グループ, 名前) に分類する。集計しないスパンは None"""
+    name = span.name
+    kind = span.attributes.get("kind")
+    if kind == "http":
+        return "endpoint", name
+    if name.startswith("stage."):
+        return "stage", name[6:]
+    if name.startswith("model.") or name == "veo.render":
+        return "model", kind or name
+    if name.startswith("gcs."):
+        return "gcs", name[4:]
+    if name == "ffmpeg":
+        return "ffmpeg", span.attributes.get("op", "")
+    return None
+
+
+class SpanCollector:
+    """tracing のエクスポーターとして登録し、終了したスパンの所要時間を集める"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._errors = {}
+
+    def export(self, span):
+        group = span_group(span)
+        if group is None:
+            return
+        with self._lock:
+            self._durations.setdefault(group, []).append(span.duration)
+            if span.status == "error":
+                self._errors[group] = self._errors.get(group, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+            self._errors.clear()
+
+    def summary(self):
+        """{グループ: {名前: 統計}}"""
+        with self._lock:
+            result = {}
+            for (group, name), durations in sorted(self._durations.items()):
+                stats = summarize(durations)
+                stats["errors"] = self._errors.get((group, name), 0)
+                result.setdefault(group, {})[name] = stats
+            return result
+
+
+def format_table(title, rows, unit="s"):
+    """{名前: 統計} を表にした文字列"""
+    lines = [f"== {title} ==", f"{'name':<28}{'count':>7}{'err':>5}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"]
+    for name, stats in rows.items():
+        if not stats.get("count"):
+            lines.append(f"{name:<28}{0:>7}")
+            continue
+        values = "".join(f"{stats[key]:>9.3f}{unit}" for key in ("mean", "p50", "p95", "p99", "max"))
+        lines.append(f"{name:<28}{stats['count']:>7}{stats.get('errors', 0):>5}{values}")
+    return "\n".join(lines)
+
+
+def write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
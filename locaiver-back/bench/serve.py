@@ -0,0 +1,29 @@
+"""
+フェイクを組み込んだアプリ。負荷試験の対象を本番と同じサーバー構成で起動する時に使う。
+
+    cd locaiver-back
+    BENCH_PROFILE=default gunicorn -w 1 --threads 16 -b :8080 bench.serve:app
+    python -m bench.serve --port 8080
+
+フェイクの GCS はプロセス内のメモリにあるので、ワーカーは 1 つにする (-w 2 だとプロジェクトが共有されない)。
+"""
+import os
+from bench.pipeline import prepare_environment
+
+prepare_environment(item for item in os.getenv("BENCH_ENV", "").split(",") if item)
+
+from bench import fakes  # noqa: E402
+
+services = fakes.FakeServices(os.getenv("BENCH_PROFILE", "default")).install()
+
+from app import app  # noqa: E402
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="フェイクを組み込んだアプリを起動する")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    # app.py の __main__ と同じ開発サーバー (threaded=True)
+    app.run(host="0.0.0.0", port=args.port, threaded=True, use_reloader=False)
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
+GOOGLE_CLOUD_REGION = os.getenv("GOOGLE_CLOUD_REGION")
+
+# SDK のクライアント/モデルをプロセス内で 1 度だけ生成して使い回すレジストリ。
+# vertexai.init / genai.configure はグローバル設定を書き換えるので、
+# 生成はすべて _lock の中で行い、threaded=True でも設定が混ざらないようにする。
+_lock = threading.RLock()
+_instances = {}
+
+
+def get(name, factory):
+    """name のインスタンスがなければ factory() で生成して登録し、返す"""
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = factory()
+                _instances[name] = instance
+    return instance
+
+
+def register(name, instance):
+    """インスタンスを差し替える (テストやベンチマークでフェイクを注入する用)"""
+    with _lock:
+        _instances[name] = instance
+
+
+def reset():
+    with _lock:
+        _instances.clear()
+
+
+# ===== Cloud Storage =====
+def storage_credentials():
+    """GCS_KEY_JSON のサービスアカウント認証情報 (署名付き URL のローカル署名にも使う)"""
+    def create():
+        from google.oauth2 import service_account
+
+        key_json_str = os.environ.get("GCS_KEY_JSON")
+        if not key_json_str:
+            raise RuntimeError("環境変数 GCS_KEY_JSON が設定されていません")
+        key_dict = json.loads(key_json_str)
+        return service_account.Credentials.from_service_account_info(key_dict)
+
+    return get("storage.credentials", create)
+
+
+def storage_client():
+    def create():
+        from google.cloud import storage
+
+        return storage.Client(credentials=storage_credentials())
+
+    return get("storage", create)
+
+
+def storage_backend():
+    """gcs_utils が読み書きする保存先 (STORAGE_BACKEND で GCS / ローカル / メモリを選ぶ)"""
+    def create():
+        import storage_backends
+
+        return storage_backends.create()
+
+    return get("storage.backend", create)
+
+
+# ===== google.generativeai (API キー) =====
+def generative_model(model_name="gemini-2.5-pro"):
+    def create():
+        import google.generativeai as genai
+
+        get("genai.configure", lambda: genai.configure(api_key=GOOGLE_API_KEY) or True)
+        return genai.GenerativeModel(model_name)
+
+    return get(f"genai.model:{model_name}", create)
+
+
+# ===== google.genai (API キー / Vertex AI) =====
+def genai_client():
+    def create():
+        from google import genai
+
+        return genai.Client(api_key=GOOGLE_API_KEY)
+
+    return get("genai.client", create)
+
+
+def vertex_genai_client(location="us-central1"):
+    def create():
+        from google import genai
+
+        return genai.Client(vertexai=True, project=GOOGLE_CLOUD_PROJECT, location=location)
+
+    return get(f"genai.vertex_client:{location}", create)
+
+
+# ===== Vertex AI SDK =====
+def _vertex_init(location):
+    import vertexai
+
+    vertexai.init(project=GOOGLE_CLOUD_PROJECT, location=location)
+
+
+def vertex_model(model_name="gemini-2.5-pro", system_instruction=None, location="us-central1", key=None):
+    """
+    vertexai の GenerativeModel を返す。
+    モデルは生成時のリージョンを保持するので、init と生成をまとめてロック内で行う。
+    system_instruction を変える場合は key で区別する。
+    """
+    def create():
+        from vertexai.generative_models import GenerativeModel
+
+        with _lock:
+            _vertex_init(location)
+            return GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+
+    return get(f"vertex.model:{location}:{model_name}:{key or ''}", create)
+
+
+def imagen_model(model_name="imagen-4.0-generate-001", location=None):
+    def create():
+        from vertexai.preview.vision_models import ImageGenerationModel
+
+        with _lock:
+            _vertex_init(location or GOOGLE_CLOUD_REGION)
+            return ImageGenerationModel.from_pretrained(model_name)
+
+    return get(f"vertex.imagen:{location or GOOGLE_CLOUD_REGION}:{model_name}", create)
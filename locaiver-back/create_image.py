@@ -1,4 +1,6 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 import scene
 import translate
 import make_scene_prompt
@@ -6,9 +8,43 @@ import make_character_prompt
 import generate_character
 import generate_scene_image
 import gcs_utils
+import tracing
 
 
 BUCKET_NAME = os.getenv("BUCKET_NAME")
+SCENE_IMAGE_CONCURRENCY = int(os.getenv("SCENE_IMAGE_CONCURRENCY", "4"))
+
+
+def _render_scene(i, task):
+    with tracing.span("scene.render", scene=i + 1):
+        return task()
+
+
+def render_scenes(tasks, max_workers=SCENE_IMAGE_CONCURRENCY):
+    """
+    シーン画像を並行生成する。
+    tasks: {シーン番号(0始まり): 引数なしで呼べる生成関数}
+    1シーンの失敗で他を止めず、全シーン終了後に失敗分をまとめて例外にする。
+    """
+    results = {}
+    failures = {}
+    if not tasks:
+        return results
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as pool:
+        futures = {pool.submit(tracing.wrap(_render_scene), i, task): i for i, task in tasks.items()}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                print(f"Scene {i+1} の画像生成に失敗しました: {e}", flush=True)
+                failures[i] = e
+
+    if failures:
+        detail = ", ".join(f"scene {i+1}: {e}" for i, e in sorted(failures.items()))
+        raise RuntimeError(f"{len(failures)}/{len(tasks)} シーンの画像生成に失敗しました ({detail})")
+    return results
 
 
 def create_image_with_character(bucket_name, story_ja_path, story_en_path, character_ja_path, character_en_path, \
@@ -32,21 +68,22 @@ def create_image_with_character(bucket_name, story_ja_path, story_en_path, chara
     save_path = img_dir + name + ".png"
     
     # キャラクター画像生成
-    generate_character.init_vertex()
     generate_character.generate_image(bucket_name, character_prompt, save_path, user_input_ja_path)
 
     #シーン(英語)のjsonから画像生成用のプロンプトにする
     scene_prompt = make_scene_prompt.generate_scene_prompts_from_json(bucket_name, scene_en_path, story_en_path, user_input_ja_path)
 
     #シーン(英語)＋キャラクター画像からシーン画像生成
+    tasks = {}
     for i in range(len(scene_prompt)):
         prompt = scene_prompt[i]
         img_path = save_path
         print(f"--- Prompt for Scene {i+1} ---")
         print(prompt)
         print("-" * 25)
-        generate_scene_image.safe_generate_image(bucket_name, prompt, \
+        tasks[i] = partial(generate_scene_image.safe_generate_image, bucket_name, prompt, \
             img_path, img_dir, i, save_img_name)
+    render_scenes(tasks)
     
     print("---finish!!---")
 
@@ -64,15 +101,17 @@ def create_image_no_character(BUCKET_NAME, story_ja_path, story_en_path, charact
     #シーン(英語)のjsonから画像生成用のプロンプトにする
     scene_prompt = make_scene_prompt.generate_scene_prompts_from_json(BUCKET_NAME, scene_en_path, story_en_path, user_input_ja_path)
 
-    #シーン(英語)＋キャラクター画像からシーン画像生成
+    #シーン(英語)からシーン画像生成
+    tasks = {}
     for i in range(len(scene_prompt)):
         prompt = scene_prompt[i]
         
         print(f"--- Prompt for Scene {i+1} ---")
         print(prompt)
         print("-" * 25)
-        generate_scene_image.safe_generate_image_no_character(BUCKET_NAME, prompt, \
+        tasks[i] = partial(generate_scene_image.safe_generate_image_no_character, BUCKET_NAME, prompt, \
             img_dir, i, save_img_name, user_input_ja_path)
+    render_scenes(tasks)
 
     print("---finish!!---")
 
@@ -117,17 +156,20 @@ def display_scenes_from_json(bucket_name, scene_file_path):
 
 
 def edit_image(project_folder,story_ja_path, scene_ja_path, scene_en_path, story_en_path, user_input_ja_path, character_en_path, img_dir, revision_count,fix,input_fix):
-    revised_scene_id = []
-    for i, val in enumerate(fix):
-        if val == "Y":
-            scene_ja_path = scene.fix_slected_scene_from_story(BUCKET_NAME, i, story_ja_path, scene_ja_path, revision_count, input_fix[i], project_folder)
-            output_scene_en_path = project_folder + f"json/scene_akakura_en_v{revision_count}.json"
-            translate.translate_json(BUCKET_NAME, scene_ja_path, output_scene_en_path)
-            revised_scene_id.append(i)
-
-            continue
-        else:
-            continue
+    # 修正するシーン (0始まり) と修正内容
+    revisions = {i: input_fix[i] for i, val in enumerate(fix) if val == "Y"}
+    if not revisions:
+        raise ValueError("修正するシーンが指定されていません")
+
+    # 全シーンの修正を 1 回でまとめて反映する
+    revised_scene_ja_path = scene.fix_selected_scenes_from_story(
+        BUCKET_NAME, revisions, story_ja_path, scene_ja_path, revision_count, project_folder
+    )
+    output_scene_en_path = project_folder + f"json/scene_akakura_en_v{revision_count}.json"
+    # 修正で変わった文字列だけを翻訳し、直前の英語版にマージする
+    translate.translate_json_incremental(
+        BUCKET_NAME, scene_ja_path, scene_en_path, revised_scene_ja_path, output_scene_en_path
+    )
     print("修正点を受け付けました。絵コンテを再生成します")
     
     scene_prompt = make_scene_prompt.generate_scene_prompts_from_json(BUCKET_NAME, output_scene_en_path, story_en_path, user_input_ja_path)
@@ -136,8 +178,21 @@ def edit_image(project_folder,story_ja_path, scene_ja_path, scene_en_path, story
     
     data = gcs_utils.read_json(BUCKET_NAME, user_input_ja_path)
     progression = data.get("progression")
-    
-    if "登場人物型" == progression:
+
+    # 修正したシーンだけを並行して再生成する
+    tasks = {}
+    if "ナレーション型" == progression:
+        print("ナレーション型で画像修正を開始")
+        for j in sorted(revisions):
+            if j >= len(scene_prompt):
+                continue
+            prompt = scene_prompt[j]
+            print(f"--- Prompt for Scene {j+1} ---")
+            print(prompt)
+            print("-" * 25)
+            tasks[j] = partial(generate_scene_image.safe_generate_image_no_character, BUCKET_NAME, prompt, img_dir, j, save_img_name, user_input_ja_path)
+
+    else:
         print("登場人物型で画像修正を開始")
         character_data = gcs_utils.read_json(BUCKET_NAME, character_en_path)
 
@@ -145,37 +200,18 @@ def edit_image(project_folder,story_ja_path, scene_ja_path, scene_en_path, story
 
         save_path = img_dir + name + ".png"
 
-        for j in range(len(scene_prompt)):
-            # 修正したシーンだけ修正するように
-            for k in range(len(revised_scene_id)):
-                if (revised_scene_id[k] == j):
-                    # 修正したシーンだけの処理はここ
-                    prompt = scene_prompt[j]
-                    img_path = save_path
-                    print(f"--- Prompt for Scene {j+1} ---")
-                    print(prompt)
-                    print("-" * 25)
-                    generate_scene_image.safe_generate_image(BUCKET_NAME, prompt, \
-                        img_path, img_dir, j, save_img_name)
-                else:
-                    continue
-            continue
-        
-    elif "ナレーション型" == progression:
-        print("ナレーション型で画像修正を開始")
-        for j in range(len(scene_prompt)):
-            # 修正したシーンだけ修正するように
-            for k in range(len(revised_scene_id)):
-                if (revised_scene_id[k] == j):
-                    # 修正したシーンだけの処理はここ
-                    prompt = scene_prompt[j]
-                    print(f"--- Prompt for Scene {j+1} ---")
-                    print(prompt)
-                    print("-" * 25)
-                    generate_scene_image.safe_generate_image_no_character(BUCKET_NAME, prompt, img_dir, j, save_img_name, user_input_ja_path)
-                else:
-                    continue
-            continue
+        for j in sorted(revisions):
+            if j >= len(scene_prompt):
+                continue
+            prompt = scene_prompt[j]
+            img_path = save_path
+            print(f"--- Prompt for Scene {j+1} ---")
+            print(prompt)
+            print("-" * 25)
+            tasks[j] = partial(generate_scene_image.safe_generate_image, BUCKET_NAME, prompt, \
+                img_path, img_dir, j, save_img_name)
+
+    render_scenes(tasks)
 
     print("絵コンテ修正を終了します")
 
@@ -1,25 +1,61 @@
 import os
-import google.generativeai as genai
-import vertexai
-from vertexai.generative_models import GenerativeModel
-import json
+import clients
 import gcs_utils
+import llm_json
+import tracing
 
 
-GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 
 
+# ===== 構造化出力のスキーマ =====
+STORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "subject": {"type": "string"},
+        "story": {"type": "string"},
+        "style": {"type": "string"},
+        "quality_modifiers": {"type": "string"},
+        "negative_prompt": {"type": "string"},
+    },
+    "required": ["subject", "story", "style", "quality_modifiers", "negative_prompt"],
+}
+
+CHARACTER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "sex": {"type": "string"},
+        "age": {"type": "string"},
+        "description": {"type": "string"},
+        "personality": {"type": "string"},
+        "visual_design": {
+            "type": "object",
+            "properties": {
+                "height": {"type": "string"},
+                "build": {"type": "string"},
+                "hair_style": {"type": "string"},
+                "eye_color": {"type": "string"},
+                "clothing_style": {"type": "string"},
+            },
+            "required": ["height", "build", "hair_style", "eye_color", "clothing_style"],
+        },
+        "key_item": {"type": "string"},
+        "style": {"type": "string"},
+        "character_composition": {"type": "string"},
+    },
+    "required": [
+        "name", "sex", "age", "description", "personality", "visual_design",
+        "key_item", "style", "character_composition",
+    ],
+}
+
+
 def get_model():
-    genai.configure(api_key=GOOGLE_API_KEY)
-    return genai.GenerativeModel("gemini-2.5-pro")
+    return clients.generative_model("gemini-2.5-pro")
 
 
-def first(data) -> str:
-    
-    model = get_model()
-    
+def first_prompt(data) -> str:
     seconds = data.get("seconds")
     highlight = data.get("highlight")
     
@@ -48,19 +84,59 @@ def first(data) -> str:
 
     まず、ユーザに最初の質問を提示するところからスタートです。
     """
+    return system_instruction
+
+
+def first(data) -> str:
+    
+    model = get_model()
+    prompt = first_prompt(data)
     
-    resp = model.generate_content(system_instruction)
+    with tracing.span("model.generate_content", kind="chat", model="gemini-2.5-pro", prompt_chars=len(prompt)) as span:
+        resp = model.generate_content(prompt)
+        span.set("response_chars", len(getattr(resp, "text", None) or ""))
     
     print("システム：" + getattr(resp, "text", None))
     
     return getattr(resp, "text", None) or "（生成結果なし）"
 
 
-def generate_lyrics(prompt_suffix):
-    vertexai.init(project=GOOGLE_CLOUD_PROJECT, location="us-central1")
+def iter_text(response):
+    """ストリーミング応答からテキストの断片を順に取り出す"""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # テキストを含まないチャンク (終了理由のみ等) は読み飛ばす
+            continue
+        if text:
+            yield text
+
+
+def traced_stream(model, contents, kind, model_name, prompt_chars):
+    """ストリーミング生成のテキスト断片を yield する。最後の断片までを 1 スパンとして計測する"""
+    with tracing.span(
+        "model.generate_content", kind=kind, model=model_name, stream=True, prompt_chars=prompt_chars
+    ) as span:
+        chars = 0
+        for text in iter_text(model.generate_content(contents, stream=True)):
+            chars += len(text)
+            yield text
+        span.set("response_chars", chars)
+
+
+def first_stream(data):
+    """first() のストリーミング版。生成されたテキストを届いた順に yield する"""
+    model = get_model()
+    prompt = first_prompt(data)
+    yield from traced_stream(model, prompt, "chat", "gemini-2.5-pro", len(prompt))
+
 
-    model = GenerativeModel(
+def interviewer_model():
+    return clients.vertex_model(
         model_name="gemini-2.5-pro",
+        location="us-central1",
+        key="interviewer",
         system_instruction=[
             """あなたは「地域紹介映像」を作るためのインタビュアーです。
             映像制作に詳しくないユーザーの想像力を引き出し、彼らが本当に作りたい映像を言語化する手助けをします。
@@ -82,12 +158,24 @@ def generate_lyrics(prompt_suffix):
         ],
     )
 
+
+def generate_lyrics(prompt_suffix):
+    model = interviewer_model()
+
     prompt = prompt_suffix
-    response = model.generate_content([prompt])
+    with tracing.span("model.generate_content", kind="chat", model="gemini-2.5-pro", prompt_chars=len(prompt)) as span:
+        response = model.generate_content([prompt])
+        span.set("response_chars", len(response.text or ""))
     print(response.text)
     return response.text
 
 
+def generate_lyrics_stream(prompt_suffix):
+    """generate_lyrics() のストリーミング版。生成されたテキストを届いた順に yield する"""
+    model = interviewer_model()
+    yield from traced_stream(model, [prompt_suffix], "chat", "gemini-2.5-pro", len(prompt_suffix))
+
+
 def make_story(messages,story_ja_path):
     model = get_model()
     
@@ -118,16 +206,7 @@ def make_story(messages,story_ja_path):
     出力: JSON
     """
     
-    response = model.generate_content(PROMPT)
-    text = response.text
-
-    try:
-        cleaned = text.strip().strip("```").replace("json", "").strip()
-        story_json = json.loads(cleaned)
-    except Exception as e:
-        print("AIの出力をJSONとしてパースできませんでした。生テキストを表示します:")
-        print(text)
-        raise e
+    story_json = llm_json.generate_json(model, PROMPT, STORY_SCHEMA, kind="story")
 
     gcs_utils.write_json(BUCKET_NAME, story_json, story_ja_path)
 
@@ -167,16 +246,7 @@ def make_story_no_character(messages,story_ja_path):
     出力: JSON
     """
     
-    response = model.generate_content(PROMPT)
-    text = response.text
-
-    try:
-        cleaned = text.strip().strip("```").replace("json", "").strip()
-        story_json = json.loads(cleaned)
-    except Exception as e:
-        print("AIの出力をJSONとしてパースできませんでした。生テキストを表示します:")
-        print(text)
-        raise e
+    story_json = llm_json.generate_json(model, PROMPT, STORY_SCHEMA, kind="story")
 
     gcs_utils.write_json(BUCKET_NAME, story_json, story_ja_path)
 
@@ -227,16 +297,7 @@ def meke_character(story,character_ja_path):
 
     """
     
-    response = model.generate_content(PROMPT)
-    text = response.text
-
-    try:
-        cleaned = text.strip().strip("```").replace("json", "").strip()
-        character_json = json.loads(cleaned)
-    except Exception as e:
-        print("AIの出力をJSONとしてパースできませんでした。生テキストを表示します:")
-        print(text)
-        raise e
+    character_json = llm_json.generate_json(model, PROMPT, CHARACTER_SCHEMA, kind="character")
 
     gcs_utils.write_json(BUCKET_NAME, character_json, character_ja_path)
 
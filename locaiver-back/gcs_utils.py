@@ -1,149 +1,458 @@
 import json
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from google.cloud import storage
-from google.oauth2 import service_account
 from PIL import Image
 from datetime import timedelta
 import re
-from google.api_core.retry import Retry
+from cachetools import LRUCache
+from google.api_core.exceptions import NotFound, PreconditionFailed
+import clients
+import metrics
+import tracing
 
 
-key_json_str = os.environ.get("GCS_KEY_JSON")
-if not key_json_str:
-    raise RuntimeError("環境変数 GCS_KEY_JSON が設定されていません")
-key_dict = json.loads(key_json_str)
-credentials = service_account.Credentials.from_service_account_info(key_dict)
-client = storage.Client(credentials=credentials)
+BUCKET_NAME = os.getenv("BUCKET_NAME")
+PROJECT_COUNTER_PATH = "_system/project_counter.json"
+GCS_CACHE_MAX_BYTES = int(os.getenv("GCS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", "2"))
+PREVIEW_MAX_SIZE = 768
+PREVIEW_QUALITY = 80
+SIGNED_URL_REFRESH_MARGIN_SECONDS = int(os.getenv("SIGNED_URL_REFRESH_MARGIN_SECONDS", "300"))
+# 読み込み中に上書きされた時に stat からやり直す回数
+READ_ATTEMPTS = 3
+
+
+# 読み書きはすべて clients.storage_backend() を経由する (実装は storage_backends.py)
+def _backend():
+    return clients.storage_backend()
+
+
+# ===== 読み込みキャッシュ =====
+# (bucket_name, gcs_path) -> (generation, bytes)
+# 読むたびにメタデータの generation を確認し、一致すればダウンロードを省略する
+_cache = LRUCache(maxsize=GCS_CACHE_MAX_BYTES, getsizeof=lambda entry: len(entry[1]))
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+metrics.GCS_READ_CACHE_MAX_BYTES.set(GCS_CACHE_MAX_BYTES)
+
+
+def _cache_count(result):
+    """ヒット/ミスを数える (_cache_lock の中で呼ぶ)"""
+    _cache_stats[result + "s"] += 1
+    metrics.GCS_READ_CACHE.labels(result).inc()
+
+
+def _cache_changed():
+    """使用量のゲージを更新する (_cache_lock の中で呼ぶ)"""
+    metrics.GCS_READ_CACHE_ENTRIES.set(len(_cache))
+    metrics.GCS_READ_CACHE_BYTES.set(_cache.currsize)
+
+
+def _cache_put(bucket_name, gcs_path, generation, data):
+    with _cache_lock:
+        try:
+            _cache[(bucket_name, gcs_path)] = (generation, data)
+        except ValueError:
+            # キャッシュ全体より大きいオブジェクトは保持しない
+            _cache.pop((bucket_name, gcs_path), None)
+        _cache_changed()
+
+
+def _cache_invalidate(bucket_name, gcs_path):
+    with _cache_lock:
+        if _cache.pop((bucket_name, gcs_path), None) is not None:
+            _cache_changed()
+
+
+# ===== 署名付き URL キャッシュ =====
+# (blob_path, expiration_minutes, generation) -> (url, expires_at)
+_signed_urls = LRUCache(maxsize=4096)
+_signed_url_lock = threading.Lock()
+
+
+def cache_stats():
+    """読み込みキャッシュのヒット/ミス数と使用量を返す"""
+    with _cache_lock:
+        return {
+            **_cache_stats,
+            "entries": len(_cache),
+            "bytes": _cache.currsize,
+            "max_bytes": _cache.maxsize,
+        }
+
+
+@tracing.traced("gcs.read")
+def read_versioned(bucket_name: str, gcs_path: str):
+    """GCS からオブジェクトを読み込み、(データ, generation) を返す (generation が変わっていなければキャッシュを返す)"""
+    backend = _backend()
+    tracing.set_attribute("path", gcs_path)
+    # stat と read の間に上書きされると generation 指定の read が PreconditionFailed になるので、stat からやり直す
+    for attempt in range(1, READ_ATTEMPTS + 1):
+        info = backend.stat(bucket_name, gcs_path)
+        if info is None:
+            _cache_invalidate(bucket_name, gcs_path)
+            raise NotFound(f"gs://{bucket_name}/{gcs_path} が見つかりません")
+
+        with _cache_lock:
+            entry = _cache.get((bucket_name, gcs_path))
+            if entry is not None and entry[0] == info.generation:
+                _cache_count("hit")
+                tracing.set_attribute("cache_hit", True)
+                tracing.set_attribute("bytes", len(entry[1]))
+                return entry[1], info.generation
+            _cache_count("miss")
+
+        try:
+            data = backend.read(bucket_name, gcs_path, generation=info.generation)
+        except PreconditionFailed:
+            if attempt == READ_ATTEMPTS:
+                raise
+            tracing.set_attribute("reread", attempt)
+            continue
+        tracing.set_attribute("cache_hit", False)
+        tracing.set_attribute("bytes", len(data))
+        _cache_put(bucket_name, gcs_path, info.generation, data)
+        return data, info.generation
 
 
-BUCKET_NAME = os.getenv("BUCKET_NAME")
+def read_bytes(bucket_name: str, gcs_path: str) -> bytes:
+    """GCS からオブジェクトを読み込む"""
+    return read_versioned(bucket_name, gcs_path)[0]
 
 
 def read_json(bucket_name: str, gcs_path: str):
     """GCS から JSON を読み込む"""
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(gcs_path)
-    data = blob.download_as_bytes()
+    data = read_bytes(bucket_name, gcs_path)
     return json.loads(data.decode("utf-8"))
 
 
-def write_json(bucket_name: str, data: dict, gcs_path: str):
-    """JSON データを GCS に保存"""
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(gcs_path)
-    blob.upload_from_string(
-        json.dumps(data, ensure_ascii=False, indent=2),
-        content_type="application/json"
+def read_json_versioned(bucket_name: str, gcs_path: str):
+    """
+    JSON と generation を返す。無ければ (None, 0)。
+    generation を write_json の if_generation_match に渡すと、読んでから誰も書き換えていない時だけ書き込める。
+    """
+    try:
+        data, generation = read_versioned(bucket_name, gcs_path)
+    except NotFound:
+        return None, 0
+    return json.loads(data.decode("utf-8")), generation
+
+
+@tracing.traced("gcs.write_json")
+def write_json(bucket_name: str, data: dict, gcs_path: str, if_generation_match=None):
+    """
+    JSON データを GCS に保存し、書き込んだ generation を返す。
+    if_generation_match を指定すると、その generation のままの時だけ書き込む (違えば PreconditionFailed)。
+    """
+    payload = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    generation = _backend().write(
+        bucket_name, gcs_path, payload, content_type="application/json", if_generation_match=if_generation_match
     )
+    tracing.set_attribute("path", gcs_path)
+    tracing.set_attribute("bytes", len(payload))
+    _cache_put(bucket_name, gcs_path, generation, payload)
     print(f"[GCS] JSON Uploaded -> gs://{bucket_name}/{gcs_path}")
-
-
-def upload_image(bucket_name: str, img, gcs_path: str):
-    """画像を GCS にアップロード (GeneratedImage / PIL.Image 双方対応)"""
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(gcs_path)
+    return generation
+
+
+def _sniff_image_type(data: bytes):
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+@tracing.traced("gcs.upload_image")
+def upload_image(bucket_name: str, img, gcs_path: str, content_type: str = None, preview: bool = True):
+    """
+    画像を GCS にアップロード (エンコード済みバイト列 / GeneratedImage / PIL.Image に対応)
+    バイト列はデコードせずそのままアップロードする。
+    preview=True ならプレビュー用の縮小版 (WebP) をバックグラウンドで作る。
+    """
+    # エンコード済みのバイト列の場合
+    if isinstance(img, (bytes, bytearray)):
+        image_bytes = bytes(img)
 
     # GeneratedImage の場合
-    if hasattr(img, "_image_bytes"):
+    elif hasattr(img, "_image_bytes"):
         image_bytes = img._image_bytes
-        blob.upload_from_string(image_bytes, content_type="image/png")
 
     # PIL.Image の場合
     elif isinstance(img, Image.Image):
         buffer = BytesIO()
         img.save(buffer, format="PNG")
-        buffer.seek(0)
-        blob.upload_from_file(buffer, content_type="image/png")
+        image_bytes = buffer.getvalue()
+        content_type = "image/png"
 
     else:
         raise TypeError(f"Unsupported image type: {type(img)}")
 
+    content_type = content_type or _sniff_image_type(image_bytes) or "image/png"
+    generation = _backend().write(bucket_name, gcs_path, image_bytes, content_type=content_type)
+    tracing.set_attribute("path", gcs_path)
+    tracing.set_attribute("bytes", len(image_bytes))
+    _cache_put(bucket_name, gcs_path, generation, image_bytes)
+
     print(f"Image uploaded to gs://{bucket_name}/{gcs_path}")
+    if preview:
+        _schedule_preview(bucket_name, image_bytes, gcs_path)
     return f"gs://{bucket_name}/{gcs_path}"
 
 
+# ===== プレビュー用の縮小画像 =====
+# 元画像のパス -> 縮小版を作る Future
+_preview_futures = LRUCache(maxsize=1024)
+_preview_lock = threading.Lock()
+_preview_executor = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix="preview")
+
+
+def preview_path(gcs_path: str) -> str:
+    """images/akakuraPR_1.png -> images/preview/akakuraPR_1.webp"""
+    folder, _, filename = gcs_path.rpartition("/")
+    stem = filename.rsplit(".", 1)[0]
+    return f"{folder}/preview/{stem}.webp" if folder else f"preview/{stem}.webp"
+
+
+@tracing.traced("gcs.upload_preview")
+def _make_preview(bucket_name, image_bytes, gcs_path):
+    img = Image.open(BytesIO(image_bytes))
+    img.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE))
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    buffer = BytesIO()
+    img.save(buffer, format="WEBP", quality=PREVIEW_QUALITY)
+
+    path = preview_path(gcs_path)
+    _backend().write(bucket_name, path, buffer.getvalue(), content_type="image/webp")
+    tracing.set_attribute("path", path)
+    tracing.set_attribute("bytes", buffer.tell())
+    print(f"Preview uploaded to gs://{bucket_name}/{path}")
+    return path
+
+
+def _schedule_preview(bucket_name, image_bytes, gcs_path):
+    future = _preview_executor.submit(tracing.wrap(_make_preview), bucket_name, image_bytes, gcs_path)
+    with _preview_lock:
+        _preview_futures[gcs_path] = future
+
+
+@tracing.traced("gcs.copy_image")
+def copy_image(bucket_name: str, source_path: str, target_path: str, preview: bool = True):
+    """
+    バケット内で画像をコピーする (サーバー側でコピーするので画像本体はダウンロードもアップロードもしない)。
+    preview=True なら縮小版だけ作る (そのための読み込みはキャッシュに載っていれば GCS に取りに行かない)。
+    """
+    _backend().copy(bucket_name, source_path, target_path)
+    tracing.set_attribute("path", target_path)
+    _cache_invalidate(bucket_name, target_path)
+    if preview:
+        try:
+            _schedule_preview(bucket_name, read_bytes(bucket_name, source_path), target_path)
+        except Exception as e:
+            print(f"Preview for {target_path} could not be scheduled: {e}")
+    print(f"Copied gs://{bucket_name}/{source_path} → gs://{bucket_name}/{target_path}")
+
+
+def wait_for_previews(gcs_paths, timeout=30):
+    """
+    指定した画像の縮小版の作成を待ち、作成済みのものについて {元画像のパス: 縮小版のパス} を返す。
+    このプロセスで作っていない (または失敗した) 画像は含めない。
+    """
+    ready = {}
+    deadline = time.monotonic() + timeout
+    for gcs_path in gcs_paths:
+        with _preview_lock:
+            future = _preview_futures.get(gcs_path)
+        if future is None:
+            continue
+        try:
+            ready[gcs_path] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception as e:
+            print(f"Preview for {gcs_path} is not available: {e}")
+    return ready
+
+
+@tracing.traced("gcs.find_previews")
+def find_previews(bucket_name, gcs_paths, timeout=30):
+    """
+    縮小版がある画像について {元画像のパス: 縮小版のパス} を返す。
+    このプロセスで作成中のものは完了を待ち、それ以外 (以前のリクエストや別のワーカーで作ったもの) は
+    フォルダの一覧で有無を確かめる。元画像より古い縮小版は作り直す前の画像のものなので含めない。
+    """
+    ready = wait_for_previews(gcs_paths, timeout)
+    missing = [gcs_path for gcs_path in gcs_paths if gcs_path not in ready]
+    folders = {gcs_path.rpartition("/")[0] for gcs_path in missing}
+    objects = {}
+    for folder in folders:
+        for info in _backend().list(bucket_name, folder + "/" if folder else ""):
+            objects[info.name] = info
+    for gcs_path in missing:
+        original = objects.get(gcs_path)
+        preview = objects.get(preview_path(gcs_path))
+        if preview is None:
+            continue
+        if original is not None and original.updated and preview.updated and preview.updated < original.updated:
+            continue
+        ready[gcs_path] = preview.name
+    tracing.set_attribute("count", len(ready))
+    return ready
+
+
 def read_image(bucket_name: str, gcs_path: str):
     """GCS から PNG/JPG 画像を読み込んで PIL Image を返す"""
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(gcs_path)
-    data = blob.download_as_bytes()
+    data = read_bytes(bucket_name, gcs_path)
     img = Image.open(BytesIO(data))
     return img
 
 
+@tracing.traced("gcs.upload_file")
 def upload_to_gcs(bucket_name, source_file, destination_blob):
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob)
-    blob.upload_from_filename(source_file)
+    _backend().upload_file(bucket_name, destination_blob, source_file)
+    tracing.set_attribute("path", destination_blob)
+    tracing.set_attribute("bytes", os.path.getsize(source_file))
+    _cache_invalidate(bucket_name, destination_blob)
     print(f"Uploaded {source_file} → gs://{bucket_name}/{destination_blob}")
     
     
-def generate_signed_url(blob_path, expiration_minutes):
-    bucket = client.bucket(BUCKET_NAME)
-    blob = bucket.blob(blob_path)
-    
-    url = blob.generate_signed_url(
-        version="v4",
-        expiration=timedelta(minutes=expiration_minutes),
-        method="GET",
-    )
-    return url
+def _known_generation(bucket_name, gcs_path):
+    """読み込みキャッシュが知っている generation を返す (リモート呼び出しはしない)"""
+    with _cache_lock:
+        entry = _cache.get((bucket_name, gcs_path))
+    return entry[0] if entry is not None else None
+
+
+@tracing.traced("gcs.sign_urls")
+def generate_signed_urls(blob_paths, expiration_minutes):
+    """
+    複数オブジェクトの署名付き URL をまとめて発行する。
+    署名はサービスアカウントの秘密鍵でローカルに行い、期限切れ間近になるまで URL を使い回す。
+    """
+    backend = _backend()
+    lifetime = timedelta(minutes=expiration_minutes)
+    # 残り時間がこれを切った URL は返さずに署名し直す
+    margin = min(timedelta(seconds=SIGNED_URL_REFRESH_MARGIN_SECONDS), lifetime / 2)
+    now = time.time()
+
+    urls = {}
+    tracing.set_attribute("count", len(blob_paths))
+    for blob_path in blob_paths:
+        key = (blob_path, expiration_minutes, _known_generation(BUCKET_NAME, blob_path))
+        with _signed_url_lock:
+            cached = _signed_urls.get(key)
+        if cached is not None and cached[1] - margin.total_seconds() > now:
+            urls[blob_path] = cached[0]
+            continue
 
+        url = backend.signed_url(BUCKET_NAME, blob_path, lifetime)
+        with _signed_url_lock:
+            _signed_urls[key] = (url, now + lifetime.total_seconds())
+        urls[blob_path] = url
+    return urls
 
-def create_next_project_folder():
-    bucket = client.bucket(BUCKET_NAME)
 
-    # 既存の Project-XXX フォルダを取得
-    blobs = client.list_blobs(BUCKET_NAME, prefix="Project-")
+def generate_signed_url(blob_path, expiration_minutes):
+    return generate_signed_urls([blob_path], expiration_minutes)[blob_path]
+
 
+def _scan_last_project_number():
+    """delimiter 付きの一覧でトップレベルの Project-XXX/ だけを調べ、最大の番号を返す (カウンタ初期化時のみ)"""
     project_numbers = []
-    for blob in blobs:
-        # "Project-001/" のようなプレフィックスを抽出
-        match = re.match(r"Project-(\d{3})/", blob.name)
+    for prefix in _backend().list_prefixes(BUCKET_NAME, "Project-"):
+        match = re.match(r"Project-(\d+)/$", prefix)
         if match:
             project_numbers.append(int(match.group(1)))
+    return max(project_numbers, default=0)
+
+
+@tracing.traced("gcs.allocate_project_number")
+def allocate_project_number(max_attempts=20):
+    """
+    カウンタオブジェクトを generation 条件付きで更新して次のプロジェクト番号を払い出す。
+    同時に呼ばれても条件付き書き込みに勝った 1 つだけが番号を得るので重複しない。
+    """
+    backend = _backend()
+
+    for attempt in range(max_attempts):
+        tracing.set_attribute("attempt", attempt + 1)
+        info = backend.stat(BUCKET_NAME, PROJECT_COUNTER_PATH)
+        try:
+            if info is None:
+                # 初回のみ既存フォルダから開始番号を決め、存在しない場合に限り作成する
+                generation = 0
+                last_number = _scan_last_project_number()
+            else:
+                generation = info.generation
+                last_number = json.loads(backend.read(BUCKET_NAME, PROJECT_COUNTER_PATH, generation=generation))["last"]
+
+            next_number = last_number + 1
+            backend.write(
+                BUCKET_NAME,
+                PROJECT_COUNTER_PATH,
+                json.dumps({"last": next_number}).encode("utf-8"),
+                content_type="application/json",
+                if_generation_match=generation,
+            )
+            return next_number
+        except PreconditionFailed:
+            # 他のリクエストが先に更新した。少し待って読み直す
+            time.sleep(random.uniform(0, 0.2 * (attempt + 1)))
+
+    raise RuntimeError("プロジェクト番号の払い出しが競合し続けたため失敗しました")
+
 
-    # 次の番号を決定
-    next_number = max(project_numbers, default=0) + 1
+def create_next_project_folder():
+    # GCS にフォルダの実体は無いので、番号を確保するだけでよい (プレースホルダは作らない)
+    next_number = allocate_project_number()
     base_folder = f"Project-{next_number:03d}/"
 
-    # まずベースフォルダを作成
-    bucket.blob(base_folder).upload_from_string("")
+    print(f"Allocated project folder: {base_folder}")
+    return base_folder
 
-    # サブフォルダを作成
-    subfolders = ["images/", "json/", "result/", "videos/"]
-    for sub in subfolders:
-        folder_path = base_folder + sub
-        bucket.blob(folder_path).upload_from_string("")  # 空ファイルでフォルダを作成
-        print(f"Created subfolder: {folder_path}")
 
-    print(f"Created project folder with subfolders under: {base_folder}")
-    return base_folder
+@tracing.traced("gcs.download_file")
+def download_file(bucket_name, gcs_path, local_path):
+    _backend().download_file(bucket_name, gcs_path, local_path)
+    tracing.set_attribute("path", gcs_path)
+    tracing.set_attribute("bytes", os.path.getsize(local_path))
+    print(f"Downloaded {gcs_path} → {local_path}")
+    return local_path
 
 
+@tracing.traced("gcs.download_videos")
 def download_videos(bucket_name, video_files, local_dir="videos"):
-    bucket = client.bucket(bucket_name)
+    backend = _backend()
 
     if not os.path.exists(local_dir):
         os.makedirs(local_dir)
 
-    local_paths = []
-    for file in video_files:
-        blob = bucket.blob(file)
+    def download(file):
         local_path = os.path.join(local_dir, os.path.basename(file))
-        blob.download_to_filename(local_path)
+        backend.download_file(bucket_name, file, local_path)
         print(f"Downloaded {file} → {local_path}")
-        local_paths.append(local_path)
+        return local_path
+
+    # クリップは独立しているので並行してダウンロードする (順序は video_files のまま)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(video_files), 8))) as pool:
+        local_paths = list(pool.map(download, video_files))
+
+    tracing.set_attribute("count", len(local_paths))
+    tracing.set_attribute("bytes", sum(os.path.getsize(path) for path in local_paths))
 
     return local_paths
 
 
+@tracing.traced("gcs.move")
 def move_and_cleanup(gcs_uri, target_prefix, new_filename):
     # 元のバケットとパス
     bucket_name, blob_path = gcs_uri[5:].split("/", 1)
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
+    backend = _backend()
 
     # ファイル名を決定
     file_name = new_filename or blob_path.split("/")[-1]
@@ -154,12 +463,13 @@ def move_and_cleanup(gcs_uri, target_prefix, new_filename):
     # コピー先 blob
     new_blob_path = f"{target_prefix}{file_name}"
 
-    # rewrite ではなく copy_blob を使用
-    retry = Retry(deadline=300)  # 最大 5 分待機
-    bucket.copy_blob(blob, bucket, new_blob_path, retry=retry)
+    backend.copy(bucket_name, blob_path, new_blob_path)
+    tracing.set_attribute("path", new_blob_path)
+    _cache_invalidate(bucket_name, new_blob_path)
 
     # 元を削除
-    blob.delete()
+    backend.delete(bucket_name, blob_path)
+    _cache_invalidate(bucket_name, blob_path)
 
     print(f"Moved: {gcs_uri} → gs://{bucket_name}/{new_blob_path}")
 
@@ -167,11 +477,10 @@ def move_and_cleanup(gcs_uri, target_prefix, new_filename):
     return f"gs://{bucket_name}/{new_blob_path}"
 
 
+@tracing.traced("gcs.list_images")
 def list_images_in_folder(bucket_name: str, folder_prefix: str):
-    bucket = client.bucket(bucket_name)
-    
     # 指定フォルダ（プレフィックス）のファイルを取得
-    blobs = bucket.list_blobs(prefix=folder_prefix)
+    blobs = _backend().list(bucket_name, folder_prefix)
     
     # 拡張子が画像のものだけを抽出
     images = [
@@ -200,16 +509,14 @@ def list_images_in_folder(bucket_name: str, folder_prefix: str):
     return [candidates[n][1] for n in sorted(candidates.keys())]
 
 
+@tracing.traced("gcs.list_scene_versions")
 def get_latest_version_file(project_folder):
-    client = storage.Client()
-    bucket = client.bucket(BUCKET_NAME)
-
     # 指定prefixで始まるファイルを取得
-    blobs = bucket.list_blobs(prefix = f"{project_folder}json/")
+    blobs = _backend().list(BUCKET_NAME, f"{project_folder}json/")
 
     # バージョン番号を抽出して管理
     versioned_files = []
-    pattern = re.compile(rf"^{"scene_akakura_en"}(?:_v(\d+))?\.json$")
+    pattern = re.compile(r"^scene_akakura_en(?:_v(\d+))?\.json$")
 
     for blob in blobs:
         filename = blob.name.split("/")[-1]  # ファイル名のみ
@@ -1,68 +1,385 @@
 import requests
 import base64
+import clients
 import gcs_utils
+import hashlib
 import os
 import json
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from cachetools import LRUCache
+import imageio_ffmpeg as ffmpeg
+import make_bgm_prompt
+import metrics
+import retry
+import tracing
+import workspace
+from google.api_core.exceptions import PreconditionFailed
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request
+from requests.adapters import HTTPAdapter
 
 
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 URL = os.getenv("URL")
+BGM_WORKERS = int(os.getenv("BGM_WORKERS", "2"))
+# "aac" にすると bgm.m4a も作り、最終マージで音声を再エンコードせずに使う
+BGM_RENDITION = os.getenv("BGM_RENDITION", "wav")
+# bgm.json の status=running がこれより古ければ、生成していたプロセスが落ちたとみなして引き継ぐ
+BGM_STALE_SECONDS = float(os.getenv("BGM_STALE_SECONDS", "900"))
+# 別のワーカー/インスタンスが生成中の BGM を待つ間隔と上限
+BGM_POLL_SECONDS = float(os.getenv("BGM_POLL_SECONDS", "5"))
+BGM_WAIT_SECONDS = float(os.getenv("BGM_WAIT_SECONDS", "900"))
+
+# 応答を読み込む単位 (バイト)
+RESPONSE_CHUNK_BYTES = 64 * 1024
+
+# 1 回の生成に 1〜2 分かかるので、期限は 2〜3 回分
+LYRIA_RETRY = retry.RetryPolicy(
+    "lyria", max_attempts=3, base_delay=2, max_delay=20,
+    deadline=float(os.getenv("LYRIA_DEADLINE_SECONDS", "600")), breaker_name="lyria",
+)
+
+
+class _Base64FieldDecoder:
+    """
+    JSON の応答を先頭から少しずつ読みながら、最初に現れる "key": "<base64>" の値だけをデコードする。
+    応答全体も base64 文字列もメモリに載せずに済む (Lyria の応答の predictions[0] の音声を取り出す用)。
+    """
+
+    def __init__(self, key):
+        self._marker = f'"{key}"'.encode("ascii")
+        self._buffer = b""
+        self._pending = b""  # 4 文字に満たない base64 の端数
+        self._state = "key"  # key → quote → value → done
+        self.done = False
+
+    def feed(self, chunk):
+        """chunk を読み、デコードできた分のバイト列を返す"""
+        self._buffer += chunk
+        if self._state == "key":
+            index = self._buffer.find(self._marker)
+            if index < 0:
+                # キーが chunk の境目で切れている場合に備えて末尾だけ残す
+                self._buffer = self._buffer[-(len(self._marker) - 1):]
+                return b""
+            self._buffer = self._buffer[index + len(self._marker):]
+            self._state = "quote"
+        if self._state == "quote":
+            index = self._buffer.find(b'"')
+            if index < 0:
+                return b""
+            if self._buffer[:index].strip() != b":":
+                raise ValueError("音声データの値が文字列ではありません")
+            self._buffer = self._buffer[index + 1:]
+            self._state = "value"
+        if self._state != "value":
+            return b""
+
+        end = self._buffer.find(b'"')
+        value = self._buffer if end < 0 else self._buffer[:end]
+        self._buffer = b""
+        # JSON では "/" が "\/" とエスケープされることがある (base64 に他のエスケープは現れない)
+        value = self._pending + value.replace(b"\\", b"")
+        if end < 0:
+            usable = len(value) - len(value) % 4
+            self._pending = value[usable:]
+            value = value[:usable]
+        else:
+            self._pending = b""
+            self._state = "done"
+            self.done = True
+        return base64.b64decode(value, validate=True)
+
+    def finish(self):
+        if not self.done:
+            raise ValueError("応答に音声データがありません (または途中で切れています)")
+
+
+class LyriaClient:
+    """
+    Lyria の REST エンドポイント用クライアント。
+    アクセストークンは期限が近づくまで使い回し、HTTP 接続は keep-alive のセッションで再利用する。
+    再試行は LYRIA_RETRY で行う (urllib3 側では再試行しない)。
+    """
+
+    def __init__(self, url=URL, connect_timeout=10, read_timeout=300):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self._credentials = None
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=BGM_WORKERS + 2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def access_token(self):
+        with self._lock:
+            if self._credentials is None:
+                key_json_str = os.environ.get("VERTEX_KEY_JSON")
+                if not key_json_str:
+                    raise RuntimeError("環境変数 VERTEX_KEY_JSON が設定されていません")
+
+                key_dict = json.loads(key_json_str)
+                self._credentials = service_account.Credentials.from_service_account_info(
+                    key_dict,
+                    scopes=["https://www.googleapis.com/auth/cloud-platform"]
+                )
+
+            credentials = self._credentials
+            # valid は期限の少し前から False になる (google.auth の refresh の余裕込み)
+            if not credentials.valid:
+                credentials.refresh(Request(self.session))
+            return credentials.token
+
+    def generate(self, prompt, negative_prompt, output_path):
+        """
+        音声を生成して output_path に書き出す。成功すれば True を返す。
+        応答は全体を読み込まずに少しずつ読みながら base64 をデコードして一時ファイルに書き込み、
+        最後まで書けたときだけ output_path に置き換える (途中で失敗したファイルは残さない)。
+        """
+        headers = {
+            "Authorization": f"Bearer {self.access_token()}",
+            "Content-Type": "application/json"
+        }
+        data = {
+            "instances": [
+                {
+                    "prompt": prompt,
+                    "negative_prompt": negative_prompt,
+                    "seed": 98765
+                }
+            ],
+            "parameters": {}
+        }
+
+        def call(attempt):
+            with tracing.span("model.lyria", kind="lyria", attempt=attempt, prompt_chars=len(prompt)) as span:
+                # 読み込みのタイムアウトは再試行の期限の残りで打ち切る
+                timeout = (self.timeout[0], retry.timeout(self.timeout[1]))
+                with self.session.post(self.url, headers=headers, json=data, timeout=timeout, stream=True) as response:
+                    span.set("status_code", response.status_code)
+                    if response.status_code != 200:
+                        print("エラー:", response.text)
+                        # HTTPError の status_code で 429 / 5xx だけ再試行する
+                        response.raise_for_status()
+
+                    decoder = _Base64FieldDecoder("bytesBase64Encoded")
+                    tmp_path = output_path + ".part"
+                    try:
+                        with open(tmp_path, "wb") as f:
+                            for chunk in response.iter_content(chunk_size=RESPONSE_CHUNK_BYTES):
+                                f.write(decoder.feed(chunk))
+                                if decoder.done:
+                                    break
+                        decoder.finish()
+                        os.replace(tmp_path, output_path)
+                    except Exception:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+                        raise
+                span.set("response_bytes", os.path.getsize(output_path))
+
+        try:
+            LYRIA_RETRY.call(call)
+        except Exception as e:
+            print("エラー:", e)
+            return False
+        return True
+
+
+def get_client():
+    return clients.get("lyria", LyriaClient)
 
 
 def get_access_token():
-    key_json_str = os.environ.get("VERTEX_KEY_JSON")
-    if not key_json_str:
-        raise RuntimeError("環境変数 VERTEX_KEY_JSON が設定されていません")
-
-    key_dict = json.loads(key_json_str)
-    credentials = service_account.Credentials.from_service_account_info(
-        key_dict,
-        scopes=["https://www.googleapis.com/auth/cloud-platform"]
-    )
-    credentials.refresh(Request())
-    return credentials.token
-
-
-def lyria(project_folder, prompt, negative_prompt):
-    token = get_access_token()
-    
-    # ヘッダー
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
-    # リクエストボディ
-    data = {
-        "instances": [
-            {
-                "prompt": prompt,
-                "negative_prompt": negative_prompt,
-                "seed": 98765
-            }
-        ],
-        "parameters": {}
-    }
-
-    # POSTリクエスト送信
-    response = requests.post(URL, headers=headers, json=data)
-
-    if response.status_code == 200:
-        # JSONにパース
-        response_json = response.json()
-
-        # Base64の音声データを抽出
-        audio_b64 = response_json["predictions"][0]["bytesBase64Encoded"]
-        audio_bytes = base64.b64decode(audio_b64)
-
-        # 音声ファイルとして保存 (wav想定)
-        with open("bgm.wav", "wb") as f:
-            f.write(audio_bytes)
-        print("音声ファイルを 'bgm.wav' として保存しました")
+    return get_client().access_token()
+
+
+def transcode_aac(wav_path, output_path):
+    """最終マージ用に WAV を AAC (m4a) に変換する"""
+    cmd = [
+        ffmpeg.get_ffmpeg_exe(),
+        "-y",
+        "-i", wav_path,
+        "-vn",
+        "-c:a", "aac",
+        "-b:a", "192k",
+        output_path,
+    ]
+    with tracing.span("ffmpeg", op="transcode_aac") as span:
+        subprocess.run(cmd, check=True)
+        span.set("output_bytes", os.path.getsize(output_path))
+    return output_path
+
+
+def lyria(project_folder, prompt, negative_prompt, output_path="bgm.wav", gcs_path=None):
+    # 失敗したときは書きかけのファイルが無いので、アップロードもしない
+    if get_client().generate(prompt, negative_prompt, output_path):
+        print(f"音声ファイルを '{output_path}' として保存しました")
         
-        gcs_utils.upload_to_gcs(BUCKET_NAME, "bgm.wav", project_folder + "result/bgm.wav")
+        gcs_utils.upload_to_gcs(BUCKET_NAME, output_path, gcs_path or project_folder + "result/bgm.wav")
+
+
+# ===== ストーリー確定直後からの BGM 先行生成 =====
+# 同じプロジェクトの BGM を複数のワーカー/インスタンスで重複して生成しないよう、bgm.json に状態を持つ。
+#   {"status": "running", "story_hash": ..., "started_at": ...}  生成中 (generation 条件付きで書けたプロセスが担当)
+#   {"status": "done", "story_hash": ..., "rendition": ...}      生成済み (担当の書いた running のままの時だけ書く)
+#   {"status": "failed", "story_hash": ..., "error": ...}        失敗 (次に必要になったプロセスが生成し直す)
+# project_folder -> (story_hash, Future)  このプロセスで生成中のもの
+_bgm_jobs = {}
+_bgm_lock = threading.Lock()
+# project_folder -> Lock  GCS の確認と担当の取得はプロジェクトごとに直列化する (他のプロジェクトは待たせない)
+# 追い出されて同じプロジェクトのロックが 2 つできても、bgm.json の条件付き書き込みで担当は 1 つに決まる
+_bgm_project_locks = LRUCache(maxsize=1024)
+_bgm_executor = ThreadPoolExecutor(max_workers=BGM_WORKERS, thread_name_prefix="bgm")
+
+
+def _story_en_path(project_folder):
+    return project_folder + "json/story_script_akakura_en.json"
+
+
+def _bgm_meta_path(project_folder):
+    return project_folder + "result/bgm.json"
+
+
+def story_hash(project_folder):
+    """英語ストーリー JSON の内容ハッシュ (BGM の再生成要否の判定に使う)"""
+    story = gcs_utils.read_json(BUCKET_NAME, _story_en_path(project_folder))
+    canonical = json.dumps(story, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _bgm_state(meta, digest):
+    """bgm.json の内容から、ストーリー digest の BGM が "done" / "running" / None (未生成か失敗) のどれかを返す"""
+    if meta is None or meta.get("story_hash") != digest:
+        return None
+    status = meta.get("status")
+    if status == "done":
+        return "done"
+    if status == "running" and time.time() - meta.get("started_at", 0) < BGM_STALE_SECONDS:
+        return "running"
+    return None
+
+
+def _claim_bgm(project_folder, digest):
+    """
+    BGM の状態を返す: "done" (生成済み) / "running" (他で生成中) / "claimed" (このプロセスで生成する)。
+    "claimed" のときは status=running を書いた generation も返す (完了時の条件付き書き込みに使う)。
+    """
+    meta, generation = gcs_utils.read_json_versioned(BUCKET_NAME, _bgm_meta_path(project_folder))
+    state = _bgm_state(meta, digest)
+    if state is not None:
+        return state, None
+    marker = {"status": "running", "story_hash": digest, "started_at": time.time()}
+    try:
+        generation = gcs_utils.write_json(
+            BUCKET_NAME, marker, _bgm_meta_path(project_folder), if_generation_match=generation
+        )
+    except PreconditionFailed:
+        # 読んでから書くまでの間に別のプロセスが担当になった
+        return "running", None
+    return "claimed", generation
+
+
+def _finish_bgm(project_folder, meta, claim_generation):
+    """担当した時の running のままなら bgm.json を meta で置き換える (新しいストーリーの生成が始まっていれば書かない)"""
+    try:
+        gcs_utils.write_json(BUCKET_NAME, meta, _bgm_meta_path(project_folder), if_generation_match=claim_generation)
+    except PreconditionFailed:
+        print(f"BGM の結果を破棄しました (別の生成が始まっています): {project_folder}")
+        return False
+    return True
+
+
+@tracing.traced("bgm.generate")
+def _generate_project_bgm(project_folder, digest, claim_generation):
+    print(f"create_bgm start ({project_folder})")
+    # ストーリーごとに別名で保存し、古いストーリーの生成が後から終わっても新しい BGM を上書きしない
+    stem = f"bgm_{digest[:16]}"
+    rendition = stem + ".wav"
+    try:
+        prompt = make_bgm_prompt.make_prompt(BUCKET_NAME, _story_en_path(project_folder))
+        print(prompt)
+        with workspace.job_workspace() as work_dir:
+            bgm_path = os.path.join(work_dir, "bgm.wav")
+            lyria(project_folder, prompt, "", bgm_path, project_folder + "result/" + rendition)
+            if not os.path.exists(bgm_path):
+                raise RuntimeError("Lyria で BGM を生成できませんでした")
+            if BGM_RENDITION == "aac":
+                m4a_path = transcode_aac(bgm_path, os.path.join(work_dir, "bgm.m4a"))
+                gcs_utils.upload_to_gcs(BUCKET_NAME, m4a_path, project_folder + "result/" + stem + ".m4a")
+                rendition = stem + ".m4a"
+    except Exception as e:
+        # 待っている他のプロセスが期限切れまで待ち続けないよう、失敗を書いておく
+        _finish_bgm(project_folder, {"status": "failed", "story_hash": digest, "error": str(e)}, claim_generation)
+        raise
+    # 音声のアップロード後に done を書くので、done であれば BGM は揃っている
+    _finish_bgm(project_folder, {"status": "done", "story_hash": digest, "rendition": rendition}, claim_generation)
+    print(f"create_bgm end ({project_folder})")
+
+
+def schedule_bgm(project_folder):
+    """
+    英語ストーリーから BGM をバックグラウンドで生成し、その Future を返す。
+    同じストーリーの BGM が既にあるか、別のワーカー/インスタンスで生成中なら None を返す。
+    """
+    digest = story_hash(project_folder)
+    with _bgm_lock:
+        project_lock = _bgm_project_locks.get(project_folder)
+        if project_lock is None:
+            project_lock = _bgm_project_locks[project_folder] = threading.Lock()
+    with project_lock:
+        with _bgm_lock:
+            job = _bgm_jobs.get(project_folder)
+        if job is not None and job[0] == digest and not (job[1].done() and job[1].exception()):
+            return job[1]
+        state, claim_generation = _claim_bgm(project_folder, digest)
+        if state != "claimed":
+            return None
+        future = _bgm_executor.submit(
+            metrics.queued("bgm", tracing.wrap(_generate_project_bgm)), project_folder, digest, claim_generation
+        )
+        with _bgm_lock:
+            _bgm_jobs[project_folder] = (digest, future)
+        # 最終処理まで進まないプロジェクトの分も残らないよう、終わったら外す
+        future.add_done_callback(lambda done: _forget_bgm_job(project_folder, done))
+        return future
+
+
+def _forget_bgm_job(project_folder, future):
+    with _bgm_lock:
+        job = _bgm_jobs.get(project_folder)
+        if job is not None and job[1] is future:
+            del _bgm_jobs[project_folder]
+
+
+def fetch_bgm(project_folder, local_dir):
+    """
+    プロジェクトの BGM を local_dir にダウンロードしてそのパスを返す。
+    生成中なら (別のワーカーやインスタンスでも) 完了を待ち、無い (またはストーリーが変わった) 場合はここで生成する。
+    """
+    deadline = retry.Deadline(BGM_WAIT_SECONDS)
+    while True:
+        future = schedule_bgm(project_folder)
+        if future is not None:
+            try:
+                future.result(timeout=deadline.remaining())
+            except FutureTimeoutError:
+                raise TimeoutError(f"BGM の生成を待ちきれませんでした: {project_folder}") from None
+
+        meta, _ = gcs_utils.read_json_versioned(BUCKET_NAME, _bgm_meta_path(project_folder))
+        if _bgm_state(meta, story_hash(project_folder)) == "done":
+            break
+        if deadline.expired():
+            raise TimeoutError(f"BGM の生成を待ちきれませんでした: {project_folder}")
+        time.sleep(min(BGM_POLL_SECONDS, deadline.remaining()))
 
-    else:
-        print("エラー:", response.text)
\ No newline at end of file
+    rendition = meta["rendition"]
+    local_path = os.path.join(local_dir, rendition)
+    gcs_utils.download_file(BUCKET_NAME, project_folder + "result/" + rendition, local_path)
+    return local_path
@@ -1,20 +1,14 @@
-from google.cloud import aiplatform
-from vertexai.preview.vision_models import ImageGenerationModel
+import clients
 import gcs_utils
-import os
+import image_cache
+import tracing
 
 
-GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
-GOOGLE_CLOUD_REGION = os.getenv("GOOGLE_CLOUD_REGION")
-
-
-def init_vertex():
-    aiplatform.init(project=GOOGLE_CLOUD_PROJECT, location=GOOGLE_CLOUD_REGION)
+IMAGEN_MODEL = "imagen-4.0-generate-001"
 
 
 def generate_image(bucket_name, prompt: str, output_path: str, user_input_ja_path):
-    init_vertex()
-    model = ImageGenerationModel.from_pretrained("imagen-4.0-generate-001")
+    model = clients.imagen_model(IMAGEN_MODEL)
     
     aspect_ratio = gcs_utils.read_json(bucket_name, user_input_ja_path).get("format")
     
@@ -25,17 +19,28 @@ def generate_image(bucket_name, prompt: str, output_path: str, user_input_ja_pat
         
     negative_prompt = "multipul angle, split view, two shot, grid view"
 
-    # 画像生成
-    result = model.generate_images(
-        prompt=prompt,
-        negative_prompt=negative_prompt,  
-        number_of_images=1,
-        aspect_ratio=aspect_ratio,
-        add_watermark=False
-    )
+    # 同じ条件で生成済みならキャッシュを使う (キャラクター画像は参照用なので縮小版は作らない)
+    cache_key = image_cache.cache_key(IMAGEN_MODEL, prompt, negative_prompt, aspect_ratio)
+    if image_cache.lookup(bucket_name, cache_key, output_path, preview=False):
+        print(f"Image saved to: {output_path}")
+        return
 
-    img = result[0]
-
-    gcs_utils.upload_image(bucket_name, img, output_path)
+    # 画像生成
+    with tracing.span(
+        "model.generate_images", kind="imagen", model=IMAGEN_MODEL, target="character", prompt_chars=len(prompt)
+    ) as span:
+        result = model.generate_images(
+            prompt=prompt,
+            negative_prompt=negative_prompt,  
+            number_of_images=1,
+            aspect_ratio=aspect_ratio,
+            add_watermark=False
+        )
+
+        img = result[0]
+        span.set("response_bytes", len(img._image_bytes))
+
+    gcs_utils.upload_image(bucket_name, img, output_path, preview=False)
+    image_cache.store(bucket_name, cache_key, img._image_bytes)
 
     print(f"Image saved to: {output_path}")
\ No newline at end of file
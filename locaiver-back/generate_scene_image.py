@@ -1,83 +1,86 @@
-from google import genai
+import os
 from PIL import Image
 from io import BytesIO
+import clients
 import gcs_utils
-import os
-import time
-from google.genai import errors
-from google.cloud import aiplatform
-from vertexai.preview.vision_models import ImageGenerationModel
-import gcs_utils
-import os
-import time
+import image_cache
+import retry
+import tracing
+
 
+GEMINI_IMAGE_MODEL = "gemini-2.5-flash-image-preview"
+IMAGEN_MODEL = "imagen-4.0-generate-001"
+# 1 枚あたりの再試行の期限 (秒)。これを超えて待つより失敗を返してユーザーに再実行してもらう
+IMAGE_DEADLINE_SECONDS = float(os.getenv("IMAGE_DEADLINE_SECONDS", "120"))
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
-GOOGLE_CLOUD_REGION = os.getenv("GOOGLE_CLOUD_REGION")
+GEMINI_IMAGE_RETRY = retry.RetryPolicy(
+    "gemini_image", max_attempts=5, base_delay=2, max_delay=20, deadline=IMAGE_DEADLINE_SECONDS,
+    breaker_name=f"genai:{GEMINI_IMAGE_MODEL}",
+)
+IMAGEN_RETRY = retry.RetryPolicy(
+    "imagen", max_attempts=5, base_delay=2, max_delay=20, deadline=IMAGE_DEADLINE_SECONDS,
+    breaker_name=f"vertex:{IMAGEN_MODEL}",
+)
 
 
 # キャラクターあり
 def safe_generate_image(bucket_name, prompt, read_img_path, output_directory, i, save_img_name):
 
-    client = genai.Client(api_key=GOOGLE_API_KEY)
-    image = gcs_utils.read_image(bucket_name, read_img_path)
-
-    max_retries = 7
-    attempt = 0
-    success = False
-    backoff = 2
+    client = clients.genai_client()
+    reference_bytes = gcs_utils.read_bytes(bucket_name, read_img_path)
+    image = Image.open(BytesIO(reference_bytes))
 
     if not output_directory.endswith('/'):
         output_directory += '/'
 
-    while attempt < max_retries and not success:
-        attempt += 1
-        print(f"Attempt {attempt}...", flush=True)
+    # 同じプロンプトと参照画像で生成済みならキャッシュを使う
+    save_path = output_directory + f"{save_img_name}_{i + 1}.png"
+    cache_key = image_cache.cache_key(
+        GEMINI_IMAGE_MODEL, prompt, reference_digest=image_cache.digest(reference_bytes)
+    )
+    if image_cache.lookup(bucket_name, cache_key, save_path):
+        return save_path
 
-        try:
+    def generate(attempt):
+        print(f"Attempt {attempt}...", flush=True)
+        with tracing.span(
+            "model.generate_content", kind="gemini_image", model=GEMINI_IMAGE_MODEL, attempt=attempt,
+            prompt_chars=len(prompt), reference_bytes=len(reference_bytes),
+        ):
             response = client.models.generate_content(
-                model="gemini-2.5-flash-image-preview",
+                model=GEMINI_IMAGE_MODEL,
                 contents=[prompt, image],
             )
-
-            image_generated = False
             for part in response.candidates[0].content.parts:
                 if part.inline_data is not None:
-                    image_obj = Image.open(BytesIO(part.inline_data.data))
-                    save_image_name_individual = f"{save_img_name}_{i + 1}.png"
-                    save_path = output_directory + save_image_name_individual
-                    gcs_utils.upload_image(bucket_name, image_obj, save_path)
-                    print(f"Saved image {save_image_name_individual}", flush=True)
-                    image_generated = True
-
-            if image_generated:
-                success = True
-            else:
-                print(f"No image returned, retrying in {backoff}s...", flush=True)
-                time.sleep(backoff)
-                backoff *= 2
-
-        except (errors.ServerError, Exception) as e:
-            print(f"Error: {e}, retrying in {backoff}s...", flush=True)
-            time.sleep(backoff)
-            backoff *= 2
-
-    if not success:
-        raise RuntimeError("Failed to generate image after maximum retries")
+                    return part.inline_data
+            # テキストだけが返ることがあるので、もう一度生成する
+            raise retry.RetryableError("no image returned")
+
+    try:
+        inline_data = GEMINI_IMAGE_RETRY.call(generate)
+    except Exception as e:
+        raise RuntimeError(f"Failed to generate image after retries: {e}") from e
+
+    if inline_data.mime_type == "image/png":
+        # PNG ならデコードせずそのままアップロード
+        image_bytes = inline_data.data
+    else:
+        # Veo に image/png として渡すので、それ以外の形式は PNG に変換する
+        buffer = BytesIO()
+        Image.open(BytesIO(inline_data.data)).save(buffer, format="PNG")
+        image_bytes = buffer.getvalue()
+    gcs_utils.upload_image(bucket_name, image_bytes, save_path)
+    image_cache.store(bucket_name, cache_key, image_bytes)
+    print(f"Saved image {save_img_name}_{i + 1}.png", flush=True)
 
     return save_path
 
 
-# キャラクターなし
-def init_vertex():
-    aiplatform.init(project=GOOGLE_CLOUD_PROJECT, location=GOOGLE_CLOUD_REGION)
-
 # キャラクターなし
 def safe_generate_image_no_character(bucket_name, prompt, output_directory, i, save_img_name, user_input_ja_path):
 
-    init_vertex()
-    model = ImageGenerationModel.from_pretrained("imagen-4.0-generate-001")
+    model = clients.imagen_model(IMAGEN_MODEL)
 
     # アスペクト比を JSON から取得
     aspect_ratio = gcs_utils.read_json(bucket_name, user_input_ja_path).get("format")
@@ -90,21 +93,21 @@ def safe_generate_image_no_character(bucket_name, prompt, output_directory, i, s
 
     negative_prompt = "collage, split screen, border, frame, duplicate, child, children"
 
-    max_retries = 7
-    attempt = 0
-    success = False
-    backoff = 2
-
     if not output_directory.endswith('/'):
         output_directory += '/'
 
-    save_path = None
+    save_path = output_directory + f"{save_img_name}_{i + 1}.png"
 
-    while attempt < max_retries and not success:
-        attempt += 1
-        print(f"Attempt {attempt}...", flush=True)
+    # 同じ条件で生成済みならキャッシュを使う
+    cache_key = image_cache.cache_key(IMAGEN_MODEL, prompt, negative_prompt, aspect_ratio)
+    if image_cache.lookup(bucket_name, cache_key, save_path):
+        return save_path
 
-        try:
+    def generate(attempt):
+        print(f"Attempt {attempt}...", flush=True)
+        with tracing.span(
+            "model.generate_images", kind="imagen", model=IMAGEN_MODEL, attempt=attempt, prompt_chars=len(prompt)
+        ) as span:
             result = model.generate_images(
                 prompt=prompt,
                 negative_prompt=negative_prompt,
@@ -112,24 +115,22 @@ def safe_generate_image_no_character(bucket_name, prompt, output_directory, i, s
                 aspect_ratio=aspect_ratio,
                 add_watermark=False
             )
-
             # 1枚だけ生成するので result[0]
-            img = result[0]
-
-            save_image_name_individual = f"{save_img_name}_{i + 1}.png"
-            save_path = output_directory + save_image_name_individual
-
-            gcs_utils.upload_image(bucket_name, img, save_path)
-            print(f"Saved image {save_image_name_individual}", flush=True)
-
-            success = True
-
-        except Exception as e:
-            print(f"Error: {e}, retrying in {backoff}s...", flush=True)
-            time.sleep(backoff)
-            backoff *= 2
-
-    if not success:
-        raise RuntimeError("Failed to generate image with Imagen after maximum retries")
+            try:
+                img = result[0]
+            except IndexError:
+                # 安全フィルタで除外されると空で返る。同じプロンプトでは結果が変わらないので再試行しない
+                raise ValueError("Imagen returned no image (filtered)")
+            span.set("response_bytes", len(img._image_bytes))
+            return img
+
+    try:
+        img = IMAGEN_RETRY.call(generate)
+    except Exception as e:
+        raise RuntimeError(f"Failed to generate image with Imagen after retries: {e}") from e
+
+    gcs_utils.upload_image(bucket_name, img, save_path)
+    image_cache.store(bucket_name, cache_key, img._image_bytes)
+    print(f"Saved image {save_img_name}_{i + 1}.png", flush=True)
 
     return save_path
\ No newline at end of file
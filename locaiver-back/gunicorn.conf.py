@@ -0,0 +1,9 @@
+import os
+
+
+def child_exit(server, worker):
+    # PROMETHEUS_MULTIPROC_DIR を使う場合、終了したワーカーのゲージを集計から外す
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import clients
+import gcs_utils
+
+
+# 生成画像のコンテンツアドレス型キャッシュ。
+# (モデル, 最終プロンプト, ネガティブプロンプト, アスペクト比, 参照画像のハッシュ) が同じなら
+# 生成をやり直さず、キャッシュ済みの画像を保存先にコピーする。
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "1") == "1"
+IMAGE_CACHE_PREFIX = "_cache/images/"
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+IMAGE_CACHE_MAX_AGE_DAYS = float(os.getenv("IMAGE_CACHE_MAX_AGE_DAYS", "30"))
+# この回数 store() するごとにバックグラウンドで作成の古いエントリを掃除する
+EVICT_EVERY = 50
+
+_store_count = 0
+_evict_lock = threading.Lock()
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(model, prompt, negative_prompt="", aspect_ratio="", reference_digest=""):
+    payload = json.dumps(
+        [model, prompt, negative_prompt or "", aspect_ratio or "", reference_digest or ""],
+        ensure_ascii=False,
+    )
+    return digest(payload.encode("utf-8"))
+
+
+def _cache_path(key):
+    return f"{IMAGE_CACHE_PREFIX}{key[:2]}/{key}.png"
+
+
+def lookup(bucket_name, key, save_path, preview=True):
+    """キャッシュにあれば save_path に保存して True を返す"""
+    if not IMAGE_CACHE_ENABLED:
+        return False
+    try:
+        gcs_utils.copy_image(bucket_name, _cache_path(key), save_path, preview=preview)
+    except Exception:
+        return False
+    print(f"[IMAGE CACHE] hit {key[:12]} -> {save_path}", flush=True)
+    return True
+
+
+def store(bucket_name, key, image_bytes):
+    """生成した画像をキャッシュに登録する (失敗しても生成結果には影響させない)"""
+    global _store_count
+    if not IMAGE_CACHE_ENABLED:
+        return
+    try:
+        gcs_utils.upload_image(bucket_name, image_bytes, _cache_path(key), preview=False)
+    except Exception as e:
+        print(f"[IMAGE CACHE] store failed: {e}", flush=True)
+        return
+
+    with _evict_lock:
+        _store_count += 1
+        run_evict = _store_count % EVICT_EVERY == 0
+    if run_evict:
+        threading.Thread(target=evict, args=(bucket_name,), daemon=True).start()
+
+
+def evict(bucket_name):
+    """
+    期限切れのエントリを消し、合計サイズが上限を超えていれば作成の古い順 (FIFO) に消す。
+    ヒットしても updated は更新しないので、よく使われるエントリでも作成が古ければ消える (LRU ではない)。
+    """
+    backend = clients.storage_backend()
+    blobs = sorted(backend.list(bucket_name, IMAGE_CACHE_PREFIX), key=lambda blob: blob.updated or 0)
+    cutoff = time.time() - IMAGE_CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+    total = sum(blob.size or 0 for blob in blobs)
+
+    removed = 0
+    for blob in blobs:
+        expired = blob.updated is not None and blob.updated < cutoff
+        if not expired and total <= IMAGE_CACHE_MAX_BYTES:
+            break
+        try:
+            backend.delete(bucket_name, blob.name)
+        except Exception as e:
+            print(f"[IMAGE CACHE] evict failed for {blob.name}: {e}", flush=True)
+            continue
+        total -= blob.size or 0
+        removed += 1
+
+    if removed:
+        print(f"[IMAGE CACHE] evicted {removed} entries", flush=True)
@@ -0,0 +1,312 @@
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import metrics
+import retry
+import tracing
+
+
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "2"))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "16"))
+JOB_STORE = os.getenv("JOB_STORE", "file")  # "memory" or "file"
+JOB_STORE_DIR = os.getenv("JOB_STORE_DIR", "/tmp/locaiver-jobs")
+# 終了したジョブの記録を残す時間。Cloud Run の /tmp はメモリ上にあるので溜め続けない
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", str(24 * 60 * 60)))
+JOB_CLEANUP_INTERVAL_SECONDS = float(os.getenv("JOB_CLEANUP_INTERVAL_SECONDS", "600"))
+FINISHED_STATUSES = ("succeeded", "failed")
+# ワーカーの再起動や gunicorn のタイムアウトで実行者を失ったジョブを失敗とみなすまでの時間
+# (期限の無いジョブは JOB_DEADLINE_SECONDS を期限とし、それに JOB_ORPHAN_GRACE_SECONDS の猶予を足す)
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "3600"))
+JOB_ORPHAN_GRACE_SECONDS = float(os.getenv("JOB_ORPHAN_GRACE_SECONDS", "600"))
+
+
+class JobQueueFull(RuntimeError):
+    """実行待ちジョブが上限に達している"""
+
+
+# ===== ジョブ状態の保存先 =====
+def _expired(job, now):
+    """終了してから JOB_TTL_SECONDS 以上たったジョブか"""
+    if job.get("status") not in FINISHED_STATUSES:
+        return False
+    return now - job.get("finished_at", job.get("updated_at", now)) > JOB_TTL_SECONDS
+
+
+def _orphaned(job, now):
+    """
+    実行者を失って queued / running のまま止まっているジョブか。
+    running は開始から期限+猶予、queued は前に並んだジョブが全部期限まで掛かった場合の時間+猶予を過ぎたもの。
+    """
+    limit = job.get("deadline") or JOB_DEADLINE_SECONDS
+    if job.get("status") == "running":
+        since = job.get("started_at", job.get("updated_at", now))
+    elif job.get("status") == "queued":
+        since = job.get("created_at", job.get("updated_at", now))
+        limit *= math.ceil(JOB_MAX_PENDING / JOB_MAX_WORKERS)
+    else:
+        return False
+    return now - since > limit + JOB_ORPHAN_GRACE_SECONDS
+
+
+def _mark_orphaned(job, now):
+    job["status"] = "failed"
+    job["error"] = "ジョブを実行していたワーカーが停止したため中断されました"
+    job["finished_at"] = now
+    job["updated_at"] = now
+
+
+class _Cleanup:
+    """put のついでに、JOB_CLEANUP_INTERVAL_SECONDS に 1 回だけ期限切れのジョブを消す"""
+
+    def __init__(self):
+        self._next_cleanup = 0.0
+        self._cleanup_lock = threading.Lock()
+
+    def _maybe_cleanup(self):
+        now = time.time()
+        if now < self._next_cleanup or not self._cleanup_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_cleanup = now + JOB_CLEANUP_INTERVAL_SECONDS
+            removed = self.cleanup(now)
+            if removed:
+                print(f"[JOB] removed {removed} expired jobs", flush=True)
+        except Exception as e:
+            print(f"[JOB] cleanup failed: {e}", flush=True)
+        finally:
+            self._cleanup_lock.release()
+
+
+class InMemoryJobStore(_Cleanup):
+    """プロセス内の dict にジョブ状態を保持する (単一ワーカー向け)"""
+
+    def __init__(self):
+        super().__init__()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def put(self, job):
+        with self._lock:
+            self._jobs[job["job_id"]] = json.loads(json.dumps(job))
+        self._maybe_cleanup()
+
+    def update(self, job_id, fn):
+        with self._lock:
+            job = self._jobs[job_id]
+            fn(job)
+            job["updated_at"] = time.time()
+
+    def cleanup(self, now):
+        with self._lock:
+            for job in self._jobs.values():
+                if _orphaned(job, now):
+                    _mark_orphaned(job, now)
+            expired = [job_id for job_id, job in self._jobs.items() if _expired(job, now)]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return len(expired)
+
+
+class FileJobStore(_Cleanup):
+    """
+    ローカルファイルにジョブ状態を保持する (同一インスタンスの全ワーカーから参照可能)。
+    インスタンスをまたいでは共有されないので、/jobs/<job_id> のポーリングはセッションアフィニティが前提。
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, job_id):
+        # job_id はファイル名として使うので英数字とハイフンのみ許可
+        if not job_id or not all(c.isalnum() or c == "-" for c in job_id):
+            raise KeyError(job_id)
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def get(self, job_id):
+        try:
+            with open(self._path(job_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (KeyError, FileNotFoundError):
+            return None
+
+    def put(self, job):
+        path = self._path(job["job_id"])
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        # rename はアトミックなので読み手が書きかけのファイルを見ることはない
+        os.replace(tmp_path, path)
+        self._maybe_cleanup()
+
+    def update(self, job_id, fn):
+        # ジョブを更新するのは実行中のワーカー 1 つだけなのでプロセス内ロックで十分
+        with self._lock:
+            job = self.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            fn(job)
+            job["updated_at"] = time.time()
+            self.put(job)
+
+    def cleanup(self, now):
+        removed = 0
+        for entry in os.scandir(self.directory):
+            try:
+                # 最近更新されたものは期限切れでも実行者を失ったものでもないので、中身を読むまでもなく残す
+                if now - entry.stat().st_mtime <= min(JOB_TTL_SECONDS, JOB_ORPHAN_GRACE_SECONDS):
+                    continue
+                if entry.name.endswith(".tmp"):
+                    # 書き込み中に落ちたプロセスの残骸
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path, encoding="utf-8") as f:
+                    job = json.load(f)
+                if _orphaned(job, now):
+                    _mark_orphaned(job, now)
+                    self.put(job)
+                if _expired(job, now):
+                    os.remove(entry.path)
+                    removed += 1
+            except (FileNotFoundError, ValueError):
+                # 別のワーカーが先に消した / 書き換え中
+                continue
+        return removed
+
+
+def _make_store():
+    if JOB_STORE == "memory":
+        return InMemoryJobStore()
+    if JOB_STORE == "file":
+        return FileJobStore(JOB_STORE_DIR)
+    raise RuntimeError(f"未対応の JOB_STORE です: {JOB_STORE}")
+
+
+store = _make_store()
+executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix="job")
+_pending = threading.BoundedSemaphore(JOB_MAX_PENDING)
+
+
+# ===== ジョブ実行中の進捗報告 =====
+class JobContext:
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def _set_stage(self, name, **fields):
+        def apply(job):
+            for stage in job["stages"]:
+                if stage["name"] == name:
+                    stage.update(fields)
+                    return
+            job["stages"].append({"name": name, **fields})
+        store.update(self.job_id, apply)
+
+    @contextmanager
+    def stage(self, name):
+        """with ブロックの間を 1 ステージとして running → done/failed を記録する"""
+        self._set_stage(name, status="running", started_at=time.time())
+        try:
+            with tracing.span(f"stage.{name}", job_id=self.job_id):
+                yield
+        except Exception as e:
+            self._set_stage(name, status="failed", finished_at=time.time(), error=str(e))
+            raise
+        self._set_stage(name, status="done", finished_at=time.time())
+
+    def skip(self, name):
+        self._set_stage(name, status="skipped")
+
+
+class NullJobContext:
+    """同期 API から呼ぶ時の何もしない進捗報告"""
+
+    @contextmanager
+    def stage(self, name):
+        with tracing.span(f"stage.{name}"):
+            yield
+
+    def skip(self, name):
+        tracing.set_attribute(f"skipped.{name}", True)
+
+
+def _run(job_id, kind, project_folder, fn, args, deadline):
+    def mark_running(job):
+        job["status"] = "running"
+        job["started_at"] = time.time()
+
+    try:
+        store.update(job_id, mark_running)
+        with tracing.span(f"job.{kind}", job_id=job_id, project_folder=project_folder or None):
+            # 期限は待ち行列に入っていた時間を含めず、実行を始めた時点から数える
+            with retry.budget(deadline):
+                result = fn(JobContext(job_id), *args)
+    except Exception as e:
+        print(f"[JOB] {job_id} failed: {e}", flush=True)
+        # except の変数はブロックを抜けると消えるので、クロージャには文字列を渡す
+        error = str(e)
+
+        def mark_failed(job):
+            job["status"] = "failed"
+            job["error"] = error
+            job["finished_at"] = time.time()
+        store.update(job_id, mark_failed)
+    else:
+        def mark_succeeded(job):
+            job["status"] = "succeeded"
+            job["result"] = result
+            job["finished_at"] = time.time()
+        store.update(job_id, mark_succeeded)
+    finally:
+        _pending.release()
+
+
+def submit(kind, stages, fn, *args, project_folder="", deadline=None):
+    """
+    fn(job_context, *args) をバックグラウンドで実行し job_id を返す。
+    stages は進捗表示用に事前登録するステージ名のリスト。
+    deadline は実行開始からの期限 (秒)。中の再試行はこれを超えて待たない。
+    """
+    if not _pending.acquire(blocking=False):
+        raise JobQueueFull("実行待ちのジョブが多すぎます")
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    store.put({
+        "job_id": job_id,
+        "kind": kind,
+        "project_folder": project_folder,
+        "status": "queued",
+        "stages": [{"name": name, "status": "pending"} for name in stages],
+        "result": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+        "deadline": deadline,
+    })
+    try:
+        executor.submit(metrics.queued(kind, tracing.wrap(_run)), job_id, kind, project_folder, fn, args, deadline)
+    except Exception:
+        _pending.release()
+        raise
+    print(f"[JOB] {kind} submitted: {job_id}", flush=True)
+    return job_id
+
+
+def get(job_id):
+    job = store.get(job_id)
+    if job is not None and _orphaned(job, time.time()):
+        # 掃除を待たずに、ポーリングしている側へ失敗を返す
+        _mark_orphaned(job, time.time())
+    return job
@@ -0,0 +1,172 @@
+import json
+import re
+import clients
+import tracing
+
+
+# 出力が壊れていた時に修復に使う軽量モデル
+REPAIR_MODEL = "gemini-2.5-flash"
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+
+
+# 空配列の要素のように、まだ型が決まっていない箇所の目印
+_UNKNOWN = {"type": "unknown"}
+
+
+def schema_from_example(value):
+    """
+    JSON の値から構造化出力用のスキーマを作る (翻訳のように入力と同じ形を返させたい時に使う)。
+    Gemini が扱えない形 (空のオブジェクト等) を含む場合は None を返す。
+    """
+    schema = _schema_of(value)
+    return _resolve_unknown(schema) if schema is not None else None
+
+
+def _schema_of(value):
+    if isinstance(value, bool):
+        return {"type": "boolean"}
+    if isinstance(value, int):
+        return {"type": "integer"}
+    if isinstance(value, float):
+        return {"type": "number"}
+    if isinstance(value, str) or value is None:
+        return {"type": "string"}
+    if isinstance(value, list):
+        items = [_schema_of(item) for item in value]
+        if any(item is None for item in items):
+            return None
+        item_schema = _merge_schemas(items)
+        if item_schema is None:
+            return None
+        return {"type": "array", "items": item_schema}
+    if isinstance(value, dict):
+        if not value:
+            return None
+        properties = {}
+        for key, item in value.items():
+            schema = _schema_of(item)
+            if schema is None:
+                return None
+            properties[key] = schema
+        return {"type": "object", "properties": properties, "required": list(value)}
+    return None
+
+
+def _merge_schemas(schemas):
+    """配列の各要素のスキーマを 1 つにまとめる (オブジェクトはキーを合わせ、全要素にあるキーだけ必須にする)"""
+    schemas = [schema for schema in schemas if schema is not _UNKNOWN]
+    if not schemas:
+        return _UNKNOWN
+    first = schemas[0]
+    if any(schema["type"] != first["type"] for schema in schemas):
+        return None
+    if first["type"] == "array":
+        items = _merge_schemas([schema["items"] for schema in schemas])
+        return {"type": "array", "items": items} if items is not None else None
+    if first["type"] != "object":
+        return first
+
+    properties = {}
+    for schema in schemas:
+        for key, prop in schema["properties"].items():
+            properties.setdefault(key, []).append(prop)
+    merged = {}
+    for key, props in properties.items():
+        prop = _merge_schemas(props)
+        if prop is None:
+            return None
+        merged[key] = prop
+    required = [key for key in merged if all(key in schema["required"] for schema in schemas)]
+    return {"type": "object", "properties": merged, "required": required}
+
+
+def _resolve_unknown(schema):
+    """型が決まらなかった箇所は文字列として扱う"""
+    if schema is _UNKNOWN:
+        return {"type": "string"}
+    if schema["type"] == "array":
+        return {"type": "array", "items": _resolve_unknown(schema["items"])}
+    if schema["type"] == "object":
+        return {
+            "type": "object",
+            "properties": {key: _resolve_unknown(prop) for key, prop in schema["properties"].items()},
+            "required": schema["required"],
+        }
+    return schema
+
+
+def extract_json(text):
+    """
+    モデルの出力から JSON を取り出す。
+    コードフェンスや前後の説明文があっても、最初の { か [ から始まる JSON を読み取る。
+    """
+    if text is None:
+        raise ValueError("出力が空です")
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    candidates = [match.group(1).strip() for match in _FENCE.finditer(text)] + [text]
+    decoder = json.JSONDecoder()
+    for candidate in candidates:
+        for start, char in enumerate(candidate):
+            if char in "{[":
+                try:
+                    value, _ = decoder.raw_decode(candidate, start)
+                    return value
+                except ValueError:
+                    continue
+    raise ValueError("出力から JSON を読み取れませんでした")
+
+
+def repair_json(text, schema=None):
+    """壊れた JSON を軽量モデルで修復する"""
+    prompt = f"""
+    以下のテキストは JSON として出力されるはずでしたが、構文が壊れています。
+    内容は変えずに、有効な JSON に修正して JSON だけを出力してください。
+
+    テキスト:
+    ---
+    {text}
+    ---
+    """
+    generation_config = {"response_mime_type": "application/json", "temperature": 0.0}
+    if schema is not None:
+        generation_config["response_schema"] = schema
+    model = clients.generative_model(REPAIR_MODEL)
+    with tracing.span("model.generate_content", kind="repair", model=REPAIR_MODEL, prompt_chars=len(prompt)) as span:
+        response = model.generate_content(prompt, generation_config=generation_config)
+        span.set("response_chars", len(response.text or ""))
+    return extract_json(response.text)
+
+
+def generate_json(model, prompt, schema=None, kind="json"):
+    """
+    構造化出力モード (JSON + スキーマ) で生成し、パースした値を返す。
+    万一パースできなければ軽量モデルで修復を試み、それでも駄目なら例外を出す。
+    kind はトレース上の呼び出し種別 (story, scene, translate 等)。
+    """
+    generation_config = {"response_mime_type": "application/json"}
+    if schema is not None:
+        generation_config["response_schema"] = schema
+    with tracing.span(
+        "model.generate_content", kind=kind, model=getattr(model, "model_name", None), prompt_chars=len(prompt)
+    ) as span:
+        response = model.generate_content(prompt, generation_config=generation_config)
+        text = response.text
+        span.set("response_chars", len(text or ""))
+
+    try:
+        return extract_json(text)
+    except ValueError:
+        print("AIの出力をJSONとしてパースできませんでした。修復を試みます。生テキストを表示します:")
+        print(text)
+
+    try:
+        return repair_json(text, schema)
+    except Exception as e:
+        print("JSONの修復に失敗しました:", e)
+        raise
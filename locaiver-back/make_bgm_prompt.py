@@ -1,14 +1,9 @@
-import google.generativeai as genai
-import os
+import clients
 import gcs_utils
-
-
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+import tracing
 
 
 def make_prompt(bucket_name, input_path):
-    genai.configure(api_key=GOOGLE_API_KEY)
-
     data = gcs_utils.read_json(bucket_name, input_path)
     
     story_text = data["story"]
@@ -38,7 +33,9 @@ def make_prompt(bucket_name, input_path):
     """
 
     # 4. モデルを指定して呼び出し
-    model = genai.GenerativeModel("gemini-2.5-pro")
-    response = model.generate_content(prompt)
+    model = clients.generative_model("gemini-2.5-pro")
+    with tracing.span("model.generate_content", kind="bgm_prompt", model="gemini-2.5-pro", prompt_chars=len(prompt)) as span:
+        response = model.generate_content(prompt)
+        span.set("response_chars", len(response.text or ""))
 
     return response.text
\ No newline at end of file
@@ -0,0 +1,134 @@
+import functools
+import os
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+import tracing
+
+
+# gunicorn の複数ワーカー分を合算する場合に設定する (gunicorn.conf.py も参照)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# モデル呼び出しや ffmpeg は数百 ms 〜 数分、GCS は数 ms 〜 数十秒
+SLOW_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "locaiver_http_request_seconds", "エンドポイントごとの処理時間",
+    ["endpoint", "status"], buckets=SLOW_BUCKETS,
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "locaiver_http_requests_in_flight", "処理中のリクエスト数", multiprocess_mode="livesum",
+)
+STAGE_SECONDS = Histogram(
+    "locaiver_stage_seconds", "絵コンテ生成の各ステージの所要時間",
+    ["stage", "status"], buckets=SLOW_BUCKETS,
+)
+MODEL_CALL_SECONDS = Histogram(
+    "locaiver_model_call_seconds", "モデル呼び出し 1 回の所要時間",
+    ["kind", "model", "status"], buckets=SLOW_BUCKETS,
+)
+MODEL_CALL_FAILURES = Counter(
+    "locaiver_model_call_failures_total", "失敗したモデル呼び出しの数 (reason=throttled はクォータ超過)",
+    ["kind", "reason"],
+)
+MODEL_CALL_RETRIES = Counter(
+    "locaiver_model_call_retries_total", "再試行として行われたモデル呼び出しの数",
+    ["kind"],
+)
+CIRCUIT_BREAKER_EVENTS = Counter(
+    "locaiver_circuit_breaker_events_total", "サーキットブレーカーの状態変化と拒否した呼び出しの数 (event=opened/closed/rejected)",
+    ["endpoint", "event"],
+)
+GCS_REQUESTS = Counter("locaiver_gcs_requests_total", "gcs_utils の呼び出し数", ["op", "status"])
+GCS_BYTES = Counter("locaiver_gcs_bytes_total", "gcs_utils で読み書きしたバイト数", ["op"])
+GCS_SECONDS = Histogram("locaiver_gcs_request_seconds", "gcs_utils の呼び出しの所要時間", ["op"], buckets=FAST_BUCKETS)
+FFMPEG_SECONDS = Histogram("locaiver_ffmpeg_seconds", "ffmpeg の実行時間", ["op", "status"], buckets=SLOW_BUCKETS)
+GCS_READ_CACHE = Counter(
+    "locaiver_gcs_read_cache_total", "gcs_utils の読み込みキャッシュの参照数 (result=hit/miss)", ["result"],
+)
+# キャッシュはワーカーごとに持つので、使用量は生きているワーカーの合計、上限はその最大値
+GCS_READ_CACHE_ENTRIES = Gauge(
+    "locaiver_gcs_read_cache_entries", "gcs_utils の読み込みキャッシュのエントリ数", multiprocess_mode="livesum",
+)
+GCS_READ_CACHE_BYTES = Gauge(
+    "locaiver_gcs_read_cache_bytes", "gcs_utils の読み込みキャッシュの使用量", multiprocess_mode="livesum",
+)
+GCS_READ_CACHE_MAX_BYTES = Gauge(
+    "locaiver_gcs_read_cache_max_bytes", "gcs_utils の読み込みキャッシュの上限", multiprocess_mode="livemax",
+)
+BACKGROUND_JOBS = Gauge(
+    "locaiver_background_jobs", "バックグラウンド処理の数 (state=queued/running)",
+    ["kind", "state"], multiprocess_mode="livesum",
+)
+
+
+def _failure_reason(error):
+    text = error or ""
+    if "429" in text or "RESOURCE_EXHAUSTED" in text or "ResourceExhausted" in text or "TooManyRequests" in text:
+        return "throttled"
+    if "Timeout" in text or "DEADLINE_EXCEEDED" in text or "DeadlineExceeded" in text:
+        return "timeout"
+    return "error"
+
+
+class MetricsExporter:
+    """終了したスパンをメトリクスに反映する (計測はトレースと共通なので、呼び出し側に追加の処理は無い)"""
+
+    def export(self, span):
+        attributes = span.attributes
+        kind = attributes.get("kind")
+        name = span.name
+
+        if name.startswith("model.") or name == "veo.render":
+            kind = kind or name.split(".", 1)[1]
+            MODEL_CALL_SECONDS.labels(kind, attributes.get("model", ""), span.status).observe(span.duration)
+            if span.status == "error":
+                MODEL_CALL_FAILURES.labels(kind, _failure_reason(span.error)).inc()
+            # attempt は呼び出しの再試行、render_attempt は Veo のレンダリングのやり直し (どちらかが 2 回目以降なら再試行)
+            if max(attributes.get("attempt", 1), attributes.get("render_attempt", 1)) > 1:
+                MODEL_CALL_RETRIES.labels(kind).inc()
+        elif name.startswith("gcs."):
+            op = name[4:]
+            GCS_REQUESTS.labels(op, span.status).inc()
+            GCS_SECONDS.labels(op).observe(span.duration)
+            if attributes.get("bytes"):
+                GCS_BYTES.labels(op).inc(attributes["bytes"])
+        elif name == "ffmpeg":
+            FFMPEG_SECONDS.labels(attributes.get("op", ""), span.status).observe(span.duration)
+        elif kind == "http":
+            HTTP_REQUEST_SECONDS.labels(name, str(attributes.get("status_code", 500))).observe(span.duration)
+        elif name.startswith("stage."):
+            STAGE_SECONDS.labels(name[6:], span.status).observe(span.duration)
+
+
+def queued(kind, fn):
+    """
+    キューに入れる関数を包んで、待ち/実行中の数をゲージに反映する。
+    包んだ時点で queued、実行が始まると running として数える。
+    """
+    BACKGROUND_JOBS.labels(kind, "queued").inc()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        BACKGROUND_JOBS.labels(kind, "queued").dec()
+        BACKGROUND_JOBS.labels(kind, "running").inc()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            BACKGROUND_JOBS.labels(kind, "running").dec()
+    return run
+
+
+def render():
+    """/metrics のレスポンス (本文, Content-Type) を返す"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+tracing.add_exporter(MetricsExporter())
@@ -0,0 +1,175 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import metrics
+import tracing
+
+
+MIN_POLL_INTERVAL = float(os.getenv("VEO_MIN_POLL_INTERVAL", "2"))
+MAX_POLL_INTERVAL = float(os.getenv("VEO_MAX_POLL_INTERVAL", "15"))
+MAX_POLL_ERRORS = 5
+
+# duration_seconds ごとの Veo のおおよその生成所要時間 (秒)
+EXPECTED_RENDER_SECONDS = {4: 50, 6: 65, 8: 80}
+
+
+def expected_render_seconds(duration_seconds):
+    return EXPECTED_RENDER_SECONDS.get(duration_seconds, 80)
+
+
+def next_poll_interval(elapsed, expected):
+    """
+    経過時間と想定所要時間から次のポーリングまでの待ち時間を決める。
+    - 想定の半分までは完了しないので、半分の時点まで間隔を空ける
+    - 想定の前後は完了直後に気付けるよう短い間隔で確認する
+    - 想定を大きく超えたら徐々に間隔を広げる
+    """
+    if elapsed < expected * 0.5:
+        return min(max(expected * 0.5 - elapsed, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+    if elapsed < expected * 1.5:
+        return MIN_POLL_INTERVAL
+    overdue = elapsed - expected * 1.5
+    return min(MIN_POLL_INTERVAL + overdue * 0.1, MAX_POLL_INTERVAL)
+
+
+class _Entry:
+    def __init__(self, client, operation, expected, callback):
+        self.client = client
+        self.operation = operation
+        self.expected = expected
+        self.callback = callback
+        self.started_at = time.monotonic()
+        self.errors = 0
+        self.polls = 0
+        self.future = Future()
+        self.finished = False
+        # 投入から完了までを 1 スパンにする (呼び出し元のスパンの子になる)
+        self.span = tracing.Span("veo.render", tracing.current(), {"kind": "veo_render", "expected_seconds": expected})
+
+    def finish(self, operation=None, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.span.set("polls", self.polls)
+        if operation is not None and getattr(operation, "error", None):
+            self.span.record_error(RuntimeError(str(operation.error)))
+        self.span.finish(error=error)
+        metrics.BACKGROUND_JOBS.labels("veo", "running").dec()
+
+
+class OperationPoller:
+    """
+    genai_client.operations の長時間オペレーションを 1 スレッドでまとめて監視する。
+    track() は完了したオペレーションを結果に持つ Future を返す。
+    """
+
+    def __init__(self, callback_workers=4):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._callbacks = ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix="veo-callback")
+
+    def track(self, client, operation, expected_seconds, callback=None):
+        """
+        operation を監視対象に追加する。
+        callback(operation) は完了時に別スレッドで呼ばれる (失敗時は呼ばれない)。
+        """
+        entry = _Entry(client, operation, expected_seconds, callback)
+        metrics.BACKGROUND_JOBS.labels("veo", "running").inc()
+        first_poll = next_poll_interval(0, expected_seconds)
+        with self._cond:
+            self._ensure_thread()
+            heapq.heappush(self._heap, (time.monotonic() + first_poll, next(self._seq), entry))
+            self._cond.notify()
+        return entry.future
+
+    def wait(self, client, operation, expected_seconds, timeout=None):
+        """監視対象に追加して完了まで待つ。timeout 秒で完了しなければ監視をやめて TimeoutError を送出する"""
+        future = self.track(client, operation, expected_seconds)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.untrack(future)
+            raise TimeoutError(f"Veo のオペレーションが {timeout:.0f} 秒以内に完了しませんでした") from None
+
+    def untrack(self, future):
+        """track() の Future の監視をやめる (次に確認する時にキューから外す)"""
+        future.cancel()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _ensure_thread(self):
+        # gunicorn の fork 後にも動くよう、最初の track() でスレッドを起動する
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="veo-poller", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                due_at, _, entry = self._heap[0]
+                delay = due_at - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(timeout=delay)
+                    continue
+                heapq.heappop(self._heap)
+
+            # 1 件の処理で例外が出てもポーラーのスレッドは止めず、その Future だけ失敗させる
+            try:
+                self._poll(entry)
+            except Exception as e:
+                print(f"オペレーションの監視中にエラーが発生しました: {e}", flush=True)
+                self._fail(entry, e)
+
+    def _fail(self, entry, error):
+        try:
+            entry.finish(error=error)
+        except Exception as e:
+            print(f"スパンの記録に失敗しました: {e}", flush=True)
+        try:
+            entry.future.set_exception(error)
+        except InvalidStateError:
+            # 既に完了しているか、待ち手が監視を打ち切った
+            pass
+
+    def _poll(self, entry):
+        if entry.future.cancelled():
+            entry.finish(error=TimeoutError("監視を打ち切りました"))
+            return
+        entry.polls += 1
+        try:
+            entry.operation = entry.client.operations.get(entry.operation)
+            entry.errors = 0
+        except Exception as e:
+            entry.errors += 1
+            print(f"オペレーションの状態取得に失敗しました ({entry.errors}/{MAX_POLL_ERRORS}): {e}", flush=True)
+            if entry.errors >= MAX_POLL_ERRORS:
+                self._fail(entry, e)
+                return
+
+        if entry.operation.done:
+            entry.finish(entry.operation)
+            entry.future.set_result(entry.operation)
+            if entry.callback is not None:
+                self._callbacks.submit(entry.callback, entry.operation)
+            return
+
+        elapsed = time.monotonic() - entry.started_at
+        with self._cond:
+            heapq.heappush(
+                self._heap,
+                (time.monotonic() + next_poll_interval(elapsed, entry.expected), next(self._seq), entry),
+            )
+
+
+# プロセス全体で共有するポーラー
+poller = OperationPoller()
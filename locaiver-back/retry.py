@@ -0,0 +1,260 @@
+import contextvars
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+import requests
+import metrics
+
+
+# モデル呼び出しや GCS 操作の再試行を共通化する。
+# - 1 回の呼び出し全体に期限 (deadline 秒) を設け、次の待ち時間が残りを超えるなら諦める
+# - 待ち時間は full jitter (0〜base*2^n の一様乱数) で、同時に失敗したスレッドが一斉に再試行しないようにする
+# - 一時的なエラー (429 / 5xx / タイムアウト / 接続断) だけ再試行し、不正なプロンプトや認証エラーはすぐに返す
+# - 呼び出し先ごとのサーキットブレーカーで、障害中は待たずに失敗させてスレッドが滞留しないようにする
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# 一時的なエラーとみなす HTTP ステータス
+RETRYABLE_HTTP_STATUS = frozenset([408, 429, 500, 502, 503, 504])
+# 一時的なエラーとみなす gRPC のステータス (長時間オペレーションの error.code)
+# 4=DEADLINE_EXCEEDED, 8=RESOURCE_EXHAUSTED, 10=ABORTED, 13=INTERNAL, 14=UNAVAILABLE
+RETRYABLE_GRPC_STATUS = frozenset([4, 8, 10, 13, 14])
+# ステータスが取れない例外の判定用
+RETRYABLE_MARKERS = (
+    "429", "RESOURCE_EXHAUSTED", "ResourceExhausted", "TooManyRequests", "UNAVAILABLE", "ServiceUnavailable",
+    "DEADLINE_EXCEEDED", "DeadlineExceeded", "Timeout", "timed out", "Connection reset", "Connection aborted",
+)
+
+
+class RetryableError(Exception):
+    """応答はあったが使えなかった (画像が返らない等) ので、もう一度呼べば成功しうる"""
+
+
+class CircuitOpenError(RuntimeError):
+    """呼び出し先が障害中とみなされているので呼び出さずに失敗した"""
+
+
+class BudgetExhausted(TimeoutError):
+    """再試行の期限を使い切った"""
+
+
+def _status_code(error):
+    """HTTP ステータスを取り出す (google.api_core / google.genai / requests の例外に対応)"""
+    response = getattr(error, "response", None)
+    for value in (getattr(error, "code", None), getattr(response, "status_code", None)):
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable(error):
+    """再試行して意味のあるエラーか"""
+    if isinstance(error, RetryableError):
+        return True
+    if isinstance(error, (CircuitOpenError, BudgetExhausted)):
+        return False
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # requests の接続エラー/タイムアウトは組み込みの ConnectionError/TimeoutError ではない (RequestException は IOError の派生)
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_HTTP_STATUS
+    # ステータスが取れない例外は文言で判定する
+    text = f"{type(error).__name__}: {error}"
+    return any(marker in text for marker in RETRYABLE_MARKERS)
+
+
+def is_retryable_status(grpc_code):
+    """長時間オペレーションの error.code (gRPC のステータス) が一時的なものか"""
+    return grpc_code in RETRYABLE_GRPC_STATUS
+
+
+def backoff(attempt, base_delay, max_delay):
+    """attempt 回目の失敗の後に待つ秒数 (full jitter)"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+# ===== 期限 =====
+_deadline = contextvars.ContextVar("retry_deadline", default=None)
+
+
+class Deadline:
+    """
+    seconds 秒後の期限。外側に期限 (リクエスト単位の budget や実行中の RetryPolicy.call) があれば、
+    それより後にはならないように切り詰める。
+    """
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+        outer = _deadline.get()
+        if outer is not None and outer.expires_at is not None:
+            if self.expires_at is None or outer.expires_at < self.expires_at:
+                self.expires_at = outer.expires_at
+
+    def remaining(self):
+        if self.expires_at is None:
+            return float("inf")
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def start_budget(seconds):
+    """以降の処理全体の期限を設定し、end_budget に渡すトークンを返す (Flask の before_request 等で使う)"""
+    return _deadline.set(Deadline(seconds))
+
+
+def end_budget(token):
+    _deadline.reset(token)
+
+
+@contextmanager
+def budget(seconds):
+    """with の中で呼ぶ RetryPolicy.call や Deadline の期限を seconds 秒以内に収める"""
+    token = start_budget(seconds)
+    try:
+        yield
+    finally:
+        end_budget(token)
+
+
+def remaining():
+    """実行中の期限の残り秒数 (期限が無ければ None)。別プロセスに期限を引き継ぐ時に使う"""
+    deadline = _deadline.get()
+    if deadline is None or deadline.expires_at is None:
+        return None
+    return deadline.remaining()
+
+
+def timeout(default):
+    """実行中の RetryPolicy.call の残り時間で default を打ち切った値 (HTTP のタイムアウト等に使う)"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    return max(1.0, min(default, deadline.remaining()))
+
+
+# ===== サーキットブレーカー =====
+class CircuitBreaker:
+    """
+    一時的なエラーが threshold 回続いたら reset_seconds の間は呼び出しを拒否する。
+    その後 1 回だけ試しに通し、成功すれば元に戻し、失敗すればまた止める。
+    """
+
+    def __init__(self, name, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "open":
+                wait = self._opened_at + self.reset_seconds - time.monotonic()
+                if wait > 0:
+                    metrics.CIRCUIT_BREAKER_EVENTS.labels(self.name, "rejected").inc()
+                    raise CircuitOpenError(f"{self.name} は障害中のため呼び出しを止めています (あと {wait:.0f} 秒)")
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._trial_in_flight:
+                    metrics.CIRCUIT_BREAKER_EVENTS.labels(self.name, "rejected").inc()
+                    raise CircuitOpenError(f"{self.name} は復旧を確認中です")
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"[CIRCUIT] {self.name} closed", flush=True)
+                metrics.CIRCUIT_BREAKER_EVENTS.labels(self.name, "closed").inc()
+            self.state = "closed"
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._trial_in_flight = False
+            self._failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self._failures >= self.threshold):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                print(f"[CIRCUIT] {self.name} opened after {self._failures} failures", flush=True)
+                metrics.CIRCUIT_BREAKER_EVENTS.labels(self.name, "opened").inc()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name):
+    """呼び出し先 (モデルのエンドポイント等) ごとに 1 つのブレーカーを返す"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+# ===== 再試行ポリシー =====
+class RetryPolicy:
+    """
+    fn(attempt) を成功するまで呼ぶ。attempt は 1 から始まる試行回数。
+    max_attempts 回失敗するか、deadline 秒の期限内に次の試行を始められなければ最後のエラーを送出する。
+    """
+
+    def __init__(self, name, max_attempts=5, base_delay=1.0, max_delay=30.0, deadline=None,
+                 breaker_name=None, retryable=is_retryable):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker_name = breaker_name
+        self.retryable = retryable
+
+    def call(self, fn, deadline=None):
+        budget = Deadline(deadline if deadline is not None else self.deadline)
+        circuit = breaker(self.breaker_name) if self.breaker_name else None
+        token = _deadline.set(budget)
+        try:
+            if budget.expired():
+                raise BudgetExhausted(f"{self.name}: 呼び出す前に期限を使い切っています")
+            attempt = 0
+            while True:
+                attempt += 1
+                if circuit is not None:
+                    circuit.before_call()
+                try:
+                    result = fn(attempt)
+                except Exception as e:
+                    retryable = self.retryable(e)
+                    if circuit is not None:
+                        # 4xx や「画像が返らない」は呼び出し先が動いている証拠なので障害として数えない
+                        if retryable and not isinstance(e, RetryableError):
+                            circuit.record_failure()
+                        else:
+                            circuit.record_success()
+                    if not retryable:
+                        raise
+                    if attempt >= self.max_attempts:
+                        print(f"[RETRY] {self.name} gave up after {attempt} attempts: {e}", flush=True)
+                        raise
+                    delay = backoff(attempt, self.base_delay, self.max_delay)
+                    if delay >= budget.remaining():
+                        print(f"[RETRY] {self.name} deadline exhausted after {attempt} attempts: {e}", flush=True)
+                        raise BudgetExhausted(f"{self.name}: 期限内に成功しませんでした ({attempt} 回試行)") from e
+                    print(f"[RETRY] {self.name} attempt {attempt} failed: {e}; retrying in {delay:.1f}s", flush=True)
+                    time.sleep(delay)
+                else:
+                    if circuit is not None:
+                        circuit.record_success()
+                    return result
+        finally:
+            _deadline.reset(token)
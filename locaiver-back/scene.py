@@ -1,16 +1,53 @@
-import os
-import json
-import google.generativeai as genai
+import clients
 import gcs_utils
-
-
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+import llm_json
+
+
+# ===== 構造化出力のスキーマ =====
+SCENES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "scenes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "scene_id": {"type": "integer"},
+                    "depiction": {"type": "string"},
+                    "composition": {
+                        "type": "object",
+                        "properties": {
+                            "camera_angle": {"type": "string"},
+                            "view": {"type": "string"},
+                            "focal_length": {"type": "string"},
+                            "lighting": {"type": "string"},
+                            "focus": {"type": "string"},
+                        },
+                        "required": ["camera_angle", "view", "focal_length", "lighting", "focus"],
+                    },
+                    "dialogue": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "character": {"type": "string"},
+                                "line": {"type": "string"},
+                            },
+                            "required": ["character", "line"],
+                        },
+                    },
+                    "other_information": {"type": "string"},
+                },
+                "required": ["scene_id", "depiction", "composition", "dialogue", "other_information"],
+            },
+        },
+    },
+    "required": ["scenes"],
+}
 
 
 def generate_scenes_from_story(bucket_name, story_ja_path, scene_ja_path): 
     
-    genai.configure(api_key=GOOGLE_API_KEY)
-
     scene_data = gcs_utils.read_json(bucket_name, story_ja_path)
 
     # 物語の本文（storyキーを想定）
@@ -71,20 +108,9 @@ def generate_scenes_from_story(bucket_name, story_ja_path, scene_ja_path):
     """
 
     # 4. モデルを指定して呼び出し
-    model = genai.GenerativeModel("gemini-2.5-pro")
-    response = model.generate_content(PROMPT)
-
-    # 5. 応答を取得
-    text = response.text
-
-    # JSONとしてパースできるよう整形
-    try:
-        cleaned = text.strip().strip("```").replace("json", "").strip()
-        scenes_json = json.loads(cleaned)
-    except Exception as e:
-        print("AIの出力をJSONとしてパースできませんでした。生テキストを表示します:")
-        print(text)
-        raise e
+    model = clients.generative_model("gemini-2.5-pro")
+    # 5. 構造化出力モードで生成し、JSONとして受け取る
+    scenes_json = llm_json.generate_json(model, PROMPT, SCENES_SCHEMA, kind="scene")
 
     # 6. 結果をファイルに保存
     # gcsに保存
@@ -96,11 +122,19 @@ def generate_scenes_from_story(bucket_name, story_ja_path, scene_ja_path):
 
 
 def fix_slected_scene_from_story(bucket_name, scene_id, story_ja_path, scene_ja_path, revision_count, revision_contents, project_folder):
+    return fix_selected_scenes_from_story(
+        bucket_name, {scene_id: revision_contents}, story_ja_path, scene_ja_path, revision_count, project_folder
+    )
+
+
+def fix_selected_scenes_from_story(bucket_name, revisions, story_ja_path, scene_ja_path, revision_count, project_folder):
+    """
+    複数シーンの修正を 1 回のモデル呼び出しでまとめて反映する。
+    revisions: {シーン番号(0始まり): 修正内容}
+    """
     
     output_path = project_folder + f"json/scene_akakura_ja_v{revision_count}.json"
 
-    genai.configure(api_key=GOOGLE_API_KEY)
-
     # 2. JSONファイルを読み込む
     # gcs_utilsの利用
     story_data = gcs_utils.read_json(bucket_name, story_ja_path)
@@ -111,15 +145,21 @@ def fix_slected_scene_from_story(bucket_name, scene_id, story_ja_path, scene_ja_
     if not story_text:
         raise ValueError("JSONに 'story' キーが見つかりません")
 
+    target_ids = "、".join(str(scene_id + 1) for scene_id in sorted(revisions))
+    revision_contents = "\n".join(
+        f"- scene_id {scene_id + 1}: {revisions[scene_id]}" for scene_id in sorted(revisions)
+    )
+
     # 3. AIへのプロンプトを作成
     PROMPT = f"""
-    あなたの役割は、入力されたJSONデータのうち、scene_id が {scene_id+1} のシーンを修正することです。  
+    あなたの役割は、入力されたJSONデータのうち、scene_id が {target_ids} のシーンを修正することです。  
 
     厳守事項:
     - 出力は入力JSON全体を返してください（修正対象以外のシーンもそのまま含めてください）。
     - JSON以外の文字、説明文、記号を絶対に含めないでください。
     - JSONの構造は保持してください。不要な削除や追加は行わず、必要な修正のみを加えてください。
     - 修正内容は「revision_contents」を解釈し、どのキーに対応するかを自律的に判断してください。
+    - revision_contents には scene_id ごとの修正内容が並んでいます。各修正はその scene_id のシーンにだけ反映してください。
     - 修正は物語全体の文脈を考慮し、一貫性を保ってください。
 
     入力JSON:
@@ -138,20 +178,9 @@ def fix_slected_scene_from_story(bucket_name, scene_id, story_ja_path, scene_ja_
     """
 
     # 4. モデルを指定して呼び出し
-    model = genai.GenerativeModel("gemini-2.5-pro")
-    response = model.generate_content(PROMPT)
-
-    # 5. 応答を取得
-    text = response.text
-
-    # JSONとしてパースできるよう整形
-    try:
-        cleaned = text.strip().strip("```").replace("json", "").strip()
-        scenes_json = json.loads(cleaned)
-    except Exception as e:
-        print("AIの出力をJSONとしてパースできませんでした。生テキストを表示します:")
-        print(text)
-        raise e
+    model = clients.generative_model("gemini-2.5-pro")
+    # 5. 構造化出力モードで生成し、JSONとして受け取る
+    scenes_json = llm_json.generate_json(model, PROMPT, SCENES_SCHEMA, kind="scene")
 
     # 6. 結果をファイルに保存
     # gcsに保存
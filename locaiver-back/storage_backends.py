@@ -0,0 +1,534 @@
+import contextlib
+import fcntl
+import glob
+import itertools
+import os
+import shutil
+import threading
+import time
+from urllib.parse import quote
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.api_core.retry import Retry
+import clients
+
+
+# gcs_utils が使うオブジェクトの保存先。
+# オブジェクトはどの実装でも GCS と同じ (バケット名, パス) で指定し、URI も gs://バケット/パス の形で扱う。
+# local / memory はベンチマークや開発用 (Veo は GCS 上の入出力しか扱えないので本番は gcs)。
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")  # "gcs" / "local" / "memory"
+STORAGE_LOCAL_DIR = os.getenv("STORAGE_LOCAL_DIR", "/tmp/locaiver-storage")
+# local の時に署名付き URL の代わりに返す URL の先頭 (未設定なら file:// の URL を返す)
+STORAGE_LOCAL_URL = os.getenv("STORAGE_LOCAL_URL")
+# 指定するとリモートの手前にローカルディスクの書き込みスルー層を置く。
+# Cloud Run の /tmp はメモリ上にあるので、上限はインスタンスのメモリに収まる値にする
+STORAGE_LOCAL_TIER_DIR = os.getenv("STORAGE_LOCAL_TIER_DIR")
+STORAGE_LOCAL_TIER_MAX_BYTES = int(os.getenv("STORAGE_LOCAL_TIER_MAX_BYTES", str(1024 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 256 KiB の倍数
+
+
+class ObjectInfo:
+    """オブジェクトのメタデータ (updated は UNIX 時刻の秒)"""
+
+    def __init__(self, name, generation, size, updated=None):
+        self.name = name
+        self.generation = generation
+        self.size = size
+        self.updated = updated
+
+
+def _check_path(bucket_name, path):
+    """ローカルに保存する実装用。project_folder はリクエストから来るので、保存先の外を指すパスは拒否する"""
+    if not bucket_name or "/" in bucket_name or bucket_name.startswith("."):
+        raise ValueError(f"不正なバケット名です: {bucket_name!r}")
+    if not path or path.startswith("/") or path.endswith("/") or any(part in (".", "..") for part in path.split("/")):
+        raise ValueError(f"不正なパスです: {path!r}")
+
+
+# ===== Cloud Storage =====
+class GCSBackend:
+    name = "gcs"
+
+    def _bucket(self, bucket_name):
+        return clients.storage_client().bucket(bucket_name)
+
+    @staticmethod
+    def _info(blob):
+        updated = blob.updated.timestamp() if blob.updated else None
+        return ObjectInfo(blob.name, blob.generation, blob.size, updated)
+
+    def stat(self, bucket_name, path):
+        blob = self._bucket(bucket_name).get_blob(path)
+        return self._info(blob) if blob is not None else None
+
+    def read(self, bucket_name, path, generation=None):
+        return self._bucket(bucket_name).blob(path).download_as_bytes(if_generation_match=generation)
+
+    def write(self, bucket_name, path, data, content_type=None, if_generation_match=None):
+        """書き込んだオブジェクトの generation を返す (if_generation_match=0 は存在しない時だけ作成)"""
+        blob = self._bucket(bucket_name).blob(path)
+        blob.upload_from_string(data, content_type=content_type, if_generation_match=if_generation_match)
+        return blob.generation
+
+    def upload_file(self, bucket_name, path, local_path, content_type=None):
+        # chunk_size を指定すると分割のレジューマブルアップロードになる
+        blob = self._bucket(bucket_name).blob(path, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.upload_from_filename(local_path, content_type=content_type)
+        return blob.generation
+
+    def download_file(self, bucket_name, path, local_path, generation=None):
+        self._bucket(bucket_name).blob(path).download_to_filename(local_path, if_generation_match=generation)
+
+    def copy(self, bucket_name, source_path, target_path):
+        bucket = self._bucket(bucket_name)
+        # rewrite ではなく copy_blob を使用。大きな動画のコピーは時間がかかるのでライブラリの再試行で最大 5 分待機
+        return bucket.copy_blob(bucket.blob(source_path), bucket, target_path, retry=Retry(deadline=300)).generation
+
+    def delete(self, bucket_name, path):
+        self._bucket(bucket_name).blob(path).delete()
+
+    def list(self, bucket_name, prefix):
+        return [self._info(blob) for blob in self._bucket(bucket_name).list_blobs(prefix=prefix)]
+
+    def list_prefixes(self, bucket_name, prefix):
+        """prefix の直下の "フォルダ" (末尾 / 付き) を返す"""
+        iterator = clients.storage_client().list_blobs(bucket_name, prefix=prefix, delimiter="/")
+        for _ in iterator.pages:
+            pass  # prefixes はページを読み進めると埋まる
+        return sorted(iterator.prefixes)
+
+    def signed_url(self, bucket_name, path, lifetime):
+        """サービスアカウントの秘密鍵でローカルに署名する"""
+        return self._bucket(bucket_name).blob(path).generate_signed_url(
+            version="v4",
+            expiration=lifetime,
+            method="GET",
+            credentials=clients.storage_credentials(),
+        )
+
+
+# ===== ローカルファイル =====
+class LocalBackend:
+    """
+    root/バケット名/パス にファイルとして保存する。generation はファイルの mtime (ナノ秒)。
+    書き込みはバケットごとのファイルロックの中で行うので、同じディレクトリを共有する複数ワーカーでも条件付き書き込みが効く。
+    """
+
+    name = "local"
+
+    def __init__(self, root, base_url=None):
+        self.root = root
+        self.base_url = base_url
+        self._tmp_dir = os.path.join(root, ".tmp")
+        self._lock_dir = os.path.join(root, ".locks")
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        os.makedirs(self._lock_dir, exist_ok=True)
+        self._thread_lock = threading.Lock()
+
+    def _path(self, bucket_name, path):
+        _check_path(bucket_name, path)
+        return os.path.join(self.root, bucket_name, *path.split("/"))
+
+    def _locked(self, bucket_name):
+        return _FileLock(os.path.join(self._lock_dir, f"{bucket_name}.lock"), self._thread_lock)
+
+    @staticmethod
+    def _generation(file_path):
+        try:
+            return os.stat(file_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _replace(self, file_path, fill):
+        """一時ファイルに fill(tmp_path) で書いてから置き換え、新しい generation を返す (ロック内で呼ぶ)"""
+        tmp_path = os.path.join(self._tmp_dir, f"{os.getpid()}.{threading.get_ident()}.tmp")
+        fill(tmp_path)
+        # mtime の分解能は粗いので、同じ時刻に 2 回書いても generation が変わるようにする
+        generation = max(time.time_ns(), (self._generation(file_path) or 0) + 1)
+        os.utime(tmp_path, ns=(generation, generation))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(tmp_path, file_path)
+        return generation
+
+    def stat(self, bucket_name, path):
+        file_path = self._path(bucket_name, path)
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return ObjectInfo(path, st.st_mtime_ns, st.st_size, st.st_mtime)
+
+    def read(self, bucket_name, path, generation=None):
+        file_path = self._path(bucket_name, path)
+        try:
+            with open(file_path, "rb") as f:
+                if generation is not None and os.fstat(f.fileno()).st_mtime_ns != generation:
+                    raise PreconditionFailed(f"gs://{bucket_name}/{path}: generation mismatch")
+                return f.read()
+        except FileNotFoundError:
+            raise NotFound(f"gs://{bucket_name}/{path} が見つかりません")
+
+    def write(self, bucket_name, path, data, content_type=None, if_generation_match=None):
+        file_path = self._path(bucket_name, path)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        def fill(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+        with self._locked(bucket_name):
+            if if_generation_match is not None and (self._generation(file_path) or 0) != if_generation_match:
+                raise PreconditionFailed(f"gs://{bucket_name}/{path}: generation mismatch")
+            return self._replace(file_path, fill)
+
+    def upload_file(self, bucket_name, path, local_path, content_type=None):
+        file_path = self._path(bucket_name, path)
+        with self._locked(bucket_name):
+            return self._replace(file_path, lambda tmp_path: shutil.copyfile(local_path, tmp_path))
+
+    def download_file(self, bucket_name, path, local_path, generation=None):
+        file_path = self._path(bucket_name, path)
+        if not os.path.exists(file_path):
+            raise NotFound(f"gs://{bucket_name}/{path} が見つかりません")
+        if generation is not None and self._generation(file_path) != generation:
+            raise PreconditionFailed(f"gs://{bucket_name}/{path}: generation mismatch")
+        shutil.copyfile(file_path, local_path)
+
+    def copy(self, bucket_name, source_path, target_path):
+        source = self._path(bucket_name, source_path)
+        target = self._path(bucket_name, target_path)
+        if not os.path.exists(source):
+            raise NotFound(f"gs://{bucket_name}/{source_path} が見つかりません")
+        with self._locked(bucket_name):
+            return self._replace(target, lambda tmp_path: shutil.copyfile(source, tmp_path))
+
+    def delete(self, bucket_name, path):
+        file_path = self._path(bucket_name, path)
+        bucket_dir = os.path.join(self.root, bucket_name)
+        with self._locked(bucket_name):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                raise NotFound(f"gs://{bucket_name}/{path} が見つかりません")
+            # GCS と同じく、空になった "フォルダ" は一覧に出さない
+            directory = os.path.dirname(file_path)
+            while directory != bucket_dir:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    def list(self, bucket_name, prefix):
+        bucket_dir = os.path.join(self.root, bucket_name)
+        folder = prefix.rpartition("/")[0]
+        start = os.path.join(bucket_dir, *folder.split("/")) if folder else bucket_dir
+        objects = []
+        for directory, _, files in os.walk(start):
+            relative = os.path.relpath(directory, bucket_dir).replace(os.sep, "/")
+            for filename in files:
+                name = filename if relative == "." else f"{relative}/{filename}"
+                if name.startswith(prefix):
+                    st = os.stat(os.path.join(directory, filename))
+                    objects.append(ObjectInfo(name, st.st_mtime_ns, st.st_size, st.st_mtime))
+        return sorted(objects, key=lambda info: info.name)
+
+    def list_prefixes(self, bucket_name, prefix):
+        folder, _, partial = prefix.rpartition("/")
+        directory = os.path.join(self.root, bucket_name, *folder.split("/")) if folder else os.path.join(self.root, bucket_name)
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            return []
+        with entries:
+            names = [entry.name for entry in entries if entry.is_dir() and entry.name.startswith(partial)]
+        return sorted(f"{folder}/{name}/" if folder else f"{name}/" for name in names)
+
+    def signed_url(self, bucket_name, path, lifetime):
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{bucket_name}/{quote(path)}"
+        return "file://" + quote(os.path.abspath(self._path(bucket_name, path)))
+
+
+class _FileLock:
+    """プロセス間 (flock) とスレッド間 (threading.Lock) の両方で排他する"""
+
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+        self._file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        except Exception:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+        finally:
+            self.thread_lock.release()
+
+
+# ===== メモリ =====
+class MemoryBackend:
+    """プロセス内の dict に保存する (単一ワーカーのベンチマーク向け)"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._objects = {}  # (bucket_name, path) -> (generation, data, updated)
+        self._lock = threading.Lock()
+        # gcs_utils の読み込みキャッシュは generation で判定するので、作り直しても重複しない値から始める
+        self._generations = itertools.count(time.time_ns() // 1000)
+
+    def _get(self, bucket_name, path):
+        with self._lock:
+            entry = self._objects.get((bucket_name, path))
+        if entry is None:
+            raise NotFound(f"gs://{bucket_name}/{path} が見つかりません")
+        return entry
+
+    def stat(self, bucket_name, path):
+        with self._lock:
+            entry = self._objects.get((bucket_name, path))
+        return ObjectInfo(path, entry[0], len(entry[1]), entry[2]) if entry is not None else None
+
+    def read(self, bucket_name, path, generation=None):
+        entry = self._get(bucket_name, path)
+        if generation is not None and entry[0] != generation:
+            raise PreconditionFailed(f"gs://{bucket_name}/{path}: generation mismatch")
+        return entry[1]
+
+    def write(self, bucket_name, path, data, content_type=None, if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self._lock:
+            current = self._objects.get((bucket_name, path))
+            if if_generation_match is not None and (current[0] if current else 0) != if_generation_match:
+                raise PreconditionFailed(f"gs://{bucket_name}/{path}: generation mismatch")
+            generation = next(self._generations)
+            self._objects[(bucket_name, path)] = (generation, bytes(data), time.time())
+            return generation
+
+    def upload_file(self, bucket_name, path, local_path, content_type=None):
+        with open(local_path, "rb") as f:
+            return self.write(bucket_name, path, f.read(), content_type)
+
+    def download_file(self, bucket_name, path, local_path, generation=None):
+        data = self.read(bucket_name, path, generation)
+        with open(local_path, "wb") as f:
+            f.write(data)
+
+    def copy(self, bucket_name, source_path, target_path):
+        return self.write(bucket_name, target_path, self._get(bucket_name, source_path)[1])
+
+    def delete(self, bucket_name, path):
+        with self._lock:
+            if self._objects.pop((bucket_name, path), None) is None:
+                raise NotFound(f"gs://{bucket_name}/{path} が見つかりません")
+
+    def list(self, bucket_name, prefix):
+        with self._lock:
+            items = [
+                (path, entry) for (bucket, path), entry in self._objects.items()
+                if bucket == bucket_name and path.startswith(prefix)
+            ]
+        return [ObjectInfo(path, entry[0], len(entry[1]), entry[2]) for path, entry in sorted(items, key=lambda item: item[0])]
+
+    def list_prefixes(self, bucket_name, prefix):
+        prefixes = set()
+        for info in self.list(bucket_name, prefix):
+            rest = info.name[len(prefix):]
+            if "/" in rest:
+                prefixes.add(prefix + rest.split("/", 1)[0] + "/")
+        return sorted(prefixes)
+
+    def signed_url(self, bucket_name, path, lifetime):
+        return f"memory://{bucket_name}/{quote(path)}"
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(len(entry[1]) for entry in self._objects.values())
+
+
+# ===== ローカルディスクの書き込みスルー層 =====
+class LocalDiskTier:
+    """
+    remote の手前に置くローカルディスクのキャッシュ。
+    書き込み・アップロード・ダウンロードした内容を directory/バケット名/パス@generation に保存し、
+    読み込みは generation が一致する時だけディスクから返す (generation の確認は呼び出し側か stat で毎回行う)。
+    同じインスタンスのワーカー間でディレクトリを共有でき、他のインスタンスが書き換えても古い内容は返さない。
+    """
+
+    def __init__(self, remote, directory, max_bytes):
+        self.remote = remote
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.name = f"{remote.name}+disk"
+        self._tmp_dir = os.path.join(directory, ".tmp")
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._added_bytes = 0
+
+    def _entry(self, bucket_name, path, generation):
+        _check_path(bucket_name, path)
+        return os.path.join(self.directory, bucket_name, *path.split("/")) + f"@{generation}"
+
+    def _hit(self, entry):
+        try:
+            # mtime を最終利用時刻として使う (古い順に追い出す)
+            os.utime(entry)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _store(self, bucket_name, path, generation, fill, size):
+        """ディスクに保存する。失敗してもリモートへの書き込み結果には影響させない"""
+        if generation is None or size > self.max_bytes:
+            return
+        try:
+            entry = self._entry(bucket_name, path, generation)
+            tmp_path = os.path.join(self._tmp_dir, f"{os.getpid()}.{threading.get_ident()}.tmp")
+            fill(tmp_path)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            os.replace(tmp_path, entry)
+            # 古い generation は二度と読まれないので消す
+            for old in glob.glob(glob.escape(entry.rpartition("@")[0]) + "@*"):
+                if old != entry:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(old)
+        except (OSError, ValueError) as e:
+            print(f"[STORAGE] local tier store failed for {path}: {e}")
+            return
+
+        with self._lock:
+            self._added_bytes += size
+            run_evict = self._added_bytes > self.max_bytes // 10
+            if run_evict:
+                self._added_bytes = 0
+        if run_evict:
+            self.evict()
+
+    def _store_bytes(self, bucket_name, path, generation, data):
+        def fill(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+        self._store(bucket_name, path, generation, fill, len(data))
+
+    def _store_file(self, bucket_name, path, generation, local_path):
+        self._store(bucket_name, path, generation, lambda tmp_path: shutil.copyfile(local_path, tmp_path),
+                    os.path.getsize(local_path))
+
+    def _drop(self, bucket_name, path):
+        base = self._entry(bucket_name, path, "")[:-1]
+        for entry in glob.glob(glob.escape(base) + "@*"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry)
+
+    def evict(self):
+        """合計サイズが上限の 8 割を切るまで、最終利用が古い順に消す"""
+        entries = []
+        for directory, dirs, files in os.walk(self.directory):
+            if directory == self.directory and ".tmp" in dirs:
+                dirs.remove(".tmp")
+            for filename in files:
+                file_path = os.path.join(directory, filename)
+                with contextlib.suppress(FileNotFoundError):
+                    st = os.stat(file_path)
+                    entries.append((st.st_mtime, st.st_size, file_path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, file_path in sorted(entries):
+            if total <= self.max_bytes * 0.8:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file_path)
+            total -= size
+            removed += 1
+        if removed:
+            print(f"[STORAGE] local tier evicted {removed} files")
+
+    def stat(self, bucket_name, path):
+        return self.remote.stat(bucket_name, path)
+
+    def read(self, bucket_name, path, generation=None):
+        if generation is None:
+            info = self.remote.stat(bucket_name, path)
+            if info is None:
+                raise NotFound(f"gs://{bucket_name}/{path} が見つかりません")
+            generation = info.generation
+        entry = self._entry(bucket_name, path, generation)
+        if self._hit(entry):
+            with contextlib.suppress(FileNotFoundError):
+                with open(entry, "rb") as f:
+                    return f.read()
+        data = self.remote.read(bucket_name, path, generation)
+        self._store_bytes(bucket_name, path, generation, data)
+        return data
+
+    def write(self, bucket_name, path, data, content_type=None, if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        generation = self.remote.write(bucket_name, path, data, content_type, if_generation_match)
+        self._store_bytes(bucket_name, path, generation, data)
+        return generation
+
+    def upload_file(self, bucket_name, path, local_path, content_type=None):
+        generation = self.remote.upload_file(bucket_name, path, local_path, content_type)
+        self._store_file(bucket_name, path, generation, local_path)
+        return generation
+
+    def download_file(self, bucket_name, path, local_path, generation=None):
+        if generation is None:
+            info = self.remote.stat(bucket_name, path)
+            if info is None:
+                raise NotFound(f"gs://{bucket_name}/{path} が見つかりません")
+            generation = info.generation
+        entry = self._entry(bucket_name, path, generation)
+        if self._hit(entry):
+            with contextlib.suppress(FileNotFoundError):
+                shutil.copyfile(entry, local_path)
+                return
+        self.remote.download_file(bucket_name, path, local_path, generation)
+        self._store_file(bucket_name, path, generation, local_path)
+
+    def copy(self, bucket_name, source_path, target_path):
+        return self.remote.copy(bucket_name, source_path, target_path)
+
+    def delete(self, bucket_name, path):
+        self.remote.delete(bucket_name, path)
+        self._drop(bucket_name, path)
+
+    def list(self, bucket_name, prefix):
+        return self.remote.list(bucket_name, prefix)
+
+    def list_prefixes(self, bucket_name, prefix):
+        return self.remote.list_prefixes(bucket_name, prefix)
+
+    def signed_url(self, bucket_name, path, lifetime):
+        return self.remote.signed_url(bucket_name, path, lifetime)
+
+
+def create(remote=None):
+    """環境変数で選んだ保存先を作る (remote を渡すと gcs の時に GCSBackend の代わりに使う。ベンチマーク用)"""
+    if STORAGE_BACKEND == "gcs":
+        backend = remote if remote is not None else GCSBackend()
+    elif STORAGE_BACKEND == "local":
+        backend = LocalBackend(STORAGE_LOCAL_DIR, STORAGE_LOCAL_URL)
+    elif STORAGE_BACKEND == "memory":
+        backend = MemoryBackend()
+    else:
+        raise RuntimeError(f"未対応の STORAGE_BACKEND です: {STORAGE_BACKEND}")
+
+    if STORAGE_LOCAL_TIER_DIR:
+        backend = LocalDiskTier(backend, STORAGE_LOCAL_TIER_DIR, STORAGE_LOCAL_TIER_MAX_BYTES)
+    print(f"[STORAGE] backend: {backend.name}")
+    return backend
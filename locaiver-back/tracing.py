@@ -0,0 +1,299 @@
+import functools
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+
+# "console" / "file" / "otlp" / "none" (カンマ区切りで複数指定できる)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "/tmp/locaiver-traces.jsonl")
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318").rstrip("/")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "locaiver-back")
+OTLP_BATCH_SIZE = 128
+OTLP_FLUSH_SECONDS = 5
+
+# 子スパンに引き継ぐ属性
+INHERITED_ATTRIBUTES = ("project_folder",)
+
+_current = ContextVar("tracing_current_span", default=None)
+
+
+class Span:
+    """処理 1 つ分の計測結果。属性は set() で後から追加できる"""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = {}
+        if parent:
+            for key in INHERITED_ATTRIBUTES:
+                if key in parent.attributes:
+                    self.attributes[key] = parent.attributes[key]
+        self.attributes.update({k: v for k, v in (attributes or {}).items() if v is not None})
+        self.start_time = time.time()
+        self.end_time = None
+        self.duration = None
+        self.status = "ok"
+        self.error = None
+        self._start = time.perf_counter()
+        self._token = None
+
+    def set(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+        return self
+
+    def record_error(self, error):
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}"
+
+    def finish(self, error=None):
+        """スパンを閉じてエクスポートする (start_span で開始した場合に呼ぶ)"""
+        if self.end_time is not None:
+            return
+        if error is not None:
+            self.record_error(error)
+        self.duration = time.perf_counter() - self._start
+        self.end_time = self.start_time + self.duration
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:
+                # 別のコンテキストで閉じられた場合は戻せないので、そのままにする
+                pass
+            self._token = None
+        _export(self)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+def current():
+    return _current.get()
+
+
+class RemoteParent:
+    """
+    別プロセスで子スパンを作るための親スパンの識別子 (pickle できる)。
+    Span の親として使えるよう trace_id / span_id / attributes だけを持つ。
+    """
+
+    def __init__(self, trace_id, span_id, attributes):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.attributes = attributes
+
+    def set(self, key, value):
+        # 親プロセスのスパンなのでここでは記録できない
+        return self
+
+
+def remote_parent():
+    """実行中のスパンを別プロセスに渡すための RemoteParent を返す (スパンの外なら None)"""
+    span_ = _current.get()
+    if span_ is None:
+        return None
+    attributes = {key: span_.attributes[key] for key in INHERITED_ATTRIBUTES if key in span_.attributes}
+    return RemoteParent(span_.trace_id, span_.span_id, attributes)
+
+
+@contextmanager
+def attach(parent):
+    """別プロセスから渡された RemoteParent を、with の中で作るスパンの親にする"""
+    token = _current.set(parent)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def set_attribute(key, value):
+    """実行中のスパンに属性を付ける (スパンの外では何もしない)"""
+    span_ = _current.get()
+    if span_ is not None:
+        span_.set(key, value)
+
+
+def start_span(name, **attributes):
+    """スパンを開始して実行中にする。with が使えない場所 (リクエストの前後フック等) 用"""
+    span_ = Span(name, _current.get(), attributes)
+    span_._token = _current.set(span_)
+    return span_
+
+
+@contextmanager
+def span(name, **attributes):
+    """with ブロックの間を 1 スパンとして計測する"""
+    span_ = start_span(name, **attributes)
+    try:
+        yield span_
+    except BaseException as e:
+        span_.finish(error=e)
+        raise
+    span_.finish()
+
+
+def traced(name=None, **attributes):
+    """関数の実行全体をスパンにするデコレータ"""
+    def decorator(fn):
+        span_name = name or f"{fn.__module__}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def wrap(fn):
+    """
+    別スレッドで実行する関数を、呼び出し元のスパンの子として計測されるようにする。
+    ThreadPoolExecutor はコンテキストを引き継がないので、submit する前に包む。
+    スパンだけでなく呼び出し元のコンテキスト全体 (retry の期限など) を引き継ぐ。
+    """
+    context = copy_context()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        # 同じ関数が複数のスレッドで同時に実行されうるので、呼び出しごとに複製して使う
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+# ===== エクスポーター =====
+class ConsoleExporter:
+    def export(self, span_):
+        print("[TRACE] " + json.dumps(span_.to_dict(), ensure_ascii=False, default=str), flush=True)
+
+
+class FileExporter:
+    """1 スパン 1 行の JSON Lines で追記する"""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span_):
+        line = json.dumps(span_.to_dict(), ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpExporter:
+    """
+    OTLP/HTTP (JSON) でコレクターに送る。
+    リクエストの処理を止めないよう、バックグラウンドスレッドでまとめて送信する。
+    """
+
+    def __init__(self, endpoint=OTLP_ENDPOINT, service_name=SERVICE_NAME):
+        import requests
+
+        self.url = f"{endpoint}/v1/traces"
+        self.service_name = service_name
+        self.session = requests.Session()
+        self._queue = queue.Queue(maxsize=OTLP_BATCH_SIZE * 16)
+        threading.Thread(target=self._loop, name="otlp-exporter", daemon=True).start()
+
+    def export(self, span_):
+        try:
+            self._queue.put_nowait(span_)
+        except queue.Full:
+            pass  # コレクターが詰まっている時は捨てる
+
+    def _to_otlp(self, span_):
+        data = {
+            "traceId": span_.trace_id,
+            "spanId": span_.span_id,
+            "name": span_.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(span_.start_time * 1e9)),
+            "endTimeUnixNano": str(int(span_.end_time * 1e9)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span_.attributes.items()],
+            "status": {"code": 2, "message": span_.error} if span_.status == "error" else {"code": 1},
+        }
+        if span_.parent_id:
+            data["parentSpanId"] = span_.parent_id
+        return data
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + OTLP_FLUSH_SECONDS
+            while len(batch) < OTLP_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            payload = {
+                "resourceSpans": [{
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                    "scopeSpans": [{"scope": {"name": "locaiver"}, "spans": [self._to_otlp(s) for s in batch]}],
+                }]
+            }
+            try:
+                self.session.post(self.url, json=payload, timeout=10)
+            except Exception as e:
+                print(f"[TRACE] OTLP export failed: {e}", flush=True)
+
+
+_exporters = []
+
+
+def add_exporter(exporter):
+    """export(span) を持つオブジェクトを登録する (メトリクス集計などもここから受け取る)"""
+    _exporters.append(exporter)
+
+
+def _export(span_):
+    for exporter in _exporters:
+        try:
+            exporter.export(span_)
+        except Exception as e:
+            print(f"[TRACE] export failed: {e}", flush=True)
+
+
+def _configure():
+    for name in (n.strip() for n in TRACE_EXPORTER.split(",")):
+        if name == "console":
+            add_exporter(ConsoleExporter())
+        elif name == "file":
+            add_exporter(FileExporter())
+        elif name == "otlp":
+            add_exporter(OtlpExporter())
+        elif name not in ("", "none"):
+            print(f"[TRACE] unknown exporter: {name}", flush=True)
+
+
+_configure()
@@ -1,21 +1,62 @@
+import hashlib
 import json
-import google.generativeai as genai
+import threading
+from cachetools import LRUCache
+import clients
 import gcs_utils
-import os
+import llm_json
 
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+TRANSLATE_MODEL = "gemini-2.5-pro"
+TARGET_LANGUAGE = "en"
+# プロンプトを変えたら上げる (古い翻訳キャッシュを使わないため)
+PROMPT_VERSION = 1
 
 
-def translate_json(bucket_name, input_path: str, output_path: str):
-    
-    genai.configure(api_key=GOOGLE_API_KEY)
+# ===== 翻訳キャッシュ =====
+# プロセス内 LRU と、プロジェクトの json/translations/ 以下の 2 段で持つ
+_memo = LRUCache(maxsize=256)
+_memo_lock = threading.Lock()
 
-    # 2. JSONファイルを読み込む
-    # gcsとのやり取りに変える
-    story_data = gcs_utils.read_json(bucket_name, input_path)
 
-    # 物語の本文（storyキーを想定）
+def translation_key(data, target_language=TARGET_LANGUAGE, model_name=TRANSLATE_MODEL):
+    """入力 JSON (キー順を正規化) と翻訳先言語・モデルから翻訳キャッシュのキーを作る"""
+    canonical = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    payload = json.dumps([canonical, target_language, model_name, PROMPT_VERSION], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _project_cache_path(input_path, key):
+    folder = input_path.rsplit("/", 1)[0] if "/" in input_path else ""
+    return f"{folder}/translations/{key}.json" if folder else f"translations/{key}.json"
+
+
+def _lookup(bucket_name, input_path, key):
+    with _memo_lock:
+        cached = _memo.get(key)
+    if cached is not None:
+        return json.loads(cached)
+
+    try:
+        translated = gcs_utils.read_json(bucket_name, _project_cache_path(input_path, key))
+    except Exception:
+        return None
+    with _memo_lock:
+        _memo[key] = json.dumps(translated, ensure_ascii=False)
+    return translated
+
+
+def _remember(bucket_name, input_path, key, translated):
+    with _memo_lock:
+        _memo[key] = json.dumps(translated, ensure_ascii=False)
+    try:
+        gcs_utils.write_json(bucket_name, translated, _project_cache_path(input_path, key))
+    except Exception as e:
+        print("翻訳キャッシュを保存できませんでした:", e)
+
+
+def _translate_data(data):
+    """JSON の値を英語に翻訳したものを返す (モデル呼び出し)"""
 
     # 3. AIへのプロンプトを作成
     PROMPT = f"""
@@ -23,32 +64,118 @@ def translate_json(bucket_name, input_path: str, output_path: str):
 
     json本体:
     ---
-    {story_data}
+    {data}
     ---
     
     返すのはjsonのフォーマットで、そのデータだけを返してください。
     """
 
     # 4. モデルを指定して呼び出し
-    model = genai.GenerativeModel("gemini-2.5-pro")
-    response = model.generate_content(PROMPT)
+    model = clients.generative_model(TRANSLATE_MODEL)
+    # 5. 構造化出力モードで生成し、JSONとして受け取る
+    return llm_json.generate_json(model, PROMPT, llm_json.schema_from_example(data), kind="translate")
 
-    # 5. 応答を取得
-    text = response.text
 
-    # JSONとしてパースできるよう整形
-    try:
-        cleaned = text.strip().strip("```").replace("json", "").strip()
-        scenes_json = json.loads(cleaned)
-    except Exception as e:
-        print("AIの出力をJSONとしてパースできませんでした。生テキストを表示します:")
-        print(text)
-        raise e
+def _translate_cached(bucket_name, input_path, data):
+    """同じ内容を翻訳済みならモデルを呼ばずにキャッシュを返す"""
+    key = translation_key(data)
+    cached = _lookup(bucket_name, input_path, key)
+    if cached is not None:
+        return cached, True
+
+    translated = _translate_data(data)
+    _remember(bucket_name, input_path, key, translated)
+    return translated, False
+
+
+def translate_json(bucket_name, input_path: str, output_path: str):
+    
+    # 2. JSONファイルを読み込む
+    # gcsとのやり取りに変える
+    story_data = gcs_utils.read_json(bucket_name, input_path)
+
+    scenes_json, from_cache = _translate_cached(bucket_name, input_path, story_data)
 
     # 6. 結果をファイルに保存
     # gcs
     gcs_utils.write_json(bucket_name, scenes_json, output_path)
 
-    print(f"翻訳結果を {output_path} に保存しました")
+    if from_cache:
+        print(f"翻訳キャッシュを {output_path} に保存しました")
+    else:
+        print(f"翻訳結果を {output_path} に保存しました")
+
+    return scenes_json
+
+
+# ===== 差分翻訳 =====
+def _string_leaves(obj, path=()):
+    """JSON 中の文字列の値を (パス, 値) で列挙する"""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            yield from _string_leaves(v, path + (k,))
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            yield from _string_leaves(v, path + (i,))
+    elif isinstance(obj, str):
+        yield path, obj
+
+
+def _get_path(obj, path):
+    for key in path:
+        if isinstance(obj, dict) and key in obj:
+            obj = obj[key]
+        elif isinstance(obj, list) and isinstance(key, int) and key < len(obj):
+            obj = obj[key]
+        else:
+            return None
+    return obj
 
-    return scenes_json
\ No newline at end of file
+
+def _set_path(obj, path, value):
+    for key in path[:-1]:
+        obj = obj[key]
+    obj[path[-1]] = value
+
+
+def translate_json_incremental(bucket_name, prev_ja_path: str, prev_en_path: str, input_path: str, output_path: str):
+    """
+    input_path (日本語) を英訳して output_path に保存する。
+    直前の版 prev_ja_path と値が変わっていない文字列は、その英訳 prev_en_path の値をそのまま使い、
+    変わった文字列だけをモデルに送る。
+    """
+    new_ja = gcs_utils.read_json(bucket_name, input_path)
+    try:
+        prev_ja = gcs_utils.read_json(bucket_name, prev_ja_path)
+        prev_en = gcs_utils.read_json(bucket_name, prev_en_path)
+    except Exception as e:
+        print("直前の版が読めないので全体を翻訳します:", e)
+        return translate_json(bucket_name, input_path, output_path)
+
+    # 構造 (文字列以外の値) は新しい日本語版に合わせ、文字列だけ差し替える
+    result = json.loads(json.dumps(new_ja))
+    changed = {}
+    for path, text in _string_leaves(new_ja):
+        prev_text = _get_path(prev_ja, path)
+        prev_translation = _get_path(prev_en, path)
+        if prev_text == text and isinstance(prev_translation, str):
+            _set_path(result, path, prev_translation)
+        else:
+            changed[path] = text
+
+    if changed:
+        print(f"変更された {len(changed)} 件の文字列だけを翻訳します")
+        paths = list(changed)
+        request = {str(n): changed[path] for n, path in enumerate(paths)}
+        translated, _ = _translate_cached(bucket_name, input_path, request)
+        for n, path in enumerate(paths):
+            value = translated.get(str(n)) if isinstance(translated, dict) else None
+            if not isinstance(value, str):
+                raise ValueError(f"差分翻訳の結果に {path} の値がありません")
+            _set_path(result, path, value)
+    else:
+        print("変更された文字列はありません")
+
+    gcs_utils.write_json(bucket_name, result, output_path)
+    print(f"翻訳結果を {output_path} に保存しました")
+    return result
@@ -1,27 +1,41 @@
-import time
-from google import genai
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from google.genai import types
-from google.cloud import storage
-import vertexai
 import os
+import clients
 import gcs_utils
 import subprocess
 import imageio_ffmpeg as ffmpeg
 import generate_bgm
-import make_bgm_prompt
+import operation_poller
+import retry
+import tracing
+import workspace
 
 
-GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
-GOOGLE_CLOUD_REGION = os.getenv("GOOGLE_CLOUD_REGION")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 MODEL = "veo-3.0-fast-generate-001" 
+NUM_CLIPS = 4
+GENERATE_ALL = 5
+VIDEO_RETRY = 5
+# 1 クリップあたりの期限 (秒)。残りが 1 回分のレンダリング時間を切ったら再投入しない
+VIDEO_DEADLINE_SECONDS = float(os.getenv("VIDEO_DEADLINE_SECONDS", "1800"))
+
+# 生成リクエストの投入 (レンダリング自体の失敗は generate_video_with_retry / generate_all_videos で扱う)
+VIDEO_SUBMIT_RETRY = retry.RetryPolicy(
+    "veo.submit", max_attempts=4, base_delay=5, max_delay=60, deadline=300, breaker_name=f"vertex:{MODEL}",
+)
+GCS_MOVE_RETRY = retry.RetryPolicy("gcs.move", max_attempts=4, base_delay=1, max_delay=10, deadline=300)
+FINALIZE_PROCESSES = int(os.getenv("FINALIZE_PROCESSES", "0"))
+# プロセスプールでの完成処理を待つ上限 (秒)。リクエストの期限が残っていればその残りで打ち切る
+FINALIZE_TIMEOUT_SECONDS = float(os.getenv("FINALIZE_TIMEOUT_SECONDS", "1200"))
 
 
 # ===== プロンプトを安全に言い換え =====
 def sanitize_prompt_with_gemini(prompt: str) -> str:
-    from vertexai.generative_models import GenerativeModel
-
-    model = GenerativeModel("gemini-2.5-pro")
+    model = clients.vertex_model("gemini-2.5-pro", location="us-central1")
 
     """
     Gemini を用いて NG ワードを徹底的に除去し、
@@ -42,17 +56,23 @@ def sanitize_prompt_with_gemini(prompt: str) -> str:
         "6. Output ONLY the safe rewritten text, nothing else."
     )
 
-    response = model.generate_content(
-        [system_instruction, prompt],
-        generation_config={"temperature": 0.0, "max_output_tokens": 256},
-    )
+    with tracing.span("model.generate_content", kind="sanitize", model="gemini-2.5-pro", prompt_chars=len(prompt)):
+        response = model.generate_content(
+            [system_instruction, prompt],
+            generation_config={"temperature": 0.0, "max_output_tokens": 256},
+        )
 
     return response.text.strip()
 
 
-# ===== 動画を結合 =====
-def merge_videos(video_paths, output_file):
-    list_file = "videos.txt"
+# ===== 動画の結合と BGM の追加を 1 回の ffmpeg で行う =====
+def assemble_video(video_paths, bgm_path, no_bgm_path, result_path):
+    """
+    クリップを連結した無音動画と、BGM を載せた完成動画を 1 回の ffmpeg 実行で同時に書き出す。
+    映像はどちらも再エンコードせずコピーする。
+    """
+    # 連結リストは出力と同じ作業ディレクトリに置く
+    list_file = os.path.join(os.path.dirname(result_path), "videos.txt")
     with open(list_file, "w", encoding="utf-8") as f:
         for path in video_paths:
             f.write(f"file '{path}'\n")
@@ -62,170 +82,386 @@ def merge_videos(video_paths, output_file):
         "-y",
         "-f", "concat", "-safe", "0",
         "-i", list_file,
-        "-c:v", "copy",  # 映像は再エンコードせずコピー
-        "-an",           # 音声を削除（無音化）
-        output_file
-    ]
-    subprocess.run(cmd, check=True)
-    print(f"無音動画を保存しました → {output_file}")
-    
-    
-# ===== 動画にbgmを追加 =====
-def merge_bgm(video_path, bgm_path, output_path):
-    ffmpeg_path = ffmpeg.get_ffmpeg_exe()
-
-    cmd = [
-        ffmpeg_path,   # "ffmpeg" ではなく、このパスを渡す
-        "-y",
-        "-i", video_path,
         "-i", bgm_path,
+        # 出力1: 無音動画
+        "-map", "0:v:0",
         "-c:v", "copy",
-        "-c:a", "aac",
+        "-an",
+        no_bgm_path,
+        # 出力2: BGM 付き完成動画
         "-map", "0:v:0",
         "-map", "1:a:0",
+        "-c:v", "copy",
+        # AAC 版の BGM ならそのままコピーする
+        "-c:a", "copy" if bgm_path.endswith(".m4a") else "aac",
         "-shortest",
-        output_path
+        result_path,
     ]
-    subprocess.run(cmd, check=True)
-    print(f"Final video with BGM saved: {output_path}")
-    return output_path
+    with tracing.span("ffmpeg", op="assemble_video", clips=len(video_paths)) as span:
+        subprocess.run(cmd, check=True)
+        span.set("output_bytes", os.path.getsize(no_bgm_path) + os.path.getsize(result_path))
+    print(f"無音動画を保存しました → {no_bgm_path}")
+    print(f"Final video with BGM saved: {result_path}")
+    return result_path
 
 
-# ===== 動画生成 =====
-def generate_video_with_retry(i, input_image, prompt, output_gcs_uri, project_folder, genai_client):
-    
-    retry = 5
-    attempt = 0
-    current_prompt = prompt
-    aspect_ratio = gcs_utils.read_json(BUCKET_NAME, project_folder + "json/user_input_akakura_ja.json").get("format")
+# ===== 動画生成の設定をユーザー入力から取得 =====
+def video_settings(project_folder):
+    user_input = gcs_utils.read_json(BUCKET_NAME, project_folder + "json/user_input_akakura_ja.json")
+
+    aspect_ratio = user_input.get("format")
     if aspect_ratio == "縦":
         aspect_ratio = "9:16"
     elif aspect_ratio == "横":
         aspect_ratio = "16:9"
-        
-    seconds = gcs_utils.read_json(BUCKET_NAME, project_folder + "json/user_input_akakura_ja.json").get("seconds")
+
+    seconds = user_input.get("seconds")
     if seconds == 16:
         duration_seconds = 4
     elif seconds == 24:
         duration_seconds = 6
     elif seconds == 32:
         duration_seconds = 8
+
+    return aspect_ratio, duration_seconds
+
+
+def submit_video(genai_client, input_image, prompt, output_gcs_uri, aspect_ratio, duration_seconds, attempt=1):
+    """Veo の生成リクエストを投げ、未完了のオペレーションを返す (attempt は何回目のレンダリングか)"""
+    def submit(submit_attempt):
+        with tracing.span(
+            "model.generate_videos", kind="veo", model=MODEL, attempt=submit_attempt, render_attempt=attempt,
+            prompt_chars=len(prompt), duration_seconds=duration_seconds,
+        ):
+            return genai_client.models.generate_videos(
+                model=MODEL,
+                prompt=prompt,
+                config=types.GenerateVideosConfig(
+                    aspect_ratio=aspect_ratio,
+                    output_gcs_uri=output_gcs_uri,
+                    number_of_videos=1,
+                    duration_seconds=duration_seconds,
+                    person_generation="allow_all",
+                    enhance_prompt=True,
+                ),
+                image={"gcsUri": input_image, "mimeType": "image/png"},
+            )
+
+    return VIDEO_SUBMIT_RETRY.call(submit)
+
+
+def generated_videos(operation):
+    if getattr(operation, "result", None) and getattr(operation.result, "generated_videos", None):
+        return operation.result.generated_videos
+    if getattr(operation, "response", None) and getattr(operation.response, "generated_videos", None):
+        return operation.response.generated_videos
+    return None
+
+
+def render_retry_action(error, attempts, deadline, expected):
+    """
+    レンダリングに失敗したクリップをどう再投入するかを返す。None なら諦める。
+      "sanitize": 安全フィルタ等で拒否されたので、プロンプトを安全化して再投入する
+      "same":     クォータ超過や一時的な障害なので、同じプロンプトで再投入する
+    """
+    if attempts >= VIDEO_RETRY:
+        return None
+    if deadline.remaining() < expected:
+        print(f"期限までに再レンダリングが終わらないため再投入しません (残り {deadline.remaining():.0f} 秒)")
+        return None
+    if isinstance(error, Exception):
+        return "same" if retry.is_retryable(error) else None
+    code = error.get("code") if isinstance(error, dict) else getattr(error, "code", None)
+    # 動画が無く error も無いのは安全フィルタで除外された時
+    if code is None or code == 3:  # 3 = INVALID_ARGUMENT
+        return "sanitize"
+    if retry.is_retryable_status(code):
+        return "same"
+    return None
+
+
+def store_videos(i, videos, project_folder):
+    """生成された動画を videos/{i}.mp4 に移動する"""
+    final_path = None
+    for video in videos:
+        gcs_uri = video.video.uri
+        new_filename = f"{i}.mp4"
+        try:
+            final_path = GCS_MOVE_RETRY.call(
+                lambda attempt: gcs_utils.move_and_cleanup(gcs_uri, project_folder+"videos/", new_filename)
+            )
+        except Exception as e:
+            print("Failed to move video after retries, skipping", e)
+        print("Final saved:", final_path)
+    return final_path
+
+
+# ===== 動画生成 =====
+def generate_video_with_retry(i, input_image, prompt, output_gcs_uri, project_folder, genai_client):
     
-    while attempt < retry:
+    attempt = 0
+    current_prompt = prompt
+    aspect_ratio, duration_seconds = video_settings(project_folder)
+    expected = operation_poller.expected_render_seconds(duration_seconds)
+    deadline = retry.Deadline(VIDEO_DEADLINE_SECONDS)
+    
+    while True:
         attempt += 1
         print(f"No.{i} 動画生成試行 {attempt} 回目…")
         print("使用プロンプト:", current_prompt)
 
-        operation = genai_client.models.generate_videos(
-            model=MODEL,
-            prompt=current_prompt,
-            config=types.GenerateVideosConfig(
-                aspect_ratio=aspect_ratio,
-                output_gcs_uri=output_gcs_uri,
-                number_of_videos=1,
-                duration_seconds=duration_seconds,
-                person_generation="allow_all",
-                enhance_prompt=True,
-            ),
-            image={"gcsUri": input_image, "mimeType": "image/png"},
-        )
+        operation = submit_video(genai_client, input_image, current_prompt, output_gcs_uri, aspect_ratio, duration_seconds, attempt)
 
         # -------------------------
-        # 処理完了まで待機
+        # 処理完了まで待機 (共有ポーラーが監視)
         # -------------------------
-        while not operation.done:
-            time.sleep(10)
-            operation = genai_client.operations.get(operation)
+        try:
+            operation = operation_poller.poller.wait(genai_client, operation, expected, timeout=deadline.remaining())
+            videos = generated_videos(operation)
+            error = None if videos else operation.error
+        except Exception as e:
+            videos = None
+            error = e
 
         # -------------------------
         # 結果確認
         # -------------------------
-        videos = None
-        if getattr(operation, "result", None) and getattr(operation.result, "generated_videos", None):
-            videos = operation.result.generated_videos
-        elif getattr(operation, "response", None) and getattr(operation.response, "generated_videos", None):
-            videos = operation.response.generated_videos
-
-        final_path = None
         if videos:
-            for idx, video in enumerate(operation.result.generated_videos, start=1):
-                gcs_uri = video.video.uri
-                new_filename = f"{i}.mp4"
-                success = False
-                for _ in range(3):
-                    try:
-                        final_path = gcs_utils.move_and_cleanup(gcs_uri, project_folder+"videos/", new_filename)
-                        success = True
-                        break
-                    except Exception as e:
-                        print("GCS move failed, retrying...", e)
-                        time.sleep(5)
-
-                if not success:
-                    print("Failed to move video after retries, skipping")
-                print("Final saved:", final_path)
+            store_videos(i, videos, project_folder)
             return True  # 成功
-        else:
-            print(f"動画生成に失敗しました: {operation.error}")
+
+        print(f"動画生成に失敗しました: {error}")
+        action = render_retry_action(error, attempt, deadline, expected)
+        if action is None:
+            break
+        if action == "sanitize":
             # プロンプトを安全化して再試行
             current_prompt = sanitize_prompt_with_gemini(current_prompt)
 
     # すべて失敗した場合
-    print(f"No.{i} は全ての試行で失敗しました。スキップします。")
+    print(f"No.{i} は再試行をあきらめました。スキップします。")
     return False
 
 
+# ===== シーンごとのプロンプトと入力画像を取得 =====
+def load_clip_inputs(project_folder):
+    bucket_name = BUCKET_NAME
+    images_prefix = project_folder + "images/"
+    json_prefix   = project_folder + "json/"
+
+    latest_version = gcs_utils.get_latest_version_file(project_folder)
+    json_content = gcs_utils.read_json(bucket_name, json_prefix + latest_version)
+    scenes = json_content["scenes"]
+
+    prompts = []
+    for scene in scenes:
+        prompt = (
+            f"Scene {scene['scene_id']}: {scene['depiction']} "
+            f"Composition details: {scene['composition']['camera_angle']}, "
+            f"{scene['composition']['view']}, "
+            f"shot with {scene['composition']['focal_length']} lens, "
+            f"lighting: {scene['composition']['lighting']}, "
+            f"focus: {scene['composition']['focus']}."
+        )
+        prompts.append(prompt)
+
+    image_files = gcs_utils.list_images_in_folder(bucket_name, images_prefix)
+    input_images = [f"gs://{bucket_name}/{images_prefix}{image_file}" for image_file in image_files]
+    return prompts, input_images
+
+
+# ===== 全シーンの映像を並行生成 =====
+@tracing.traced("video.generate_all")
+def generate_all_videos(project_folder, genai_client):
+    """
+    全クリップの生成リクエストをまとめて投げ、共有ポーラーで同時に監視する。
+    失敗したクリップだけプロンプトを安全化して再投入し、他のクリップはそのまま進める。
+    """
+    prompts, input_images = load_clip_inputs(project_folder)
+    clip_count = min(len(prompts), len(input_images))
+    if clip_count < NUM_CLIPS:
+        raise IndexError(f"シーンまたは画像が不足しています (scenes={len(prompts)}, images={len(input_images)})")
+
+    output_gcs_uri = f"gs://{BUCKET_NAME}/{project_folder}videos/"
+    aspect_ratio, duration_seconds = video_settings(project_folder)
+    expected = operation_poller.expected_render_seconds(duration_seconds)
+
+    current_prompts = {num + 1: prompts[num] for num in range(NUM_CLIPS)}
+    attempts = {video_index: 0 for video_index in current_prompts}
+    deadline = retry.Deadline(VIDEO_DEADLINE_SECONDS)
+
+    def start(video_index):
+        attempts[video_index] += 1
+        print(f"No.{video_index} 動画生成試行 {attempts[video_index]} 回目…")
+        print("使用プロンプト:", current_prompts[video_index])
+        operation = submit_video(
+            genai_client, input_images[video_index - 1], current_prompts[video_index],
+            output_gcs_uri, aspect_ratio, duration_seconds, attempts[video_index],
+        )
+        return operation_poller.poller.track(genai_client, operation, expected)
+
+    # 途中のクリップの投入に失敗しても、投入済みのオペレーションは課金されながら進むので見失わずに待つ
+    in_flight = {}
+    failed = []
+    for video_index in current_prompts:
+        try:
+            in_flight[start(video_index)] = video_index
+        except Exception as e:
+            print(f"No.{video_index} の投入に失敗しました: {e}")
+            failed.append(video_index)
+
+    while in_flight:
+        done, _ = wait(in_flight, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            # 期限までに終わらなかったクリップは監視をやめて失敗にする
+            for future, video_index in in_flight.items():
+                operation_poller.poller.untrack(future)
+                print(f"No.{video_index} は期限までに完了しませんでした。")
+                failed.append(video_index)
+            break
+        for future in done:
+            video_index = in_flight.pop(future)
+            try:
+                operation = future.result()
+                videos = generated_videos(operation)
+                error = None if videos else operation.error
+            except Exception as e:
+                videos = None
+                error = e
+
+            if videos:
+                store_videos(video_index, videos, project_folder)
+                continue
+
+            print(f"No.{video_index} の動画生成に失敗しました: {error}")
+            action = render_retry_action(error, attempts[video_index], deadline, expected)
+            if action is None:
+                print(f"No.{video_index} は再試行をあきらめました。")
+                failed.append(video_index)
+                continue
+
+            # このクリップだけ再投入 (拒否された場合はプロンプトを安全化する)
+            if action == "sanitize":
+                current_prompts[video_index] = sanitize_prompt_with_gemini(current_prompts[video_index])
+            try:
+                in_flight[start(video_index)] = video_index
+            except Exception as e:
+                # 投入自体が失敗した (Veo が障害中等)。他のクリップは待ち続ける
+                print(f"No.{video_index} の再投入に失敗しました: {e}")
+                failed.append(video_index)
+
+    if failed:
+        raise RuntimeError(f"動画生成に失敗したクリップがあります: {sorted(failed)}")
+
+
+# ===== 完成処理 =====
+@tracing.traced("video.finalize")
+def finalize(project_folder):
+    """
+    動画の取得と BGM 生成を並行して行い、1 回の ffmpeg で結合と BGM 追加をしてアップロードする。
+    ファイルはジョブ専用の作業ディレクトリに置くので、複数プロジェクトを同時に処理できる。
+    """
+    bucket_name = BUCKET_NAME
+
+    VIDEO_FILES = [
+        project_folder + f"videos/{n}.mp4" for n in range(1, NUM_CLIPS + 1)
+    ]
+
+    with workspace.job_workspace() as work_dir:
+        no_bgm_path = os.path.join(work_dir, "no_bgm.mp4")
+        result_path = os.path.join(work_dir, "result.mp4")
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            # BGM は /chat-fin の時点で先行生成されている。取得 (未完了なら待機) とダウンロードを並行して進める
+            bgm_future = pool.submit(tracing.wrap(generate_bgm.fetch_bgm), project_folder, work_dir)
+            local_video_paths = gcs_utils.download_videos(bucket_name, VIDEO_FILES, os.path.join(work_dir, "videos"))
+            bgm_path = bgm_future.result()
+
+        print("assemble start")
+        assemble_video(local_video_paths, bgm_path, no_bgm_path, result_path)
+        print("assemble end")
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            uploads = [
+                pool.submit(tracing.wrap(gcs_utils.upload_to_gcs), bucket_name, no_bgm_path, project_folder + "result/no_bgm.mp4"),
+                pool.submit(tracing.wrap(gcs_utils.upload_to_gcs), bucket_name, result_path, project_folder + "result/result.mp4"),
+            ]
+            for upload in uploads:
+                upload.result()
+
+
+_finalize_pool = None
+_finalize_pool_lock = threading.Lock()
+
+
+def _finalize_in_child(project_folder, trace_parent, budget_seconds):
+    """
+    プロセスプールの子プロセスで完成処理を行う。
+    コンテキスト変数はプロセスをまたがないので、親のスパンと期限の残りを引数で受け取って設定し直す。
+    """
+    with tracing.attach(trace_parent), retry.budget(budget_seconds):
+        finalize(project_folder)
+
+
+def run_finalize(project_folder):
+    """
+    FINALIZE_PROCESSES > 0 ならプロセスプールで、そうでなければ呼び出しスレッドで完成処理を行う。
+    /video は完成した動画の URL を返すので呼び出しスレッドは完了を待つが、待つのは期限の残りまで。
+    """
+    global _finalize_pool
+    if FINALIZE_PROCESSES <= 0:
+        finalize(project_folder)
+        return
+
+    with _finalize_pool_lock:
+        if _finalize_pool is None:
+            # fork だと親の gRPC/HTTP 接続を引き継いでしまうので spawn で起動する
+            _finalize_pool = ProcessPoolExecutor(
+                max_workers=FINALIZE_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+    budget_seconds = retry.remaining()
+    future = _finalize_pool.submit(_finalize_in_child, project_folder, tracing.remote_parent(), budget_seconds)
+    timeout = FINALIZE_TIMEOUT_SECONDS if budget_seconds is None else min(budget_seconds, FINALIZE_TIMEOUT_SECONDS)
+    try:
+        future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # 実行中の子プロセスは止められないが、待ち行列に残っていれば取り消す
+        future.cancel()
+        raise TimeoutError(f"完成処理が {timeout:.0f} 秒以内に終わりませんでした: {project_folder}") from None
+
+
 # ===== main =====
 def main(project_folder, num):
     """
     num:
       0~3 -> 対応する1本の映像のみ生成 → "success" を返す
       4    -> GCSから動画取得→結合→BGM生成→マージ→アップロード → "complete" を返す
+      5    -> 全シーンの映像を並行生成→完成処理(4 と同じ) → "complete" を返す
     """
-    if not isinstance(num, int) or num < 0 or num > 4:
-        raise ValueError("num は 0〜4 の整数で指定してください。")
+    if not isinstance(num, int) or num < 0 or num > GENERATE_ALL:
+        raise ValueError(f"num は 0〜{GENERATE_ALL} の整数で指定してください。")
 
     bucket_name = BUCKET_NAME
-    project = GOOGLE_CLOUD_PROJECT
     location = "us-central1"
 
     # -------------------------
     # Vertex AI クライアント初期化
     # -------------------------
-    genai_client = genai.Client(vertexai=True, project=project, location=location)
-    vertexai.init(project=project, location=location)
+    genai_client = clients.vertex_genai_client(location)
 
     videos_prefix = project_folder + "videos/"
-    images_prefix = project_folder + "images/"
-    json_prefix   = project_folder + "json/"
 
     # --- num=0~3 の場合：映像生成のみ ---
     if num in (0, 1, 2, 3):
-        latest_version = gcs_utils.get_latest_version_file(project_folder)
-        json_content = gcs_utils.read_json(bucket_name, json_prefix + latest_version)
-        scenes = json_content["scenes"]
-
-        prompts = []
-        for scene in scenes:
-            prompt = (
-                f"Scene {scene['scene_id']}: {scene['depiction']} "
-                f"Composition details: {scene['composition']['camera_angle']}, "
-                f"{scene['composition']['view']}, "
-                f"shot with {scene['composition']['focal_length']} lens, "
-                f"lighting: {scene['composition']['lighting']}, "
-                f"focus: {scene['composition']['focus']}."
-            )
-            prompts.append(prompt)
-
-        image_files = gcs_utils.list_images_in_folder(bucket_name, images_prefix)
+        prompts, input_images = load_clip_inputs(project_folder)
 
-        if num >= len(image_files):
+        if num >= len(input_images):
             raise IndexError(f"images フォルダに num={num} 用のファイルがありません。")
         if num >= len(prompts):
             raise IndexError(f"scenes が num={num} に対応していません。")
 
         video_index = num + 1
-        input_image_gcs = f"gs://{bucket_name}/{images_prefix}{image_files[num]}"
+        input_image_gcs = input_images[num]
         output_gcs_uri  = f"gs://{bucket_name}/{videos_prefix}"
 
         generate_video_with_retry(
@@ -239,28 +475,11 @@ def main(project_folder, num):
 
         return "success"
 
-    # --- num=4 の場合：完成処理 ---
-    VIDEO_FILES = [
-        project_folder + "videos/1.mp4",
-        project_folder + "videos/2.mp4",
-        project_folder + "videos/3.mp4",
-        project_folder + "videos/4.mp4",
-    ]
-    local_video_paths = gcs_utils.download_videos(bucket_name, VIDEO_FILES)
-
-    merge_videos(local_video_paths, "no_bgm.mp4")
-    gcs_utils.upload_to_gcs(bucket_name, "no_bgm.mp4", project_folder + "result/no_bgm.mp4")
-
-    print("create_bgm start")
-    prompt = make_bgm_prompt.make_prompt(bucket_name, project_folder + "json/story_script_akakura_en.json")
-    print(prompt)
-    generate_bgm.lyria(project_folder, prompt, "")
-    print("create_bgm end")
+    # --- num=5 の場合：全クリップをまとめて生成してから完成処理 ---
+    if num == GENERATE_ALL:
+        generate_all_videos(project_folder, genai_client)
 
-    print("merge bgm start")
-    merge_bgm("no_bgm.mp4", "bgm.wav", "result.mp4")
-    print("merge bgm end")
-
-    gcs_utils.upload_to_gcs(bucket_name, "result.mp4", project_folder + "result/result.mp4")
+    # --- num=4 の場合：完成処理 ---
+    run_finalize(project_folder)
 
     return "complete"
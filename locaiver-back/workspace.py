@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+# 作業ディレクトリの置き場所。未指定なら十分な空きがある場合に限り tmpfs (/dev/shm) を使う
+WORKSPACE_ROOT = os.getenv("WORKSPACE_ROOT")
+TMPFS_ROOT = "/dev/shm"
+TMPFS_MIN_FREE_BYTES = 512 * 1024 * 1024
+
+
+def _default_root():
+    if WORKSPACE_ROOT:
+        return WORKSPACE_ROOT
+    try:
+        stat = os.statvfs(TMPFS_ROOT)
+    except OSError:
+        return None
+    if os.access(TMPFS_ROOT, os.W_OK) and stat.f_bavail * stat.f_frsize >= TMPFS_MIN_FREE_BYTES:
+        return TMPFS_ROOT
+    return None  # tempfile の既定 (/tmp など)
+
+
+@contextmanager
+def job_workspace(prefix="locaiver-"):
+    """ジョブ専用の一時ディレクトリを作り、終了時 (失敗時も) に丸ごと削除する"""
+    path = tempfile.mkdtemp(prefix=prefix, dir=_default_root())
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)